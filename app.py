@@ -1,15 +1,14 @@
 import io
 import os
 
-import openai
 import pydub
-import requests
 import soundfile as sf
 import speech_recognition as sr
 from flask import Flask, jsonify, request
-import json
 import copy
-from scheduler import schedule_job, cancel_job
+from state_store import StateStore, SUMMARIZED_JOB
+from scheduler import job_queue
+import notifier
 from argparse import ArgumentParser
 import dotenv
 import datetime
@@ -27,13 +26,17 @@ os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 from empathy_framework import EmpatheticResponder
 
 import dspy
-openai_lm = dspy.LM('openai/gpt-4o-mini', api_key=os.getenv("OPENAI_API_KEY"), max_tokens=4000)
+from llm_cache import CachedLM, cached_chat_completion
+from http_transport import http_transport
+# dspy LMs, the embedder and the openai module all go through the shared connection pool
+http_transport.install()
+openai_lm = CachedLM('openai/gpt-4o-mini', api_key=os.getenv("OPENAI_API_KEY"), max_tokens=4000)
     
 dspy.configure(lm=openai_lm)
 
 empathy_responder = EmpatheticResponder()
 
-client = openai.OpenAI()
+client = http_transport.openai_client()
 
 __p_location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -44,27 +47,14 @@ whatsapp_token = os.environ.get("WHATSAPP_TOKEN")
 # Verify Token defined when configuring the webhook
 verify_token = os.environ.get("VERIFY_TOKEN")
 
-# Message log dictionary to enable conversation over multiple messages
-if not os.path.exists("message_logs.json"):
-    json.dump({}, open("message_logs.json", "w+"))
-message_log_dict = json.load(open("message_logs.json"))
-
-# Session logs
-if not os.path.exists("session_logs.json"):
-    json.dump({}, open("session_logs.json", "w+"))
-session_log_dict = json.load(open("session_logs.json"))
-
-# User JSON body template
-if not os.path.exists("user_templates.json"):
-    json.dump({}, open("user_templates.json", "w+"))
-user_template_dict = json.load(open("user_templates.json"))
-
-# Stress relief dict
-if not os.path.exists("stress_relief_logs.json"):
-    json.dump({}, open("stress_relief_logs.json", "w+"))
-stress_relief_dict = json.load(open("stress_relief_logs.json"))
-
-user_job_dict = {}
+# Message logs, sessions, request templates, stress relief state and ping jobs of every user
+# The old JSON state files are imported the first time the database is created
+state_store = StateStore()
+# In-process replacement for the `at` jobs that used to run notifier.py
+job_queue.register("summarize", notifier.summarize)
+job_queue.register("ping", notifier.ping)
+# Jobs left pending by an earlier run are scheduled again now, not only when the next job is added
+job_queue.start()
 
 
 # language for speech to text recoginition
@@ -83,7 +73,7 @@ def get_media_url(media_id):
         "Authorization": f"Bearer {whatsapp_token}",
     }
     url = f"https://graph.facebook.com/v16.0/{media_id}/"
-    response = requests.get(url, headers=headers)
+    response = http_transport.session.get(url, headers=headers)
     print(f"media id response: {response.json()}")
     return response.json()["url"]
 
@@ -93,7 +83,7 @@ def download_media_file(media_url):
     headers = {
         "Authorization": f"Bearer {whatsapp_token}",
     }
-    response = requests.get(media_url, headers=headers)
+    response = http_transport.session.get(media_url, headers=headers)
     print(f"first 10 digits of the media file: {response.content[:10]}")
     return response.content
 
@@ -153,9 +143,8 @@ def send_checkin_template(body):
             "components": []
         }
     }
-    user_template_dict.update({from_number: body})
-    json.dump(user_template_dict, open("user_templates.json", "w+"))
-    response = requests.post(url, json=data, headers=headers)
+    state_store.set_template(from_number, body)
+    response = http_transport.session.post(url, json=data, headers=headers)
     print(f"whatsapp message response: {response.json()}")
     response.raise_for_status()
 
@@ -176,48 +165,44 @@ def send_whatsapp_message(body, message):
         "type": "text",
         "text": {"body": message},
     }
-    user_template_dict.update({from_number: body})
-    json.dump(user_template_dict, open("user_templates.json", "w+"))
-    response = requests.post(url, json=data, headers=headers)
+    state_store.set_template(from_number, body)
+    response = http_transport.session.post(url, json=data, headers=headers)
     print(f"whatsapp message response: {response.json()}")
     response.raise_for_status()
 
 
 # create a message log for each phone number and return the current message log
 def update_message_log(message, phone_number, role):
-    if phone_number not in message_log_dict:
+    with state_store.transaction():
+        _update_message_log(message, phone_number, role)
+    return state_store.get_messages(phone_number)
+
+
+def _update_message_log(message, phone_number, role):
+    if not state_store.has_messages(phone_number):
         initial_log = {
             "role": "system",
             "content": INITIAL_PROMPT,
         }
-        message_log_dict[phone_number] = {"current_session": [initial_log]}
-    if phone_number not in session_log_dict:
-        session_log_dict[phone_number] = {
-            "current_session": 1,
-            "session_summaries": []
-        }
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
-    if phone_number not in user_job_dict:
-        user_job_dict.update({
-            phone_number: -1
-        })
-        json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+        state_store.append_message(phone_number, initial_log)
+    if state_store.get_session(phone_number) is None:
+        state_store.create_session(phone_number)
+    if state_store.get_job(phone_number) is None:
+        state_store.set_job(phone_number, -1)
     message_log = {"role": role, "content": message}
-    message_log_dict[phone_number]["current_session"].append(message_log)
-    json.dump(message_log_dict, open("message_logs.json", "w+"))
-    return message_log_dict[phone_number]["current_session"]
+    state_store.append_message(phone_number, message_log)
 
 
 # remove last message from log if OpenAI request fails
 def remove_last_message_from_log(phone_number):
-    message_log_dict[phone_number]["current_session"].pop()
+    state_store.pop_last_message(phone_number)
 
 
 # make request to OpenAI
 def make_openai_request(message, from_number):
     try:
         message_log = update_message_log(message, from_number, "user")
-        response = client.chat.completions.create(
+        response = cached_chat_completion(client,
             model="gpt-4o",
             messages=message_log,
             temperature=1.0,
@@ -260,40 +245,40 @@ def make_stress_relief_response(message, from_number):
 
 # Handle the specific case of pinging user
 def create_ping(from_number):
-    ping_msg = PING_PROMPT.replace("NUM_SESSIONS", str(session_log_dict[from_number]["current_session"]))
-    if session_log_dict[from_number]["current_session"] > 1:
+    session_log = state_store.get_session(from_number)
+    ping_msg = PING_PROMPT.replace("NUM_SESSIONS", str(session_log["current_session"]))
+    if session_log["current_session"] > 1:
         ping_msg = ping_msg.replace("SESSION_SINGULAR_PLURAL", "sessions")
     else:
         ping_msg = ping_msg.replace("SESSION_SINGULAR_PLURAL", "session")
-    ping_msg = ping_msg.replace("SESSION_SUMMARY", session_log_dict[from_number]["session_summaries"][-1])
+    ping_msg = ping_msg.replace("SESSION_SUMMARY", session_log["session_summaries"][-1])
     try:
-        response = client.chat.completions.create(
+        response = cached_chat_completion(client,
             model="gpt-4o",
             messages=[{"role": "system", "content": ping_msg}],
             temperature=1.0,
         )
         response_message = response.choices[0].message.content
         print(f"openai response: {response_message}")
-        update_message_log(MAINTENANCE_PROMPT.replace("SESSION_SUMMARY", session_log_dict[from_number]["session_summaries"][-1]), from_number, "system")
-        update_message_log(response_message, from_number, "assistant")
-        session_log_dict[from_number]["current_session"] += 1
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
+        with state_store.transaction():
+            update_message_log(MAINTENANCE_PROMPT.replace("SESSION_SUMMARY", session_log["session_summaries"][-1]), from_number, "system")
+            update_message_log(response_message, from_number, "assistant")
+            state_store.increment_session(from_number)
     except Exception as e:
         print(f"openai error: {e}")
         response_message = "Sorry, the OpenAI API is currently overloaded or offline. Please try again later."
         remove_last_message_from_log(from_number)
-    # Turn the stress relief state to false
-    if from_number in stress_relief_dict:
-        stress_relief_dict[from_number] = False
-        json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
-    # Create another ping in 15 minutes if the user has not responded
-    curr_time = datetime.datetime.now()
-    if args.short:
-        user_job_dict.update({from_number: (curr_time + datetime.timedelta(minutes=15)).timestamp()})
-    else:
-        if user_job_dict[from_number] == -1:
-            user_job_dict.update({from_number: (curr_time + datetime.timedelta(hours=48)).timestamp()})
-    json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+    with state_store.transaction():
+        # Turn the stress relief state to false
+        if state_store.has_stress_relief(from_number):
+            state_store.set_stress_relief(from_number, False)
+        # Create another ping in 15 minutes if the user has not responded
+        curr_time = datetime.datetime.now()
+        if args.short:
+            state_store.set_job(from_number, (curr_time + datetime.timedelta(minutes=15)).timestamp())
+        else:
+            if state_store.get_job(from_number) == -1:
+                state_store.set_job(from_number, (curr_time + datetime.timedelta(hours=48)).timestamp())
     return response_message
 
 
@@ -317,37 +302,35 @@ def handle_whatsapp_message(body):
         send_whatsapp_message(body, response)
         return
     print("PASS 1")
-    if stress_relief_dict.get(message["from"], False):
+    session_log = state_store.get_session(message["from"])
+    if state_store.get_stress_relief(message["from"]):
         response = make_stress_relief_response(message_body, message["from"])
-    elif "EMPATHY" in message_body or args.empathy or (message["from"] in session_log_dict and session_log_dict[message["from"]]["current_session"] > 1):
+    elif "EMPATHY" in message_body or args.empathy or (session_log is not None and session_log["current_session"] > 1):
         message_body = message_body.replace("EMPATHY", "")
         response = make_empathetic_response(message_body, message["from"])
     else:
         response = make_openai_request(message_body, message["from"])
     print("PASS 2")
-    if "FINISHED" in response and message["from"] in stress_relief_dict:
+    if "FINISHED" in response and state_store.has_stress_relief(message["from"]):
         # Go into stress relief workflow
-        stress_relief_dict[message["from"]] = True
-        json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+        state_store.set_stress_relief(message["from"], True)
         
     send_whatsapp_message(body, response)
     # Set up scheduling
-    # notifier_script_path = os.path.join(__p_location__, "notifier.py")
     # msg_from = message["from"]
     curr_time = datetime.datetime.now()
     if args.short:
         # if user_job_dict[message["from"]] != (-1, -1):
-        #     cancel_job(user_job_dict[message["from"]][0])
-        #     cancel_job(user_job_dict[message["from"]][1])
-        # new_job_num_ping = schedule_job(f"python3 {notifier_script_path} --ping --user_number={msg_from}", "15 minutes")
-        # new_job_num_sum = schedule_job(f"python3 {notifier_script_path} --summarize --user_number={msg_from}", "10 minutes")
-        user_job_dict.update({message["from"]: (curr_time + datetime.timedelta(minutes=15)).timestamp()})
+        #     job_queue.cancel(user_job_dict[message["from"]][0])
+        #     job_queue.cancel(user_job_dict[message["from"]][1])
+        # new_job_num_ping = job_queue.schedule("ping", {"user_number": msg_from}, delay=15 * 60)
+        # new_job_num_sum = job_queue.schedule("summarize", {"user_number": msg_from}, delay=10 * 60)
+        state_store.set_job(message["from"], (curr_time + datetime.timedelta(minutes=15)).timestamp())
     else:
-        if user_job_dict[message["from"]] == -1:
-            # new_job_num_ping = schedule_job(f"python3 {notifier_script_path} --ping --user_number={msg_from}", "48 hours")
-            # new_job_num_sum = schedule_job(f"python3 {notifier_script_path} --summarize --user_number={msg_from}", "47 hours")
-            user_job_dict.update({message["from"]: (curr_time + datetime.timedelta(hours=48)).timestamp()})
-    json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+        if state_store.get_job(message["from"]) == -1:
+            # new_job_num_ping = job_queue.schedule("ping", {"user_number": msg_from}, delay=48 * 3600)
+            # new_job_num_sum = job_queue.schedule("summarize", {"user_number": msg_from}, delay=47 * 3600)
+            state_store.set_job(message["from"], (curr_time + datetime.timedelta(hours=48)).timestamp())
 
 
 
@@ -445,9 +428,7 @@ def webhook():
 # Route to reset message log
 @app.route("/reset", methods=["GET"])
 def reset():
-    global message_log_dict
-    message_log_dict = {}
-    json.dump({}, open("message_logs.json", "w+"))
+    state_store.clear_messages()
     return "Message log resetted!"
 
 
@@ -455,12 +436,11 @@ def reset():
 def summarize_session():
     phone_number = request.args.get("phone_number")
     print("Obtained phone number", phone_number)
-    current_session_messages = []
-    
-    if len(message_log_dict[phone_number]["current_session"]):
-        current_session_messages = copy.copy(message_log_dict[phone_number]["current_session"])
+    current_session_messages = state_store.get_messages(phone_number)
+    if len(current_session_messages):
+        session_log = state_store.get_session(phone_number)
         formatted_convo = format_conversation(current_session_messages)
-        response = openai.chat.completions.create(
+        response = cached_chat_completion(client,
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": SUMMARY_PROMPT + "\n\n" + formatted_convo}],
                 temperature=1.0,
@@ -468,26 +448,22 @@ def summarize_session():
         response_message = response.choices[0].message.content
         print(response_message)
         # Find whether stress is a signficant barrier
-        if session_log_dict[phone_number]["current_session"] == 1:
-            stress_judge = openai.chat.completions.create(
+        stress_barrier = False
+        if session_log["current_session"] == 1:
+            stress_judge = cached_chat_completion(client,
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": "Does the user think stress is a significant barrier for them in terms of increasing physical activity? Answer with yes or no." + "\n\n" + formatted_convo}],
                 temperature=0,
             )
-            if stress_judge.choices[0].message.content.lower().startswith("yes"):
-                stress_relief_dict.update({
-                    phone_number: False
-                })
-        if phone_number in session_log_dict:
-            session_log_dict[phone_number]["session_summaries"].append(response_message)
-        session_num = f"session_" + str(session_log_dict[phone_number]["current_session"])
-        message_log_dict[phone_number].update({
-            session_num: current_session_messages
-        })
-        message_log_dict[phone_number]["current_session"] = []
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
-        json.dump(message_log_dict, open("message_logs.json", "w+"))
-    user_job_dict.update({phone_number: (-1, -1)})
+            stress_barrier = stress_judge.choices[0].message.content.lower().startswith("yes")
+        session_num = f"session_" + str(session_log["current_session"])
+        # Record the summary and archived session together
+        with state_store.transaction():
+            state_store.add_session_summary(phone_number, response_message)
+            if stress_barrier:
+                state_store.set_stress_relief(phone_number, False)
+            state_store.archive_session(phone_number, session_num)
+    state_store.set_job(phone_number, SUMMARIZED_JOB)
     return f"Session summarized for {phone_number}!"
     
 
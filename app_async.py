@@ -0,0 +1,365 @@
+import asyncio
+import datetime
+import os
+import threading
+import time
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import app_official
+from app_official import (state_store, stress_relief_states, rolling_summarizer, ping_precomputer, assignment_dict,
+                          update_message_log, remove_last_message_from_log, compute_emp_condition, split_message_by_period,
+                          validate_payload, coalesce_messages, FINAL_GOOGLE_FORM_MESSAGE, TWILIO_NUMBER,
+                          TWILIO_SMS_NUMBER, TWILIO_MESSAGING_SERVICE_SID, TWILIO_SID, TWILIO_TOKEN,
+                          TWILIO_API_BASE_URL, verify_token)
+from lazy_startup import LAZY_STARTUP, warm_up
+from llm_cache import cached_chat_completion_async, llm_cache
+from http_transport import http_transport
+
+# asyncio version of the app_official.py webhook, on aiohttp:
+#   python app_async.py --port 55002
+# A chat turn awaits the OpenAI and Twilio calls on async clients instead of holding a thread
+# while they are in flight, so one process can keep hundreds of conversations going on a
+# handful of threads. The parts built on dspy (empathetic responses, stress relief) and the
+# check-in ping (summary, long-term memory) have no async API; they run on a small thread
+# pool of SYNC_WORKERS threads. State is kept in the same state store as app_official.
+#
+# The turns of a user are ordered by the reply queue of this process only: they do not take
+# the cross-process user lock (user_lock.py), which cannot be held across awaits. So
+# app_async must be the only process answering the users of its state store; do not run it
+# next to app_official or a second app_async on the same store.
+
+# Turns being answered at once, and turns waiting for their user's previous turn
+MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", 500))
+REPLY_QUEUE_DEPTH = int(os.environ.get("ASYNC_QUEUE_DEPTH", 2000))
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", 8))
+
+sync_executor = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="async-app-sync")
+
+# Created on the event loop at startup (see on_startup)
+async_client = None
+twilio_async = None
+
+
+class AsyncReplyQueue:
+    """
+    asyncio counterpart of ReplyWorkerPool: payloads of one key run one at a time in arrival
+    order, payloads of different keys run concurrently, up to `max_inflight` at once.
+    A key's payloads are held until it has been quiet for `coalesce_window` seconds (at most
+    `coalesce_max_wait` after the oldest one) and then passed through `merge` together.
+    `submit` refuses payloads once `max_queue` are waiting.
+    """
+
+    def __init__(self, handler, max_inflight: int = 500, max_queue: int = 2000, coalesce_window: float = 0.0,
+                 coalesce_max_wait: float = 10.0, merge=None):
+        self.handler = handler
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_wait = coalesce_max_wait
+        self.merge = merge if merge is not None else (lambda payloads: payloads)
+        self._slots = asyncio.Semaphore(max_inflight)
+        # key -> list of (enqueued_at, payload) not taken yet; key -> task draining it
+        self._mailboxes = {}
+        self._tasks = {}
+        self._pending = 0
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "coalesced": 0,
+                       "in_flight": 0, "total_wait_seconds": 0.0, "total_run_seconds": 0.0}
+
+    def submit(self, key, payload: dict) -> bool:
+        if self._pending >= self.max_queue:
+            self._stats["rejected"] += 1
+            return False
+        self._mailboxes.setdefault(key, []).append((time.monotonic(), payload))
+        self._pending += 1
+        self._stats["submitted"] += 1
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._drain(key))
+        return True
+
+    async def _quiet(self, key):
+        # Wait until the key's mailbox may be taken
+        while self.coalesce_window > 0:
+            mailbox = self._mailboxes[key]
+            due = min(mailbox[-1][0] + self.coalesce_window, mailbox[0][0] + self.coalesce_max_wait)
+            if time.monotonic() >= due:
+                return
+            await asyncio.sleep(due - time.monotonic())
+
+    async def _drain(self, key):
+        try:
+            while self._mailboxes.get(key):
+                await self._quiet(key)
+                batch = self._mailboxes.pop(key)
+                self._pending -= len(batch)
+                payloads = self.merge([payload for _, payload in batch])
+                self._stats["coalesced"] += len(batch) - len(payloads)
+                for payload in payloads:
+                    async with self._slots:
+                        started = time.monotonic()
+                        self._stats["total_wait_seconds"] += started - batch[0][0]
+                        self._stats["in_flight"] += 1
+                        try:
+                            await self.handler(payload)
+                            self._stats["completed"] += 1
+                        except Exception as e:
+                            print(f"reply error: {e}")
+                            traceback.print_exc()
+                            self._stats["failed"] += 1
+                        finally:
+                            self._stats["in_flight"] -= 1
+                            self._stats["total_run_seconds"] += time.monotonic() - started
+        finally:
+            self._tasks.pop(key, None)
+
+    def metrics(self) -> dict:
+        stats = dict(self._stats)
+        done = stats["completed"] + stats["failed"]
+        stats["queue_depth"] = self._pending
+        stats["users_pending"] = len(self._tasks)
+        stats["avg_wait_seconds"] = stats.pop("total_wait_seconds") / done if done else 0.0
+        stats["avg_run_seconds"] = stats.pop("total_run_seconds") / done if done else 0.0
+        return stats
+
+
+# Run a blocking part of the pipeline on the sync pool; the reply queue keeps the user's turns apart
+async def run_sync(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(sync_executor, fn, *args)
+
+
+# Run a state store call on the loop's default executor. Each is a short SQLite query, but it can
+# wait up to the busy timeout for another writer, which must not stall the event loop
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+# send the response as a WhatsApp message back to the user
+async def send_whatsapp_message(body, message):
+    if "||" in message:
+        await run_db(update_message_log, message.split("||")[0], body["From"], "assistant")
+        message = message.replace("||", "")
+    else:
+        await run_db(update_message_log, message, body["From"], "assistant")
+    if twilio_async is None:
+        print("ASSISTANT >>", message)
+        return
+    # Twilio cannot send messages over 1600 characters
+    for chunk in split_message_by_period(message) if len(message) > 1600 else [message]:
+        await twilio_async.messages.create_async(to=body["From"], from_=TWILIO_NUMBER, body=chunk)
+
+
+# make request to OpenAI
+async def make_openai_request(message, from_number, non_empathetic=False):
+    try:
+        message_log = await run_db(update_message_log, message, from_number, "user", non_empathetic)
+        if non_empathetic:
+            response = await cached_chat_completion_async(async_client, model="gpt-4o",
+                messages=message_log + [{"role": "system", "content": "Do not be empathetic when responding."}],
+                temperature=0.5)
+        else:
+            response = await cached_chat_completion_async(async_client, model="gpt-4o", messages=message_log,
+                                                          temperature=1.0)
+        response_message = response.choices[0].message.content
+    except Exception as e:
+        print(f"openai error: {e}")
+        response_message = "Sorry, the OpenAI API is currently overloaded or offline. Please try again later."
+        await run_db(remove_last_message_from_log, from_number)
+    return response_message
+
+
+# handle WhatsApp messages of different type; the same flow as app_official.handle_whatsapp_message
+async def handle_whatsapp_message(body):
+    if body["MessageType"] == "text":
+        message_body = body["Body"]
+        if "EXP_ID" in message_body:
+            exp_id = message_body.replace("EXP_ID", "").strip()
+            if exp_id in assignment_dict:
+                exp_condition = assignment_dict[exp_id]
+            else:
+                await send_whatsapp_message(body, "Sorry, your experiment ID is not in our list of participants. Please double-check and resend your message. Thank you!!")
+                return
+            enroll_time = datetime.datetime.now().timestamp()
+            # 0 means starting with non-empathetic, 1 means starting with empathetic
+            await run_db(state_store.set_experiment, body["From"], exp_id, exp_condition, enroll_time)
+            message_body = "Hi"
+        else:
+            exp_id, exp_condition, enroll_time = await run_db(state_store.get_experiment, body["From"])
+        # Archived sessions plus the current one
+        session_id = "S" + str(await run_db(state_store.count_archived_sessions, body["From"]) + 1)
+        fin_google_message = FINAL_GOOGLE_FORM_MESSAGE.format(USER_ID=exp_id, SESSION_ID=session_id)
+        if "USER_PING" in message_body:
+            await twilio_async.messages.create_async(content_sid="HXf1ecfec77c71835b8522045749a825d5",
+                                                     to=body["From"], from_=TWILIO_NUMBER,
+                                                     messaging_service_sid=TWILIO_MESSAGING_SERVICE_SID)
+            return
+    elif body["MessageType"] == "button":
+        response = await run_sync(app_official.create_ping, body["From"])
+        await send_whatsapp_message(body, response)
+        return
+    emp_condition = compute_emp_condition(exp_condition, enroll_time)
+    session_log = await run_db(state_store.get_session, body["From"])
+    if await run_db(stress_relief_states.active, body["From"]):
+        response = await run_sync(app_official.make_stress_relief_response, message_body, body["From"],
+                                  emp_condition == 0)
+    elif session_log is not None and session_log["current_session"] > 1:
+        if emp_condition == 0:
+            response = await make_openai_request(message_body, body["From"], non_empathetic=True)
+        elif emp_condition == 1:
+            response = await make_openai_request(message_body, body["From"])
+        elif emp_condition == 2:
+            response = await run_sync(app_official.make_empathetic_response, message_body, body["From"])
+        if "FINISHED" in response or ("scale of 0 - 5" in response and "stressed" in response):
+            # Go into stress relief workflow
+            await run_db(stress_relief_states.start, body["From"])
+    else:
+        response = await make_openai_request(message_body, body["From"], non_empathetic=(emp_condition == 0))
+
+    if "FINAL_MESSAGE" in response:
+        response = response.replace("\n\nFINAL_MESSAGE", "||\n\n" + fin_google_message)
+        response = response.replace("FINAL_MESSAGE", "||" + fin_google_message)
+
+    if "FINISHED" in response:
+        response = response.replace("FINISHED.", "").replace("FINISHED", "")
+        if len(response) == 0:
+            response = "Thank you for your chat today!\n\n" + fin_google_message
+
+    await send_whatsapp_message(body, response)
+    # Set up scheduling
+    if await run_db(state_store.get_job, body["From"]) == -1 and twilio_async is not None:
+        curr_time = datetime.datetime.now(datetime.timezone.utc)
+        if app_official.SHORT_SCHEDULE:
+            schedule_time = curr_time + datetime.timedelta(minutes=12)
+        else:
+            schedule_time = curr_time + datetime.timedelta(hours=48)
+        message = await twilio_async.messages.create_async(
+            content_sid="HX031bd602333a47aac19947f0f6817916",
+            to=body["From"].replace("whatsapp:", ""),
+            from_=TWILIO_SMS_NUMBER,
+            messaging_service_sid=TWILIO_MESSAGING_SERVICE_SID,
+            send_at=schedule_time,
+            schedule_type="fixed",
+        )
+        print("SCHEDULED MESSAGE:", message)
+        await run_db(state_store.set_job, body["From"], schedule_time.timestamp())
+
+
+# run the reply pipeline for a queued message
+async def process_queued_message(body):
+    # A failed turn is logged and counted by the reply queue
+    try:
+        await handle_whatsapp_message(body)
+    finally:
+        try:
+            await run_db(rolling_summarizer.observe, body["From"])
+        except Exception as e:
+            print(f"rolling summary error: {e}")
+        # A button press starts a new session, which gets its own ping once it goes idle
+        if body["MessageType"] != "button":
+            ping_precomputer.touch(body["From"])
+
+
+reply_queue = None
+
+
+async def home(request):
+    return web.Response(text="WhatsApp OpenAI Webhook is listening!")
+
+
+# Required webhook verifictaion for WhatsApp
+def verify(request):
+    mode = request.query.get("hub.mode")
+    token = request.query.get("hub.verify_token")
+    challenge = request.query.get("hub.challenge")
+    if not mode or not token:
+        return web.json_response({"status": "error", "message": "Missing parameters"}, status=400)
+    if mode == "subscribe" and token == verify_token:
+        print("WEBHOOK_VERIFIED")
+        return web.Response(text=challenge)
+    print("VERIFICATION_FAILED")
+    return web.json_response({"status": "error", "message": "Verification failed"}, status=403)
+
+
+# Accepts POST and GET requests at /webhook endpoint
+async def webhook(request):
+    if request.method == "GET":
+        return verify(request)
+    body = dict(await request.post())
+    if body.get("SmsStatus") != "received":
+        return web.json_response({"status": "error", "message": "Not a WhatsApp API event"}, status=404)
+    if not validate_payload(body):
+        return web.json_response({"status": "error", "message": "Unsupported WhatsApp message"}, status=400)
+    # Answer Twilio right away; the reply is generated and sent in the background
+    if not reply_queue.submit(body["From"], body):
+        return web.json_response({"status": "error", "message": "Reply queue is full"}, status=503)
+    return web.json_response({"status": "ok"})
+
+
+async def metrics(request):
+    stats = reply_queue.metrics()
+    stats["pid"] = os.getpid()
+    stats["threads"] = threading.active_count()
+    stats["llm_cache"] = await run_db(llm_cache.stats)
+    stats["ping_precompute"] = ping_precomputer.stats()
+    stats["stress_relief"] = stress_relief_states.stats()
+    stats["http"] = http_transport.stats()
+    return web.json_response(stats)
+
+
+# Route to reset message log
+async def reset(request):
+    await run_db(state_store.clear_messages)
+    return web.Response(text="Message log resetted!")
+
+
+async def on_startup(app):
+    global async_client, twilio_async
+    from twilio.http.async_http_client import AsyncTwilioHttpClient
+    from twilio.rest import Client
+    # Every turn in flight may be waiting on OpenAI at the same time
+    async_client = http_transport.async_openai_client(max_connections=reply_queue.max_inflight)
+    twilio_async = Client(TWILIO_SID, TWILIO_TOKEN, http_client=AsyncTwilioHttpClient(
+        pool_connections=True, timeout=http_transport.timeout.read))
+    if TWILIO_API_BASE_URL:
+        twilio_async.api.base_url = TWILIO_API_BASE_URL
+
+
+async def on_cleanup(app):
+    await async_client.close()
+    await twilio_async.http_client.close()
+
+
+def make_app(max_inflight=MAX_INFLIGHT, max_queue=REPLY_QUEUE_DEPTH, coalesce_window=app_official.COALESCE_WINDOW,
+             coalesce_max_wait=app_official.COALESCE_MAX_WAIT):
+    global reply_queue
+    reply_queue = AsyncReplyQueue(process_queued_message, max_inflight=max_inflight, max_queue=max_queue,
+                                  coalesce_window=coalesce_window, coalesce_max_wait=coalesce_max_wait,
+                                  merge=coalesce_messages)
+    app = web.Application()
+    app.add_routes([web.get("/", home), web.get("/webhook", webhook), web.post("/webhook", webhook),
+                    web.get("/metrics", metrics), web.get("/reset", reset)])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=55002)
+    parser.add_argument("--short", action="store_true")
+    parser.add_argument("--max_inflight", type=int, default=MAX_INFLIGHT)
+    parser.add_argument("--queue_depth", type=int, default=REPLY_QUEUE_DEPTH)
+    parser.add_argument("--coalesce_window", type=float, default=app_official.COALESCE_WINDOW)
+    parser.add_argument("--coalesce_max_wait", type=float, default=app_official.COALESCE_MAX_WAIT)
+    parser.add_argument("--warm_up", action="store_true",
+                        help="With LAZY_STARTUP=1, initialize the deferred subsystems in the background after startup")
+    args = parser.parse_args()
+
+    if args.short:
+        app_official.SHORT_SCHEDULE = True
+    if LAZY_STARTUP and args.warm_up:
+        warm_up()
+    web.run_app(make_app(args.max_inflight, args.queue_depth, args.coalesce_window, args.coalesce_max_wait),
+                port=args.port)
@@ -12,6 +12,8 @@ if __name__ == "__main__":
     parser.add_argument("--short", action="store_true")
     args = parser.parse_args()
     app_official.args = args
+    if args.short:
+        app_official.SHORT_SCHEDULE = True
 
     BODY_TEMPLATE = {
         "From": "007",
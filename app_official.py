@@ -1,18 +1,23 @@
 import io
 import os
 
-import openai
-import pydub
 import requests
-import soundfile as sf
-import speech_recognition as sr
 from flask import Flask, jsonify, request
 import json
 import copy
+from state_store import StateStore, SUMMARIZED_JOB
+from reply_worker import ReplyWorkerPool
+from rolling_summarizer import RollingSummarizer, count_turns
+from ping_precomputer import PingPrecomputer
+from user_lock import user_locks, summary_locks
+from stress_relief_state import StressReliefStates, AWAITING_RATING, AWAITING_FEEDBACK
+from lazy_startup import LAZY_STARTUP, lazy, lazy_module, ensure, is_initialized, init_times, warm_up
 from argparse import ArgumentParser
 import dotenv
 import datetime
 import uuid
+import threading
+import time
 
 import random
 random.seed(42)
@@ -27,16 +32,43 @@ app = Flask(__name__)
 # print(os.getenv("OPENAI_API_KEY"))
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
-from empathy_framework import EmpatheticResponder
+from llm_cache import cached_chat_completion, llm_cache
+from http_transport import http_transport
+
+# With LAZY_STARTUP=1 the subsystems below are only set up when first used (see lazy_startup.py);
+# otherwise they are all built here, as before
+
+
+# dspy LMs, the embedder and the openai module all go through the shared connection pool
+def init_llm():
+    import dspy
+    from llm_cache import CachedLM
+    http_transport.install()
+    openai_lm = CachedLM('openai/gpt-4o', api_key=os.getenv("OPENAI_API_KEY"), max_tokens=4000)
+    dspy.configure(lm=openai_lm)
+    return openai_lm
+
+openai_lm = lazy("llm", init_llm)
 
-import dspy
-openai_lm = dspy.LM('openai/gpt-4o', api_key=os.getenv("OPENAI_API_KEY"), max_tokens=4000)
-    
-dspy.configure(lm=openai_lm)
 
-empathy_responder = EmpatheticResponder()
+def init_empathy_responder():
+    from empathy_framework import EmpatheticResponder
+    ensure(openai_lm)
+    # EO_MODE=batched classifies all segments of a message in a single LM call
+    # RESPONSE_MODE=single streams one generation instead of draft + rewrite;
+    # RESPONSE_MODE=speculative sends the draft if the rewrite takes longer than REWRITE_BUDGET seconds
+    return EmpatheticResponder(eo_mode=os.environ.get("EO_MODE", "per_segment"),
+                               response_mode=os.environ.get("RESPONSE_MODE", "rewrite"),
+                               rewrite_budget=float(os.environ.get("REWRITE_BUDGET", 3.0)))
 
-client = openai.OpenAI()
+empathy_responder = lazy("empathy_responder", init_empathy_responder)
+
+client = lazy("openai_client", http_transport.openai_client)
+
+# The audio stack is not used by this app; kept importable for the voice message handlers
+pydub = lazy_module("pydub")
+sf = lazy_module("soundfile")
+sr = lazy_module("speech_recognition")
 
 __p_location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -47,44 +79,46 @@ whatsapp_token = os.environ.get("WHATSAPP_TOKEN")
 # Verify Token defined when configuring the webhook
 verify_token = os.environ.get("VERIFY_TOKEN")
 
-from stress_relief import StressReliefModule
 
-stress_relief = StressReliefModule("user_profiles.json")
+# Message logs, sessions, stress relief state, ping jobs and experiment IDs of every user
+# The old JSON state files are imported the first time the database is created
+state_store = StateStore()
 
-from long_term_memory import build_faiss_index, identify_and_retrieve
+# Stress relief state of every user, kept in memory and written back every
+# STRESS_RELIEF_FLUSH_INTERVAL seconds; STRESS_RELIEF_SHARED=1 writes every transition
+# through instead, for processes sharing the store (set by gunicorn_conf.py)
+stress_relief_states = StressReliefStates(state_store,
+                                          flush_interval=float(os.environ.get("STRESS_RELIEF_FLUSH_INTERVAL", 1.0)),
+                                          shared=os.environ.get("STRESS_RELIEF_SHARED", "0") == "1")
 
-# Message log dictionary to enable conversation over multiple messages
-if not os.path.exists("message_logs.json"):
-    json.dump({}, open("message_logs.json", "w+"))
-message_log_dict = json.load(open("message_logs.json"))
 
-# Session logs
-if not os.path.exists("session_logs.json"):
-    json.dump({}, open("session_logs.json", "w+"))
-session_log_dict = json.load(open("session_logs.json"))
+def init_stress_relief():
+    from stress_relief import StressReliefModule
+    ensure(openai_lm)
+    # Profiles live in the state store, so every worker process sees the latest one
+    return StressReliefModule("user_profiles.json", profile_store=state_store)
 
-# User JSON body template
-# if not os.path.exists("user_templates.json"):
-#     json.dump({}, open("user_templates.json", "w+"))
-# user_template_dict = json.load(open("user_templates.json"))
+stress_relief = lazy("stress_relief", init_stress_relief)
 
-# Stress relief dict
-if not os.path.exists("stress_relief_logs.json"):
-    json.dump({}, open("stress_relief_logs.json", "w+"))
-stress_relief_dict = json.load(open("stress_relief_logs.json"))
+# FAISS indexes, the vector store and the embedder
+long_term_memory = lazy_module("long_term_memory", before=lambda: ensure(openai_lm))
 
 # User experiment condition assignment
 assignment_dict = json.load(open("assignment_exps.json"))
 
-user_job_dict = {}
-
 all_scheduled_messages = []
 
+# SHORT_SCHEDULE=1 (or --short) runs the study on a compressed clock: a "week" is 12 minutes
+# and the next check-in is 12 minutes away instead of 48 hours
+SHORT_SCHEDULE = os.environ.get("SHORT_SCHEDULE", "0") == "1"
 
-# EXP ID dict
-if not os.path.exists("exp_id_map.json"):
-    json.dump({}, open("exp_id_map.json", "w+"))
-exp_id_map = json.load(open("exp_id_map.json"))
+# Incoming messages are answered by background workers; the webhook only enqueues them
+REPLY_WORKERS = int(os.environ.get("REPLY_WORKERS", 4))
+REPLY_QUEUE_DEPTH = int(os.environ.get("REPLY_QUEUE_DEPTH", 100))
+# Messages a user sends within this many seconds of each other are answered as one turn.
+# Off by default: a window delays every reply by that long, even when no second message comes
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 0.0))
+COALESCE_MAX_WAIT = float(os.environ.get("COALESCE_MAX_WAIT", 10.0))
 
 # language for speech to text recoginition
 # TODO: detect this automatically based on the user's language
@@ -92,10 +126,8 @@ LANGUGAGE = "en-US"
 
 INITIAL_PROMPT = open("initial_prompt.txt").read()
 INITIAL_PROMPT_NE = open("initial_prompt_ne.txt").read()
-SUMMARY_PROMPT = open("summarization_prompt.txt").read()
 PING_PROMPT = open("ping_prompt.txt").read()
 MAINTENANCE_PROMPT = open("maintenance_prompt.txt").read()
-ACTION_PLAN_PROMPT = open("action_plan_prompt.txt").read()
 
 TWILIO_NUMBER = "whatsapp:+18774467072"
 TWILIO_SID = os.environ.get("TWILIO_ACCOUNT_SID")
@@ -106,9 +138,21 @@ TWILIO_SMS_NUMBER = "+18774467072"
 
 FINAL_GOOGLE_FORM_MESSAGE = """Please fill out this Google form:\nhttps://docs.google.com/forms/d/e/1FAIpQLSdCsJa-EtOlVczRckdA9jmNX4id2C68bfuTnBEt5IGnOqSXYw/viewform?usp=pp_url&entry.1959604237={USER_ID}&entry.78496601={SESSION_ID}"""
 
-from twilio.rest import Client
+from twilio_bulk import BulkMessageScheduler, TwilioTransport
+
+
+# TWILIO_API_BASE_URL points the client at another host, e.g. the stub of load_test_async.py
+TWILIO_API_BASE_URL = os.environ.get("TWILIO_API_BASE_URL")
 
-twilio_client = Client(TWILIO_SID, TWILIO_TOKEN)
+
+def init_twilio_client():
+    from twilio.rest import Client
+    twilio_client = Client(TWILIO_SID, TWILIO_TOKEN, http_client=http_transport.twilio_http_client())
+    if TWILIO_API_BASE_URL:
+        twilio_client.api.base_url = TWILIO_API_BASE_URL
+    return twilio_client
+
+twilio_client = lazy("twilio_client", init_twilio_client)
 
 def split_message_by_period(text, max_length=1600):
     """
@@ -140,7 +184,7 @@ def split_message_by_period(text, max_length=1600):
 
 
 def compute_emp_condition(exp_condition, enroll_time):
-    if args.short:
+    if SHORT_SCHEDULE:
         num_weeks = int((datetime.datetime.now().timestamp() - enroll_time) // (12 * 60))
     else:
         num_weeks = int((datetime.datetime.now().timestamp() - enroll_time) // (24 * 60 * 60 * 7))
@@ -183,7 +227,13 @@ def send_whatsapp_message(body, message):
 
 # create a message log for each phone number and return the current message log
 def update_message_log(message, phone_number, role, non_empathetic=False):
-    if phone_number not in message_log_dict:
+    with state_store.transaction():
+        _update_message_log(message, phone_number, role, non_empathetic)
+    return state_store.get_messages(phone_number)
+
+
+def _update_message_log(message, phone_number, role, non_empathetic):
+    if not state_store.has_messages(phone_number):
         if non_empathetic:
             initial_log = {
                 "role": "system",
@@ -194,27 +244,18 @@ def update_message_log(message, phone_number, role, non_empathetic=False):
                 "role": "system",
                 "content": INITIAL_PROMPT,
             }
-        message_log_dict[phone_number] = {"current_session": [initial_log]}
-    if phone_number not in session_log_dict:
-        session_log_dict[phone_number] = {
-            "current_session": 1,
-            "session_summaries": []
-        }
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
-    if phone_number not in user_job_dict:
-        user_job_dict.update({
-            phone_number: -1
-        })
-        json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+        state_store.append_message(phone_number, initial_log)
+    if state_store.get_session(phone_number) is None:
+        state_store.create_session(phone_number)
+    if state_store.get_job(phone_number) is None:
+        state_store.set_job(phone_number, -1)
     message_log = {"role": role, "content": message, "timestamp": datetime.datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}
-    message_log_dict[phone_number]["current_session"].append(message_log)
-    json.dump(message_log_dict, open("message_logs.json", "w+"))
-    return message_log_dict[phone_number]["current_session"]
+    state_store.append_message(phone_number, message_log)
 
 
 # remove last message from log if OpenAI request fails
 def remove_last_message_from_log(phone_number):
-    message_log_dict[phone_number]["current_session"].pop()
+    state_store.pop_last_message(phone_number)
 
 
 # make request to OpenAI
@@ -222,13 +263,13 @@ def make_openai_request(message, from_number, non_empathetic=False):
     try:
         message_log = update_message_log(message, from_number, "user", non_empathetic)
         if non_empathetic:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=message_log + [{"role": "system", "content": "Do not be empathetic when responding."}],
                 temperature=0.5,
             )
         else:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=message_log,
                 temperature=1.0,
@@ -250,7 +291,9 @@ def make_empathetic_response(message, from_number):
     try:
         message_log = update_message_log(message, from_number, "user")
         convo_history = copy.copy(message_log)
-        response_message = empathy_responder.respond_empathetically(user_input=message, convo_history=convo_history)[0]
+        response_message, response_info = empathy_responder.respond_empathetically(user_input=message, convo_history=convo_history, return_dict=True)
+        response_message = response_message[0]
+        print(f"empathetic response timings: {response_info['timings']}")
         if twilio_client is not None:
             print(f"empathetic response: {response_message}")
     except Exception as e:
@@ -260,21 +303,19 @@ def make_empathetic_response(message, from_number):
     return response_message
 
 def make_stress_relief_response(message, from_number, non_empathetic=False):
-    stress_relief_dict = json.load(open("stress_relief_logs.json"))
+    stress_relief_state = stress_relief_states.state(from_number)
     try:
         message_log = update_message_log(message, from_number, "user")
-        if stress_relief_dict[from_number] == 1:
+        if stress_relief_state == AWAITING_RATING:
             print("ROUND 2 STRESS RELIEF CONVERSATION")
             cont, response_message = stress_relief.process_user_msg(message, from_number, message_log, non_empathetic)
-            stress_relief_dict.update({from_number: cont})
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
-        elif stress_relief_dict[from_number] == 2:
+            stress_relief_states.advance(from_number, cont)
+        elif stress_relief_state == AWAITING_FEEDBACK:
             print("ROUND 3 STRESS RELIEF CONVERSATION")
             cont, response_message = stress_relief.process_user_feedback(message, from_number, message_log, non_empathetic)
-            stress_relief_dict.update({from_number: cont})
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+            stress_relief_states.advance(from_number, cont)
         else:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=message_log,
                 temperature=0.5,
@@ -282,65 +323,139 @@ def make_stress_relief_response(message, from_number, non_empathetic=False):
             response_message = response.choices[0].message.content
         if twilio_client is not None:
             print(f"stress relief response: {response_message}")
-        print(stress_relief_dict[from_number])
+        print(stress_relief_states.state(from_number))
     except Exception as e:
         print(f"openai error: {e}")
         response_message = "Sorry, the OpenAI API is currently overloaded or offline. Please try again later."
         remove_last_message_from_log(from_number)
     return response_message
 
-# Handle the specific case of pinging user
-def create_ping(from_number):
-    summarize_session(from_number)
-    ping_msg = PING_PROMPT.replace("NUM_SESSIONS", str(session_log_dict[from_number]["current_session"]))
-    if session_log_dict[from_number]["current_session"] > 1:
+# Empathy condition of the user at this point of the study
+def user_emp_condition(phone_number):
+    experiment = state_store.get_experiment(phone_number)
+    if experiment is not None:
+        _, exp_condition, enroll_time = experiment
+    else:
+        exp_condition = 0
+        enroll_time = datetime.datetime.now().timestamp()
+    return compute_emp_condition(exp_condition, enroll_time)
+
+
+# Generate the check-in ping that follows a session with the given summary
+def generate_ping(current_session, summary, emp_condition):
+    ping_msg = PING_PROMPT.replace("NUM_SESSIONS", str(current_session))
+    if current_session > 1:
         ping_msg = ping_msg.replace("SESSION_SINGULAR_PLURAL", "sessions")
     else:
         ping_msg = ping_msg.replace("SESSION_SINGULAR_PLURAL", "session")
-    ping_msg = ping_msg.replace("SESSION_SUMMARY", session_log_dict[from_number]["session_summaries"][-1])
-    if from_number in exp_id_map:
-        _, exp_condition, enroll_time = exp_id_map[from_number]
+    ping_msg = ping_msg.replace("SESSION_SUMMARY", summary)
+    if emp_condition == 0:
+        response = cached_chat_completion(client,
+            model="gpt-4o",
+            messages=[{"role": "system", "content": ping_msg + "\n\nDo not be empathetic. Minimize emoji usage."}],
+            temperature=0.2,
+        )
     else:
-        exp_condition = 0
-        enroll_time = datetime.datetime.now().timestamp()
-    emp_condition = compute_emp_condition(exp_condition, enroll_time)
+        response = cached_chat_completion(client,
+            model="gpt-4o",
+            messages=[{"role": "system", "content": ping_msg}],
+            temperature=0.8,
+        )
+    return response.choices[0].message.content
+
+
+# Maintenance prompt of the next session; RETRIEVAL_CONTENT is filled in once the
+# summary of the session has been added to long-term memory
+def build_maintenance_prompt(summary, action_plan, topic):
+    maintenance_p = MAINTENANCE_PROMPT.replace("SESSION_SUMMARY_1", summary)
+    maintenance_p = maintenance_p.replace("ACTION_PLAN", action_plan)
+    return maintenance_p.replace("DISCUSSION_TOPIC", topic)
+
+
+# Prepare the ping of a user whose session has gone idle (run by ping_precomputer).
+# Nothing is archived here: the summary is folded into the running summary, the bullet and
+# topic embeddings land in the embedding cache, and the ping, topic and maintenance prompt
+# are stored together with the number of messages they were made from.
+def precompute_ping(phone_number):
+    session_log = state_store.get_session(phone_number)
+    messages = state_store.get_messages(phone_number)
+    if session_log is None or count_turns(messages) == 0:
+        return
+    # With several worker processes, a later message may have been handled (and its idle
+    # timer started) by another worker
+    last_message = datetime.datetime.strptime(messages[-1]["timestamp"], "%Y/%m/%d, %H:%M:%S")
+    if (datetime.datetime.now() - last_message).total_seconds() < PING_PRECOMPUTE_IDLE - 1:
+        return
+    start = time.perf_counter()
+    rolling = rolling_summarizer.finalize(phone_number)
+    summary = rolling["summary"] or ""
+    bullets = [x for x in summary.split("\n") if len(x) > 5]
+    if bullets:
+        long_term_memory.get_embeddings(bullets)
+    emp_condition = user_emp_condition(phone_number)
+    ping = generate_ping(session_log["current_session"], summary, emp_condition)
+    topic = long_term_memory.identify_topic((session_log["session_summaries"] + [summary])[-3:])
+    long_term_memory.get_embeddings([topic])
+    maintenance_p = build_maintenance_prompt(summary, str(rolling["action_plan"]), topic)
+    state_store.set_precomputed_ping(phone_number, session_log["current_session"], rolling["messages_covered"],
+                                     emp_condition, ping, topic, maintenance_p, time.time())
+    print(f"precomputed ping for {phone_number} in {time.perf_counter() - start:.2f}s")
+
+
+# The stored ping of a user, if it was made from the conversation as it is now
+def fresh_precomputed_ping(phone_number, emp_condition):
+    ready = state_store.get_precomputed_ping(phone_number)
+    if ready is None:
+        return None
+    session_log = state_store.get_session(phone_number)
+    if (session_log is None or ready["session"] != session_log["current_session"]
+            or ready["messages_covered"] != len(state_store.get_messages(phone_number))
+            or ready["emp_condition"] != emp_condition):
+        print(f"precomputed ping for {phone_number} is out of date, generating it now")
+        return None
+    return ready
+
+
+# Handle the specific case of pinging user
+def create_ping(from_number):
+    start = time.perf_counter()
+    ping_precomputer.cancel(from_number)
+    emp_condition = user_emp_condition(from_number)
+    # Must be checked before the session is summarized and archived
+    ready = fresh_precomputed_ping(from_number, emp_condition)
+    summarize_session(from_number)
+    session_log = state_store.get_session(from_number)
     try:
-        if emp_condition == 0:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "system", "content": ping_msg + "\n\nDo not be empathetic. Minimize emoji usage."}],
-                temperature=0.2,
-            )
+        if ready is not None:
+            response_message = ready["ping"]
+            topic = ready["topic"]
+            maintenance_p = ready["maintenance_prompt"]
         else:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "system", "content": ping_msg}],
-                temperature=0.8,
-            )
-        response_message = response.choices[0].message.content
+            response_message = generate_ping(session_log["current_session"], session_log["session_summaries"][-1],
+                                             emp_condition)
+            # Identify topic from the past three conversation summaries
+            topic = long_term_memory.identify_topic(session_log["session_summaries"][-3:])
+            maintenance_p = build_maintenance_prompt(session_log["session_summaries"][-1], session_log["action_plan"],
+                                                     topic)
         if twilio_client is not None:
             print(f"openai response: {response_message}")
-        maintenance_p = MAINTENANCE_PROMPT.replace("SESSION_SUMMARY_1", session_log_dict[from_number]["session_summaries"][-1])
-        maintenance_p = maintenance_p.replace("ACTION_PLAN", session_log_dict[from_number]["action_plan"])
-        # TODO: Identify topic & retrieve
-        # Identify topic from the past three conversation summaries
-        topic, ret = identify_and_retrieve(session_log_dict[from_number]["session_summaries"][-3:],
-                                           session_log_dict[from_number]["faiss_meta_prefix"])
-        maintenance_p = maintenance_p.replace("DISCUSSION_TOPIC", topic).replace("RETRIEVAL_CONTENT", ret)
-        update_message_log(maintenance_p, from_number, "system")
-        session_log_dict[from_number]["current_session"] += 1
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
+        ret = long_term_memory.retrieve_bullets(user_prefix=session_log["faiss_meta_prefix"], query=topic)
+        maintenance_p = maintenance_p.replace("RETRIEVAL_CONTENT", ret)
+        with state_store.transaction():
+            update_message_log(maintenance_p, from_number, "system")
+            state_store.increment_session(from_number)
     except Exception as e:
         print(f"openai error: {e}")
         response_message = "Sorry, the OpenAI API is currently overloaded or offline. Please try again later."
         remove_last_message_from_log(from_number)
     # Turn the stress relief state to false
-    if from_number in stress_relief_dict:
-        stress_relief_dict[from_number] = False
-        json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
-    # Create another ping in 15 minutes if the user has not responded
-    user_job_dict.update({from_number: -1})
-    json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+    stress_relief_states.end(from_number)
+    with state_store.transaction():
+        # Create another ping in 15 minutes if the user has not responded
+        state_store.set_job(from_number, -1)
+        state_store.clear_precomputed_ping(from_number)
+    print(f"create_ping for {from_number} took {time.perf_counter() - start:.2f}s "
+          f"({'precomputed' if ready is not None else 'live'})")
     return response_message
 
 
@@ -357,14 +472,12 @@ def handle_whatsapp_message(body):
                 return
             enroll_time = datetime.datetime.now().timestamp()
             # 0 means starting with non-empathetic, 1 means starting with empathetic
-            exp_id_map.update({
-                body["From"]: (exp_id, exp_condition, enroll_time)
-            })
-            json.dump(exp_id_map, open("exp_id_map.json", "w+"))
+            state_store.set_experiment(body["From"], exp_id, exp_condition, enroll_time)
             message_body = "Hi"
         else:
-            exp_id, exp_condition, enroll_time = exp_id_map[body["From"]]
-            session_id = "S" + str(len(message_log_dict[body["From"]]))
+            exp_id, exp_condition, enroll_time = state_store.get_experiment(body["From"])
+            # Archived sessions plus the current one
+            session_id = "S" + str(state_store.count_archived_sessions(body["From"]) + 1)
             fin_google_message = FINAL_GOOGLE_FORM_MESSAGE.format(USER_ID=exp_id,
                                                                   SESSION_ID=session_id)
         if "USER_PING" in message_body:
@@ -381,9 +494,10 @@ def handle_whatsapp_message(body):
         send_whatsapp_message(body, response)
         return
     emp_condition = compute_emp_condition(exp_condition, enroll_time)
-    if stress_relief_dict.get(body["From"], False):
+    session_log = state_store.get_session(body["From"])
+    if stress_relief_states.active(body["From"]):
         response = make_stress_relief_response(message_body, body["From"], non_empathetic=(emp_condition == 0))    
-    elif body["From"] in session_log_dict and session_log_dict[body["From"]]["current_session"] > 1:
+    elif session_log is not None and session_log["current_session"] > 1:
         if emp_condition == 0:
             response = make_openai_request(message_body, body["From"], non_empathetic=True)
         elif emp_condition == 1:
@@ -392,11 +506,8 @@ def handle_whatsapp_message(body):
             response = make_empathetic_response(message_body, body["From"])
         if "FINISHED" in response or ("scale of 0 - 5" in response and "stressed" in response):
             # Go into stress relief workflow
-            stress_relief_dict.update({
-                body["From"]: 1
-            })
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
-            msg_logs = message_log_dict[body["From"]]["current_session"]
+            stress_relief_states.start(body["From"])
+            msg_logs = state_store.get_messages(body["From"])
             convo_history = copy.copy(msg_logs)
             convo_history.pop(0)
     else:
@@ -427,8 +538,8 @@ def handle_whatsapp_message(body):
     # Set up scheduling
     curr_time = datetime.datetime.now(datetime.timezone.utc)
     # datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-    if user_job_dict[body["From"]] == -1 and twilio_client is not None:
-        if args.short:
+    if state_store.get_job(body["From"]) == -1 and twilio_client is not None:
+        if SHORT_SCHEDULE:
             schedule_time = curr_time + datetime.timedelta(minutes=12)
         else:
             schedule_time = curr_time + datetime.timedelta(hours=48)
@@ -442,8 +553,7 @@ def handle_whatsapp_message(body):
         )
         all_scheduled_messages.append(message)
         print("SCHEDULED MESSAGE:", message)
-        user_job_dict.update({body["From"]: schedule_time.timestamp()})
-    json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+        state_store.set_job(body["From"], schedule_time.timestamp())
 
 
 def cancel_all_scheduled_messages():
@@ -451,14 +561,64 @@ def cancel_all_scheduled_messages():
         return
     if len(all_scheduled_messages) == 0:
         print("No messages to cancel")
-    for m in all_scheduled_messages:
-        message = twilio_client.messages(m.sid).update(
-            status="canceled"
-        )
-        print("CANCELLED:", message)
+    # Cancel concurrently, within the Twilio rate limit
+    bulk = BulkMessageScheduler(TwilioTransport(twilio_client))
+    for m, result in zip(all_scheduled_messages, bulk.cancel_many([m.sid for m in all_scheduled_messages])):
+        print("CANCELLED:" if result["error"] is None else "CANCEL FAILED:", m.sid, result["error"] or "")
 
 
 
+# run the reply pipeline for a queued message on a background worker
+def process_queued_message(body):
+    # The user's turn runs under their lock, which also holds across worker processes.
+    # A failed turn is logged and counted by the reply pool.
+    # Known limitation of multi-worker deployments (gunicorn_conf.py): the reply pool only
+    # orders the messages a worker received itself. When two messages of a user reach
+    # different workers at once, the lock answers them one at a time but in either order
+    try:
+        with user_locks.lock(body["From"]):
+            handle_whatsapp_message(body)
+    finally:
+        try:
+            rolling_summarizer.observe(body["From"])
+        except Exception as e:
+            print(f"rolling summary error: {e}")
+        # A button press starts a new session, which gets its own ping once it goes idle
+        if body["MessageType"] != "button":
+            ping_precomputer.touch(body["From"])
+
+
+# merge a burst of plain text messages from one user into a single message;
+# commands (EXP_ID, USER_PING) and button presses are kept as separate turns
+def coalesce_messages(bodies):
+    merged = []
+    previous_mergeable = False
+    for body in bodies:
+        mergeable = body["MessageType"] == "text" and "EXP_ID" not in body["Body"] and "USER_PING" not in body["Body"]
+        if mergeable and previous_mergeable:
+            merged[-1]["Body"] = merged[-1]["Body"] + "\n" + body["Body"]
+        else:
+            merged.append(dict(body))
+        previous_mergeable = mergeable
+    if len(merged) < len(bodies):
+        print(f"coalesced {len(bodies)} messages into {len(merged)}")
+    return merged
+
+
+reply_pool = ReplyWorkerPool(process_queued_message, num_workers=REPLY_WORKERS, max_queue=REPLY_QUEUE_DEPTH,
+                             coalesce_window=COALESCE_WINDOW, coalesce_max_wait=COALESCE_MAX_WAIT,
+                             merge=coalesce_messages)
+
+
+# check that the Twilio payload has the fields handle_whatsapp_message relies on
+def validate_payload(body):
+    if not body.get("From") or body.get("MessageType") not in ["text", "button"]:
+        return False
+    if body["MessageType"] == "text" and "Body" not in body:
+        return False
+    return True
+
+
 # handle incoming webhook messages
 def handle_message(request):
     # Parse Request body in json format
@@ -469,7 +629,12 @@ def handle_message(request):
         # info on WhatsApp text message payload:
         # https://developers.facebook.com/docs/whatsapp/cloud-api/webhooks/payload-examples#text-messages
         if body.get("SmsStatus") == "received":
-            handle_whatsapp_message(body)
+            if not validate_payload(body):
+                return jsonify({"status": "error", "message": "Unsupported WhatsApp message"}), 400
+            # Answer Twilio right away; the reply is generated and sent by a worker.
+            # Messages of one user are processed strictly in arrival order.
+            if not reply_pool.submit(body["From"], body):
+                return jsonify({"status": "error", "message": "Reply queue is full"}), 503
             return jsonify({"status": "ok"}), 200
         else:
             # if the request is not a WhatsApp API event, return an error
@@ -520,6 +685,18 @@ def format_conversation(msgs):
     return msg_str
 
 
+# Running summary and action plan of every session, updated in the background every
+# SUMMARY_EVERY_N_TURNS messages so that closing a session only summarizes the last turns
+SUMMARY_EVERY_N_TURNS = int(os.environ.get("SUMMARY_EVERY_N_TURNS", 6))
+rolling_summarizer = RollingSummarizer(state_store, format_conversation, every_n_turns=SUMMARY_EVERY_N_TURNS,
+                                       client=client, user_lock=summary_locks.lock)
+
+# The next check-in ping is prepared PING_PRECOMPUTE_IDLE seconds after the last message
+# of a session (negative disables it), so the button press only has to send it
+PING_PRECOMPUTE_IDLE = float(os.environ.get("PING_PRECOMPUTE_IDLE", 300))
+ping_precomputer = PingPrecomputer(precompute_ping, idle_seconds=PING_PRECOMPUTE_IDLE)
+
+
 # Sets homepage endpoint and welcome message
 @app.route("/", methods=["GET"])
 def home():
@@ -540,73 +717,79 @@ def webhook():
     return jsonify({"status": "ok"}, 200)
 
 
+# Reply worker pool, LLM cache, FAISS index, embedding, ping precompute and connection pool metrics
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Per process: with several workers, each request reports the worker that answered it
+    stats = reply_pool.metrics()
+    stats["pid"] = os.getpid()
+    stats["threads"] = threading.active_count()
+    stats["llm_cache"] = llm_cache.stats()
+    # Deferred subsystems are not initialized just to report on them
+    if is_initialized(long_term_memory):
+        stats["faiss_indexes"] = long_term_memory.index_manager.stats()
+        stats["embeddings"] = long_term_memory.embedding_batcher.stats()
+    stats["ping_precompute"] = ping_precomputer.stats()
+    stats["stress_relief"] = stress_relief_states.stats()
+    stats["http"] = http_transport.stats()
+    stats["startup"] = {"lazy": LAZY_STARTUP, "init_seconds": dict(init_times)}
+    return jsonify(stats)
+
+
 # Route to reset message log
 @app.route("/reset", methods=["GET"])
 def reset():
-    global message_log_dict
-    message_log_dict = {}
-    json.dump({}, open("message_logs.json", "w+"))
+    state_store.clear_messages()
     return "Message log resetted!"
 
 def summarize_session(phone_number):
     print("Obtained phone number", phone_number)
-    current_session_messages = []
-    
-    if len(message_log_dict[phone_number]["current_session"]):
-        current_session_messages = copy.copy(message_log_dict[phone_number]["current_session"])
-        formatted_convo = format_conversation(current_session_messages)
-        if "action_plan" not in session_log_dict[phone_number]:
-            action_plan = str(None)
+    current_session_messages = state_store.get_messages(phone_number)
+    if len(current_session_messages):
+        session_log = state_store.get_session(phone_number)
+        start = time.perf_counter()
+        timings = {}
+        if "faiss_meta_prefix" not in session_log:
+            faiss_meta_prefix = __p_location__ + "/long_term_memory/storage/" + str(uuid.uuid4())
         else:
-            action_plan = session_log_dict[phone_number]["action_plan"]
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": ACTION_PLAN_PROMPT.replace("USER_CONVO", formatted_convo).replace("PREV_ACTION_PLAN", action_plan)}]
-        )
-        response_message = response.choices[0].message.content
-        session_log_dict[phone_number].update({
-            "action_plan": response_message
-        })
-        response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": SUMMARY_PROMPT + "\n\n" + formatted_convo}],
-                temperature=1.0,
-            )
-        response_message = response.choices[0].message.content
-        all_bullets = [x for x in response_message.split("\n") if len(x) > 5]
-        # Find whether stress is a signficant barrier
-        if session_log_dict[phone_number]["current_session"] == 1:
-            stress_judge = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": "Does the user think stress is a significant barrier for them in terms of increasing physical activity? Answer with yes or no." + "\n\n" + formatted_convo}],
-                temperature=0,
-            )
-            if stress_judge.choices[0].message.content.lower().startswith("yes"):
-                stress_relief_dict.update({
-                    phone_number: False
-                })
-        session_log_dict[phone_number]["session_summaries"].append(response_message)
-        
-        if "faiss_meta_prefix" not in session_log_dict[phone_number]:
-            session_log_dict[phone_number].update(
-                {
-                    "faiss_meta_prefix": __p_location__ + "/long_term_memory/storage/" + str(uuid.uuid4())
-                }
-            )
-        # Now we process session summary messages
+            faiss_meta_prefix = session_log["faiss_meta_prefix"]
         session_date = datetime.datetime.strptime(current_session_messages[-1]["timestamp"],
                                                   "%Y/%m/%d, %H:%M:%S").date().strftime("%Y-%m-%d")
-        all_bullets = [{"text": x, "session_date": session_date} for x in all_bullets]
-        build_faiss_index(all_bullets, session_log_dict[phone_number]["faiss_meta_prefix"])
+
+        # Embed the summary bullets as soon as the summary is back, while the action plan
+        # and stress judgement are still being generated. They are only stored once every
+        # call has succeeded, so a retry after a failed call does not store them twice
+        embedded = {"bullets": []}
+        def embed_summary(summary):
+            embed_start = time.perf_counter()
+            all_bullets = [{"text": x, "session_date": session_date} for x in (summary or "").split("\n") if len(x) > 5]
+            if all_bullets:
+                embedded["embeddings"] = long_term_memory.get_embeddings([b["text"] for b in all_bullets])
+            embedded["bullets"] = all_bullets
+            timings["embedding"] = time.perf_counter() - embed_start
+
+        # Most of the session has already been summarized in the background; only the last turns are folded in here
+        rolling = rolling_summarizer.finalize(phone_number, on_summary=embed_summary, timings=timings)
+        if embedded["bullets"]:
+            long_term_memory.build_faiss_index(embedded["bullets"], faiss_meta_prefix, embeddings=embedded["embeddings"])
+        new_action_plan = rolling["action_plan"]
+        response_message = rolling["summary"] or ""
+        # Find whether stress is a signficant barrier
+        stress_barrier = bool(rolling["stress_barrier"])
         # Split message into different sentences
-        session_num = f"session_" + str(session_log_dict[phone_number]["current_session"])
-        message_log_dict[phone_number].update({
-            session_num: current_session_messages
-        })
-        message_log_dict[phone_number]["current_session"] = []
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
-        json.dump(message_log_dict, open("message_logs.json", "w+"))
-    user_job_dict.update({phone_number: (-1, -1)})
+        session_num = f"session_" + str(session_log["current_session"])
+        # Record the summary, action plan and archived session together
+        with state_store.transaction():
+            state_store.update_session(phone_number, action_plan=new_action_plan, faiss_meta_prefix=faiss_meta_prefix)
+            state_store.add_session_summary(phone_number, response_message)
+            state_store.archive_session(phone_number, session_num)
+            state_store.clear_rolling_summary(phone_number)
+        if stress_barrier:
+            stress_relief_states.end(phone_number)
+        timings["total"] = time.perf_counter() - start
+        print(f"summarize_session timings for {phone_number}: " +
+              ", ".join(f"{k}={v:.2f}s" for k, v in timings.items()))
+    state_store.set_job(phone_number, SUMMARIZED_JOB)
     return f"Session summarized for {phone_number}!"
     
 
@@ -619,6 +802,20 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--short", action="store_true")
     parser.add_argument("--empathy", action="store_true")
+    parser.add_argument("--reply_workers", type=int, default=REPLY_WORKERS)
+    parser.add_argument("--reply_queue_depth", type=int, default=REPLY_QUEUE_DEPTH)
+    parser.add_argument("--coalesce_window", type=float, default=COALESCE_WINDOW)
+    parser.add_argument("--coalesce_max_wait", type=float, default=COALESCE_MAX_WAIT)
+    parser.add_argument("--warm_up", action="store_true",
+                        help="With LAZY_STARTUP=1, initialize the deferred subsystems in the background after startup")
     args = parser.parse_args()
+
+    if args.short:
+        SHORT_SCHEDULE = True
+    reply_pool = ReplyWorkerPool(process_queued_message, num_workers=args.reply_workers, max_queue=args.reply_queue_depth,
+                                 coalesce_window=args.coalesce_window, coalesce_max_wait=args.coalesce_max_wait,
+                                 merge=coalesce_messages)
+    if LAZY_STARTUP and args.warm_up:
+        warm_up()
     
     app.run(port=55001, debug=True, use_reloader=True)
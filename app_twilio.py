@@ -1,7 +1,6 @@
 import io
 import os
 
-import openai
 import pydub
 import requests
 import soundfile as sf
@@ -9,6 +8,7 @@ import speech_recognition as sr
 from flask import Flask, jsonify, request
 import json
 import copy
+from state_store import StateStore, SUMMARIZED_JOB
 from argparse import ArgumentParser
 import dotenv
 import datetime
@@ -29,13 +29,17 @@ os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 from empathy_framework import EmpatheticResponder
 
 import dspy
-openai_lm = dspy.LM('openai/gpt-4o-mini', api_key=os.getenv("OPENAI_API_KEY"), max_tokens=4000)
+from llm_cache import CachedLM, cached_chat_completion
+from http_transport import http_transport
+# dspy LMs, the embedder and the openai module all go through the shared connection pool
+http_transport.install()
+openai_lm = CachedLM('openai/gpt-4o-mini', api_key=os.getenv("OPENAI_API_KEY"), max_tokens=4000)
     
 dspy.configure(lm=openai_lm)
 
 empathy_responder = EmpatheticResponder()
 
-client = openai.OpenAI()
+client = http_transport.openai_client()
 
 __p_location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -51,39 +55,16 @@ from stress_relief import StressReliefModule
 bot = StressReliefModule(
         profile_path="user_profiles.json",
         openai_api_key=os.environ["OPENAI_API_KEY"],  # Pass the API key directly
+        http_client=http_transport.httpx_client,
         favorite_threshold=7.0  # Use a custom threshold
     )
 
-# Message log dictionary to enable conversation over multiple messages
-if not os.path.exists("message_logs.json"):
-    json.dump({}, open("message_logs.json", "w+"))
-message_log_dict = json.load(open("message_logs.json"))
-
-# Session logs
-if not os.path.exists("session_logs.json"):
-    json.dump({}, open("session_logs.json", "w+"))
-session_log_dict = json.load(open("session_logs.json"))
-
-# User JSON body template
-if not os.path.exists("user_templates.json"):
-    json.dump({}, open("user_templates.json", "w+"))
-user_template_dict = json.load(open("user_templates.json"))
-
-# Stress relief dict
-if not os.path.exists("stress_relief_logs.json"):
-    json.dump({}, open("stress_relief_logs.json", "w+"))
-stress_relief_dict = json.load(open("stress_relief_logs.json"))
-
-user_job_dict = {}
+# Message logs, sessions, stress relief state, ping jobs and experiment IDs of every user
+# The old JSON state files are imported the first time the database is created
+state_store = StateStore()
 
 all_scheduled_messages = []
 
-
-# EXP ID dict
-if not os.path.exists("exp_id_map.json"):
-    json.dump({}, open("exp_id_map.json", "w+"))
-exp_id_map = json.load(open("exp_id_map.json"))
-
 # language for speech to text recoginition
 # TODO: detect this automatically based on the user's language
 LANGUGAGE = "en-US"
@@ -99,8 +80,9 @@ TWILIO_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 TWILIO_MESSAGING_SERVICE_SID = "MGdadfd2c85ec7e22833d012852d8fa58a"
 
 from twilio.rest import Client
+from twilio_bulk import BulkMessageScheduler, TwilioTransport
 
-twilio_client = Client(TWILIO_SID, TWILIO_TOKEN)
+twilio_client = Client(TWILIO_SID, TWILIO_TOKEN, http_client=http_transport.twilio_http_client())
 
 def split_message_by_period(text, max_length=1600):
     """
@@ -152,32 +134,29 @@ def send_whatsapp_message(body, message):
 
 # create a message log for each phone number and return the current message log
 def update_message_log(message, phone_number, role):
-    if phone_number not in message_log_dict:
+    with state_store.transaction():
+        _update_message_log(message, phone_number, role)
+    return state_store.get_messages(phone_number)
+
+
+def _update_message_log(message, phone_number, role):
+    if not state_store.has_messages(phone_number):
         initial_log = {
             "role": "system",
             "content": INITIAL_PROMPT,
         }
-        message_log_dict[phone_number] = {"current_session": [initial_log]}
-    if phone_number not in session_log_dict:
-        session_log_dict[phone_number] = {
-            "current_session": 1,
-            "session_summaries": []
-        }
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
-    if phone_number not in user_job_dict:
-        user_job_dict.update({
-            phone_number: -1
-        })
-        json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+        state_store.append_message(phone_number, initial_log)
+    if state_store.get_session(phone_number) is None:
+        state_store.create_session(phone_number)
+    if state_store.get_job(phone_number) is None:
+        state_store.set_job(phone_number, -1)
     message_log = {"role": role, "content": message}
-    message_log_dict[phone_number]["current_session"].append(message_log)
-    json.dump(message_log_dict, open("message_logs.json", "w+"))
-    return message_log_dict[phone_number]["current_session"]
+    state_store.append_message(phone_number, message_log)
 
 
 # remove last message from log if OpenAI request fails
 def remove_last_message_from_log(phone_number):
-    message_log_dict[phone_number]["current_session"].pop()
+    state_store.pop_last_message(phone_number)
 
 
 # make request to OpenAI
@@ -185,13 +164,13 @@ def make_openai_request(message, from_number, non_empathetic=False):
     try:
         message_log = update_message_log(message, from_number, "user")
         if non_empathetic:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=message_log + [{"role": "system", "content": "You should be very professional and cold when responding. Do not be empathetic."}],
                 temperature=1.0,
             )
         else:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=message_log,
                 temperature=1.0,
@@ -220,26 +199,23 @@ def make_empathetic_response(message, from_number):
     return response_message
 
 def make_stress_relief_response(message, from_number):
-    global stress_relief_dict
-    stress_relief_dict = json.load(open("stress_relief_logs.json"))
+    stress_relief_state = state_store.get_stress_relief(from_number)
     try:
         message_log = update_message_log(message, from_number, "user")
-        if stress_relief_dict[from_number] == 1:
+        if stress_relief_state == 1:
             print("ROUND 2 STRESS RELIEF CONVERSATION")
             response_message = bot.process_message(message, from_number)["text"]
-            stress_relief_dict.update({from_number: 2})
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
-        elif stress_relief_dict[from_number] == 2:
+            state_store.set_stress_relief(from_number, 2)
+        elif stress_relief_state == 2:
             print("ROUND 3 STRESS RELIEF CONVERSATION")
             response_message = bot.handle_feedback(message, from_number)["text"]
             convo_history = copy.copy(message_log)
             convo_history.append({"role": "assistant", "content": response_message})
             convo_history.append({"role": "system", "content": "Rewrite your last message to incorporate content earlier in the conversation and to say goodbye to the user."})
             response_message = openai_lm(messages=convo_history)[0]
-            stress_relief_dict.update({from_number: False})
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+            state_store.set_stress_relief(from_number, False)
         print(f"stress relief response: {response_message}")
-        print(stress_relief_dict[from_number])
+        print(state_store.get_stress_relief(from_number))
         update_message_log(response_message, from_number, "assistant")
     except Exception as e:
         print(f"openai error: {e}")
@@ -250,46 +226,47 @@ def make_stress_relief_response(message, from_number):
 # Handle the specific case of pinging user
 def create_ping(from_number):
     summarize_session(from_number)
-    ping_msg = PING_PROMPT.replace("NUM_SESSIONS", str(session_log_dict[from_number]["current_session"]))
-    if session_log_dict[from_number]["current_session"] > 1:
+    session_log = state_store.get_session(from_number)
+    ping_msg = PING_PROMPT.replace("NUM_SESSIONS", str(session_log["current_session"]))
+    if session_log["current_session"] > 1:
         ping_msg = ping_msg.replace("SESSION_SINGULAR_PLURAL", "sessions")
     else:
         ping_msg = ping_msg.replace("SESSION_SINGULAR_PLURAL", "session")
-    ping_msg = ping_msg.replace("SESSION_SUMMARY", session_log_dict[from_number]["session_summaries"][-1])
-    if from_number in exp_id_map:
-        _, exp_condition = exp_id_map[from_number]
+    ping_msg = ping_msg.replace("SESSION_SUMMARY", session_log["session_summaries"][-1])
+    experiment = state_store.get_experiment(from_number)
+    if experiment is not None:
+        _, exp_condition, _ = experiment
     else:
         exp_condition = 0
     try:
         if exp_condition == 0:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=[{"role": "system", "content": ping_msg}, {"role": "system", "content": "You should be very professional and cold when responding. Do not be empathetic."}],
                 temperature=0.2,
             )
         else:
-            response = client.chat.completions.create(
+            response = cached_chat_completion(client,
                 model="gpt-4o",
                 messages=[{"role": "system", "content": ping_msg}],
                 temperature=0.8,
             )
         response_message = response.choices[0].message.content
         print(f"openai response: {response_message}")
-        update_message_log(MAINTENANCE_PROMPT.replace("SESSION_SUMMARY", session_log_dict[from_number]["session_summaries"][-1]), from_number, "system")
-        update_message_log(response_message, from_number, "assistant")
-        session_log_dict[from_number]["current_session"] += 1
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
+        with state_store.transaction():
+            update_message_log(MAINTENANCE_PROMPT.replace("SESSION_SUMMARY", session_log["session_summaries"][-1]), from_number, "system")
+            update_message_log(response_message, from_number, "assistant")
+            state_store.increment_session(from_number)
     except Exception as e:
         print(f"openai error: {e}")
         response_message = "Sorry, the OpenAI API is currently overloaded or offline. Please try again later."
         remove_last_message_from_log(from_number)
-    # Turn the stress relief state to false
-    if from_number in stress_relief_dict:
-        stress_relief_dict[from_number] = False
-        json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
-    # Create another ping in 15 minutes if the user has not responded
-    user_job_dict.update({from_number: -1})
-    json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+    with state_store.transaction():
+        # Turn the stress relief state to false
+        if state_store.has_stress_relief(from_number):
+            state_store.set_stress_relief(from_number, False)
+        # Create another ping in 15 minutes if the user has not responded
+        state_store.set_job(from_number, -1)
     return response_message
 
 
@@ -301,53 +278,49 @@ def handle_whatsapp_message(body):
             exp_id = message_body.replace("EXP_ID", "").strip()
             # exp_condition = random.choice([0, 1, 2])
             exp_condition = 1
-            exp_id_map.update({
-                body["From"]: (exp_id, exp_condition)
-            })
-            json.dump(exp_id_map, open("exp_id_map.json", "w+"))
+            state_store.set_experiment(body["From"], exp_id, exp_condition)
             message_body = "Hi"
         else:
-            _, exp_condition = exp_id_map[body["From"]]
+            _, exp_condition, _ = state_store.get_experiment(body["From"])
     elif body["MessageType"] == "button":
         response = create_ping(body["From"])
         send_whatsapp_message(body, response)
         return
     print("PASS 1")
-    if stress_relief_dict.get(body["From"], False):
-        print(">>> inside stress_relief_dict if statement")
+    session_log = state_store.get_session(body["From"])
+    if state_store.get_stress_relief(body["From"]):
+        print(">>> inside stress relief if statement")
         response = make_stress_relief_response(message_body, body["From"])
-    elif body["From"] in session_log_dict and session_log_dict[body["From"]]["current_session"] > 1:
+    elif session_log is not None and session_log["current_session"] > 1:
         if exp_condition == 0:
             response = make_openai_request(message_body, body["From"], non_empathetic=True)
         elif exp_condition == 1:
             response = make_openai_request(message_body, body["From"])
         elif exp_condition == 2:
             response = make_empathetic_response(message_body, body["From"])
-        if "FINISHED" in response and body["From"] in stress_relief_dict:
+        if "FINISHED" in response and state_store.has_stress_relief(body["From"]):
             # Go into stress relief workflow
-            stress_relief_dict[body["From"]] = True
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+            state_store.set_stress_relief(body["From"], True)
             # TODO: Directly ask here if the user is stressed
-            msg_logs = message_log_dict[body["From"]]["current_session"]
+            msg_logs = state_store.get_messages(body["From"])
             convo_history = copy.copy(msg_logs)
             convo_history.pop(0)
             convo_history.append({"role": "system", "content": "Rewrite your last message so that you check with the user to determine whether they are stressed."})
             response = openai_lm(messages=convo_history)[0]
-            message_log_dict[body["From"]]["current_session"][-1]["content"] = response
-            stress_relief_dict.update({body["From"]: 1})
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+            with state_store.transaction():
+                state_store.replace_last_message(body["From"], response)
+                state_store.set_stress_relief(body["From"], 1)
     else:
         if exp_condition == 0:
             response = make_openai_request(message_body, body["From"], non_empathetic=True)
         else:
             response = make_openai_request(message_body, body["From"])
         
-        if "FINISHED" in response and body["From"] in stress_relief_dict:
+        if "FINISHED" in response and state_store.has_stress_relief(body["From"]):
             # Go into stress relief workflow
-            stress_relief_dict[body["From"]] = True
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+            state_store.set_stress_relief(body["From"], True)
             # TODO: Directly ask here if the user is stressed
-            msg_logs = message_log_dict[body["From"]]["current_session"]
+            msg_logs = state_store.get_messages(body["From"])
             convo_history = copy.copy(msg_logs)
             convo_history.pop(0)
             if exp_condition == 0:
@@ -356,9 +329,9 @@ def handle_whatsapp_message(body):
                 convo_history.append({"role": "system", "content": "Rewrite your last message so that you check with the user to determine whether they are stressed."})
             
             response = openai_lm(messages=convo_history)[0]
-            message_log_dict[body["From"]]["current_session"][-1]["content"] = response
-            stress_relief_dict.update({body["From"]: 1})
-            json.dump(stress_relief_dict, open("stress_relief_logs.json", "w+"))
+            with state_store.transaction():
+                state_store.replace_last_message(body["From"], response)
+                state_store.set_stress_relief(body["From"], 1)
     print("PASS 2")
     
     if "FINISHED" in response:
@@ -368,7 +341,7 @@ def handle_whatsapp_message(body):
     # Set up scheduling
     curr_time = datetime.datetime.now(datetime.timezone.utc)
     # datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-    if user_job_dict[body["From"]] == -1:
+    if state_store.get_job(body["From"]) == -1:
         if args.short:
             schedule_time = curr_time + datetime.timedelta(minutes=12)
         else:
@@ -383,18 +356,16 @@ def handle_whatsapp_message(body):
         )
         all_scheduled_messages.append(message)
         print("SCHEDULED MESSAGE:", message)
-        user_job_dict.update({body["From"]: schedule_time.timestamp()})
-    json.dump(user_job_dict, open("user_job_dict.json", "w+"))
+        state_store.set_job(body["From"], schedule_time.timestamp())
 
 
 def cancel_all_scheduled_messages():
     if len(all_scheduled_messages) == 0:
         print("No messages to cancel")
-    for m in all_scheduled_messages:
-        message = twilio_client.messages(m.sid).update(
-            status="canceled"
-        )
-        print("CANCELLED:", message)
+    # Cancel concurrently, within the Twilio rate limit
+    bulk = BulkMessageScheduler(TwilioTransport(twilio_client))
+    for m, result in zip(all_scheduled_messages, bulk.cancel_many([m.sid for m in all_scheduled_messages])):
+        print("CANCELLED:" if result["error"] is None else "CANCEL FAILED:", m.sid, result["error"] or "")
 
 
 
@@ -482,19 +453,16 @@ def webhook():
 # Route to reset message log
 @app.route("/reset", methods=["GET"])
 def reset():
-    global message_log_dict
-    message_log_dict = {}
-    json.dump({}, open("message_logs.json", "w+"))
+    state_store.clear_messages()
     return "Message log resetted!"
 
 def summarize_session(phone_number):
     print("Obtained phone number", phone_number)
-    current_session_messages = []
-    
-    if len(message_log_dict[phone_number]["current_session"]):
-        current_session_messages = copy.copy(message_log_dict[phone_number]["current_session"])
+    current_session_messages = state_store.get_messages(phone_number)
+    if len(current_session_messages):
+        session_log = state_store.get_session(phone_number)
         formatted_convo = format_conversation(current_session_messages)
-        response = openai.chat.completions.create(
+        response = cached_chat_completion(client,
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": SUMMARY_PROMPT + "\n\n" + formatted_convo}],
                 temperature=1.0,
@@ -502,26 +470,22 @@ def summarize_session(phone_number):
         response_message = response.choices[0].message.content
         print(response_message)
         # Find whether stress is a signficant barrier
-        if session_log_dict[phone_number]["current_session"] == 1:
-            stress_judge = openai.chat.completions.create(
+        stress_barrier = False
+        if session_log["current_session"] == 1:
+            stress_judge = cached_chat_completion(client,
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": "Does the user think stress is a significant barrier for them in terms of increasing physical activity? Answer with yes or no." + "\n\n" + formatted_convo}],
                 temperature=0,
             )
-            if stress_judge.choices[0].message.content.lower().startswith("yes"):
-                stress_relief_dict.update({
-                    phone_number: False
-                })
-        if phone_number in session_log_dict:
-            session_log_dict[phone_number]["session_summaries"].append(response_message)
-        session_num = f"session_" + str(session_log_dict[phone_number]["current_session"])
-        message_log_dict[phone_number].update({
-            session_num: current_session_messages
-        })
-        message_log_dict[phone_number]["current_session"] = []
-        json.dump(session_log_dict, open("session_logs.json", "w+"))
-        json.dump(message_log_dict, open("message_logs.json", "w+"))
-    user_job_dict.update({phone_number: (-1, -1)})
+            stress_barrier = stress_judge.choices[0].message.content.lower().startswith("yes")
+        session_num = f"session_" + str(session_log["current_session"])
+        # Record the summary and archived session together
+        with state_store.transaction():
+            state_store.add_session_summary(phone_number, response_message)
+            if stress_barrier:
+                state_store.set_stress_relief(phone_number, False)
+            state_store.archive_session(phone_number, session_num)
+    state_store.set_job(phone_number, SUMMARIZED_JOB)
     return f"Session summarized for {phone_number}!"
     
 
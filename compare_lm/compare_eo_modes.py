@@ -0,0 +1,93 @@
+import sys
+import os
+import time
+import json
+import dspy
+import dotenv
+from argparse import ArgumentParser
+
+dotenv.load_dotenv("../.env")
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+sys.path.insert(1, os.path.join(__location__, "../"))
+from empathy_framework import EmpatheticResponder
+from empathy_framework import appraisal_responder as ar
+
+# Compares the per-segment EO classifier (one SIMBA-optimized call per segment, run concurrently)
+# against the batched classifier (one call for all segments) on the comparison texts.
+# Reports latency, token usage and how often the two modes agree on the labels.
+
+
+def count_tokens(history_start):
+    # Sum the token usage of the mini LM calls made since `history_start`
+    prompt_tokens, completion_tokens = 0, 0
+    for entry in ar.openai_4o_mini.history[history_start:]:
+        usage = entry.get("usage") or {}
+        prompt_tokens += usage.get("prompt_tokens", 0) or 0
+        completion_tokens += usage.get("completion_tokens", 0) or 0
+    return prompt_tokens, completion_tokens
+
+
+def run_mode(responder, segmentation, user_input, eo_mode):
+    history_start = len(ar.openai_4o_mini.history)
+    start = time.perf_counter()
+    labels = responder.classify_segments(segmentation, user_input, eo_mode=eo_mode)
+    latency = time.perf_counter() - start
+    prompt_tokens, completion_tokens = count_tokens(history_start)
+    return {"labels": [list(l) for l in labels], "latency": latency, "calls": len(ar.openai_4o_mini.history) - history_start,
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+
+def summarize(results, mode):
+    n = len(results)
+    return {
+        "avg_latency": sum(r[mode]["latency"] for r in results) / n,
+        "avg_calls": sum(r[mode]["calls"] for r in results) / n,
+        "avg_prompt_tokens": sum(r[mode]["prompt_tokens"] for r in results) / n,
+        "avg_completion_tokens": sum(r[mode]["completion_tokens"] for r in results) / n
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--texts", type=str, default="empathy_comparison_texts.json")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--output", type=str, default="eo_mode_comparison.json")
+    args = parser.parse_args()
+
+    # Measure real calls, not cache hits
+    ar.openai_4o_mini.cache = False
+    ar.openai_4o_mini.cache_in_memory = False
+
+    texts = json.load(open(args.texts))
+    if args.limit:
+        texts = texts[:args.limit]
+
+    responder = EmpatheticResponder()
+    results = []
+    for t in texts:
+        user_input = t["message"]
+        # Segment once so both modes classify the same segments
+        with dspy.context(lm=ar.openai_4o_mini):
+            segmentation = responder.sentence_segmenter(input_paragraph=user_input).output.split("\n")
+        per_segment = run_mode(responder, segmentation, user_input, "per_segment")
+        batched = run_mode(responder, segmentation, user_input, "batched")
+        top1 = [a[:1] == b[:1] for a, b in zip(per_segment["labels"], batched["labels"])]
+        overlap = [len(set(a) & set(b)) / max(len(set(a) | set(b)), 1) for a, b in zip(per_segment["labels"], batched["labels"])]
+        results.append({"participant": t.get("participant"), "message": user_input, "segments": segmentation,
+                        "per_segment": per_segment, "batched": batched,
+                        "top1_agreement": sum(top1) / len(top1), "label_overlap": sum(overlap) / len(overlap)})
+        print(f"{len(segmentation)} segments | per_segment {per_segment['latency']:.2f}s, batched {batched['latency']:.2f}s | top-1 agreement {results[-1]['top1_agreement']:.2f}")
+
+    report = {
+        "n_messages": len(results),
+        "n_segments": sum(len(r["segments"]) for r in results),
+        "per_segment": summarize(results, "per_segment"),
+        "batched": summarize(results, "batched"),
+        "top1_agreement": sum(r["top1_agreement"] * len(r["segments"]) for r in results) / sum(len(r["segments"]) for r in results),
+        "label_overlap": sum(r["label_overlap"] * len(r["segments"]) for r in results) / sum(len(r["segments"]) for r in results)
+    }
+    print(json.dumps(report, indent=2))
+    json.dump({"report": report, "results": results}, open(args.output, "w+"), indent=2)
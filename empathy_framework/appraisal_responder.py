@@ -1,13 +1,41 @@
 import dspy
-from .eo_classifier import EOClassifierModule, SingleEOClassifierModule
+from llm_cache import CachedLM
+from .eo_classifier import EOClassifierModule, SingleEOClassifierModule, BatchEOClassifierModule
 from .sampling_appraisal import sample_appraisal
 from .constants import CLINICAL_EMPATHY_DESCRIPTIONS, __location__
 import os
 from typing import List
 import copy
+import time
+import litellm
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-empathy_lm = dspy.LM("openai/gpt-4o", temperature=0.7)
-openai_4o_mini = dspy.LM("openai/gpt-4o-mini")
+empathy_lm = CachedLM("openai/gpt-4o", temperature=0.7)
+openai_4o_mini = CachedLM("openai/gpt-4o-mini")
+
+REWRITE_INSTRUCTION = "Rewrite your previous utterance to be more natural and less repetitive, while retaining empathy."
+SINGLE_PASS_INSTRUCTION = "\n\nMake your response natural and not repetitive of your previous utterances, while retaining empathy."
+
+RESPONSE_MODES = ["rewrite", "single", "speculative"]
+
+
+# Stream a chat completion from `lm`, passing every text delta to `on_token`
+# Returns the full text and the seconds until the first token arrived
+def stream_completion(lm, messages, on_token=None):
+    start = time.perf_counter()
+    first_token = None
+    chunks = []
+    kwargs = {k: v for k, v in lm.kwargs.items() if k in ["temperature", "max_tokens"]}
+    for chunk in litellm.completion(model=lm.model, messages=messages, stream=True, **kwargs):
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        chunks.append(delta)
+        if on_token is not None:
+            on_token(delta)
+    return "".join(chunks), first_token
 
 class SentenceSegmenter(dspy.Signature):
     """
@@ -50,21 +78,70 @@ class EmpatheticResponderDSPy(dspy.Module):
                                  empathy_techniques=all_emp_techs)
     
 class EmpatheticResponder:
-    def __init__(self):
+    def __init__(self, max_eo_concurrency=4, eo_mode="per_segment", response_mode="rewrite", rewrite_budget=3.0):
+        """
+        max_eo_concurrency: maximum number of segment classifications sent to the LM at once.
+        eo_mode: "per_segment" classifies each segment with its own (concurrent) call to the
+            SIMBA-optimized classifier; "batched" classifies all segments in a single call.
+        response_mode: "rewrite" generates a draft and then rewrites it to be more natural;
+            "single" streams one generation with the naturalness instruction in the first prompt;
+            "speculative" generates the draft and falls back to it if the rewrite takes longer
+            than `rewrite_budget` seconds.
+        """
+        if eo_mode not in ["per_segment", "batched"]:
+            raise ValueError(f"Unknown eo_mode: {eo_mode}")
+        if response_mode not in RESPONSE_MODES:
+            raise ValueError(f"Unknown response_mode: {response_mode}")
+        self.eo_mode = eo_mode
+        self.response_mode = response_mode
+        self.rewrite_budget = rewrite_budget
         self.eo_class = SingleEOClassifierModule()
         self.eo_class.load(os.path.join(__location__, "eo_classifier_optimized_simba.json"))
+        self.batch_eo_class = BatchEOClassifierModule()
         self.sentence_segmenter = dspy.Predict(SentenceSegmenter)
         self.eo_descriptions = open(os.path.join(__location__, "eo_descriptions.txt")).read()
         self.empathy_prompt = open(os.path.join(__location__, "empathy_response_prompt.txt")).read()
+        # Shared by all calls so the concurrency cap holds across simultaneous conversations
+        self.eo_executor = ThreadPoolExecutor(max_workers=max_eo_concurrency, thread_name_prefix="eo-classifier")
+        # Rewrites that miss the budget in speculative mode finish here in the background
+        self.rewrite_executor = ThreadPoolExecutor(max_workers=max_eo_concurrency, thread_name_prefix="empathy-rewrite")
+
+    def classify_segment(self, segment, user_input):
+        # dspy.context is thread-local, so each worker thread sets the classifier LM itself
+        with dspy.context(lm=openai_4o_mini):
+            return self.eo_class(user_input=segment, user_utt=user_input, eo_descriptions=self.eo_descriptions).eo_classification
+
+    def classify_segments(self, segmentation, user_input, eo_mode=None):
+        """
+        Returns the top EO labels of every segment, in segment order.
+        """
+        eo_mode = eo_mode or self.eo_mode
+        if eo_mode == "batched":
+            with dspy.context(lm=openai_4o_mini):
+                return self.batch_eo_class(user_inputs=segmentation, user_utt=user_input,
+                                           eo_descriptions=self.eo_descriptions).eo_classifications
+        # Classify all segments concurrently; results come back in segment order
+        return list(self.eo_executor.map(lambda s: self.classify_segment(s, user_input), segmentation))
         
-    def respond_empathetically(self, user_input, convo_history: List[dict], return_dict=False):
+    def respond_empathetically(self, user_input, convo_history: List[dict], return_dict=False,
+                               response_mode=None, on_token=None):
+        """
+        Returns a list with the response text, like calling a dspy.LM.
+        on_token: called with each streamed text delta in "single" mode.
+        With return_dict, the strategies, EOs and per-stage timings (in seconds) are returned as well.
+        """
+        response_mode = response_mode or self.response_mode
+        timings = {}
+        start = time.perf_counter()
         all_eos = []
         with dspy.context(lm=openai_4o_mini):
             segmentation = self.sentence_segmenter(input_paragraph=user_input).output
             segmentation = segmentation.split("\n")
-            for s in segmentation:
-                eos = self.eo_class(user_input=s, user_utt=user_input, eo_descriptions=self.eo_descriptions).eo_classification
-                all_eos.extend(eos)
+        timings["segmentation"] = time.perf_counter() - start
+        stage_start = time.perf_counter()
+        for eos in self.classify_segments(segmentation, user_input):
+            all_eos.extend(eos)
+        timings["eo_classification"] = time.perf_counter() - stage_start
         # print("All classified empathetic opportunities:", all_eos)
         if len(segmentation) == 1:
             all_appraisals = sample_appraisal(all_eos, sampling_num=1)
@@ -75,16 +152,41 @@ class EmpatheticResponder:
             all_emp_techs = all_emp_techs + "- " + CLINICAL_EMPATHY_DESCRIPTIONS[a] + "\n\n"
         # print("All empathetic strategies:", all_emp_techs)
         convo_copy = copy.copy(convo_history)
-        convo_copy.append({"role": "system", "content": self.empathy_prompt.replace("ALL_EMP", all_emp_techs)})
-        response_text = empathy_lm(messages=convo_copy)
-        convo_copy.pop(-1)
-        convo_copy.append({"role": "assistant", "content": response_text[0]})
-        convo_copy.append({"role": "system", "content": "Rewrite your previous utterance to be more natural and less repetitive, while retaining empathy."})
-        response_text = empathy_lm(messages=convo_copy)
+        stage_start = time.perf_counter()
+        if response_mode == "single":
+            # One generation, streamed, with the rewrite instruction folded into the prompt
+            convo_copy.append({"role": "system", "content": self.empathy_prompt.replace("ALL_EMP", all_emp_techs) + SINGLE_PASS_INSTRUCTION})
+            text, first_token = stream_completion(empathy_lm, convo_copy, on_token=on_token)
+            response_text = [text]
+            timings["draft"] = time.perf_counter() - stage_start
+            if first_token is not None:
+                timings["first_token"] = timings["segmentation"] + timings["eo_classification"] + first_token
+        else:
+            convo_copy.append({"role": "system", "content": self.empathy_prompt.replace("ALL_EMP", all_emp_techs)})
+            response_text = empathy_lm(messages=convo_copy)
+            timings["draft"] = time.perf_counter() - stage_start
+            convo_copy.pop(-1)
+            convo_copy.append({"role": "assistant", "content": response_text[0]})
+            convo_copy.append({"role": "system", "content": REWRITE_INSTRUCTION})
+            stage_start = time.perf_counter()
+            if response_mode == "speculative":
+                rewrite = self.rewrite_executor.submit(empathy_lm, messages=convo_copy)
+                try:
+                    response_text = rewrite.result(timeout=self.rewrite_budget)
+                    timings["used_draft"] = False
+                except TimeoutError:
+                    # Send the draft; the rewrite is left to finish and is discarded
+                    timings["used_draft"] = True
+            else:
+                response_text = empathy_lm(messages=convo_copy)
+            timings["rewrite"] = time.perf_counter() - stage_start
+        timings["total"] = time.perf_counter() - start
         if return_dict:
             return response_text, {
                 "all_empathetic_strategies": all_emp_techs,
-                "all_eos": all_eos
+                "all_eos": all_eos,
+                "response_mode": response_mode,
+                "timings": timings
             }
         return response_text
         
@@ -42,6 +42,30 @@ class EOClassifierOne(dspy.Signature):
     ]] = dspy.OutputField(desc="The top three Empathy Opportunity prediction")
 
 
+EOLabel = Literal[
+    "negative_feelings_explicit",
+    "negative_feelings_implicit",
+    "negative_judgment_explicit",
+    "negative_judgment_implicit",
+    "positive_self_judgment_explicit",
+    "positive_self_judgment_implicit",
+    "negative_appreciation_explicit",
+    "negative_appreciation_implicit",
+    "general"
+]
+
+
+class EOClassifierBatch(dspy.Signature):
+    """
+    Classify every segment of a longer user utterance into different Empathy Opportunities (EO) or as General. Use the definitions and examples for each EO provided to you to make your classifications. For each segment, in the order given, return the top three EO classifications.
+    """
+
+    user_segments: List[str] = dspy.InputField(desc="The segments of the user's utterance.")
+    user_utterance: str = dspy.InputField(desc="The full original user utterance.")
+    eo_descriptions: str = dspy.InputField(desc="Definitions and examples for each Empathy Opportunity type.")
+    empathy_opportunities: List[List[EOLabel]] = dspy.OutputField(desc="One list per segment, in segment order, with the top three Empathy Opportunity predictions for that segment")
+
+
 class EOClassifierModule(dspy.Module):
     def __init__(self, callbacks=None):
         super().__init__(callbacks)
@@ -62,7 +86,19 @@ class SingleEOClassifierModule(dspy.Module):
         output = self.eo_class(user_segment = user_input, user_utterance=user_utt, eo_descriptions=eo_descriptions)
         return dspy.Prediction(eo_classification=output.empathy_opportunity)
 
+class BatchEOClassifierModule(dspy.Module):
+    """
+    Classifies all segments of an utterance in one LM call instead of one call per segment.
+    Not optimized with SIMBA; eo_classifier_optimized_simba.json only applies to SingleEOClassifierModule.
+    """
+    def __init__(self, callbacks=None):
+        super().__init__(callbacks)
+        self.eo_class = dspy.ChainOfThought(EOClassifierBatch)
 
-
-
-        
+    def forward(self, user_inputs, user_utt, eo_descriptions):
+        output = self.eo_class(user_segments=user_inputs, user_utterance=user_utt, eo_descriptions=eo_descriptions)
+        eo_classifications = list(output.empathy_opportunities)[:len(user_inputs)]
+        # The LM occasionally drops a segment; treat the missing ones as general
+        while len(eo_classifications) < len(user_inputs):
+            eo_classifications.append(["general"])
+        return dspy.Prediction(eo_classifications=eo_classifications)
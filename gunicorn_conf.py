@@ -0,0 +1,58 @@
+import multiprocessing
+import os
+import sys
+
+# Multi-worker deployment of app_official:
+#   gunicorn -c gunicorn_conf.py
+#
+# The app is imported once in the master before the workers are forked (preload_app), so
+# the LMs, the empathy responder, stress relief, the prompts and long-term memory are
+# loaded once and shared copy-on-write. Everything a worker must not share with its parent
+# is created after the fork: SQLite connections are opened per process and thread, and the
+# reply workers, timers, executors and HTTP connections only start on first use.
+#
+# All per-user state lives in the SQLite state store (and long-term memory in the vector
+# store), and every user's turn runs under a lock that holds across workers (user_lock.py),
+# so any worker can answer any user. Known limitation: gunicorn cannot route a user to one
+# worker, so two messages of a user that reach different workers at the same time are
+# answered one after the other but not necessarily in arrival order. Within a worker the
+# reply pool keeps each user's messages in order.
+
+wsgi_app = "app_official:app"
+bind = os.environ.get("BIND", "0.0.0.0:55001")
+
+# Every stress relief transition is written through, since the next message of a user may
+# reach another worker (see stress_relief_state.py)
+os.environ.setdefault("STRESS_RELIEF_SHARED", "1")
+
+# WEB_CONCURRENCY sets the number of workers directly; otherwise WORKERS_PER_CORE per CPU
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             multiprocessing.cpu_count() * int(os.environ.get("WORKERS_PER_CORE", 2))))
+# The webhook only enqueues payloads, so a few threads per worker are enough to accept them
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+preload_app = True
+timeout = 120
+graceful_timeout = 30
+accesslog = "-"
+errorlog = "-"
+
+# Threads used by FAISS searches in each worker; the cores are shared by all workers
+FAISS_THREADS = int(os.environ.get("FAISS_THREADS", 1))
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded, before any worker is forked. With
+    # LAZY_STARTUP=1 the deferred subsystems are loaded now, so they are shared by the workers
+    # instead of being loaded again by each of them.
+    from lazy_startup import LAZY_STARTUP, init_times, warm_up
+    if LAZY_STARTUP:
+        warm_up(background=False)
+    server.log.info("app loaded before fork: %s",
+                    ", ".join(f"{k}={v:.2f}s" for k, v in init_times.items()))
+
+
+def post_fork(server, worker):
+    if "faiss" in sys.modules:
+        sys.modules["faiss"].omp_set_num_threads(FAISS_THREADS)
+    server.log.info("worker %s forked", worker.pid)
@@ -0,0 +1,162 @@
+import importlib.util
+import os
+import threading
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    # Response body that gives the host slot back once the response is closed
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class _PerHostLimitTransport(httpx.HTTPTransport):
+    # httpx only limits connections in total; this also caps the requests open to each host
+    def __init__(self, max_per_host: int, **kwargs):
+        super().__init__(**kwargs)
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[host]
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        slot = self._slot(request.url.host)
+        # Wait for a slot no longer than for a pooled connection, so slots leaked by responses
+        # that were never closed surface as PoolTimeout instead of hanging every later call
+        pool_timeout = request.extensions.get("timeout", {}).get("pool")
+        if not slot.acquire(timeout=pool_timeout):
+            raise httpx.PoolTimeout(f"no free slot for {request.url.host} within {pool_timeout}s", request=request)
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            slot.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, slot.release)
+        return response
+
+
+class _TimeoutSession(requests.Session):
+    # requests has no session-wide timeout; apply ours unless the call passes one
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+
+class HttpTransport:
+    """
+    Keep-alive HTTP connection pools shared by every outbound API client of the bot.
+
+    `httpx_client` serves the OpenAI SDK and litellm (and through it every dspy LM and the
+    embedder); `session` serves requests-based callers (Graph API, Twilio, the notifier).
+    Both keep warm TLS connections to each host, so a burst of calls to the same API reuses
+    them instead of handshaking per call. HTTP/2 is used for httpx when the `h2` package is
+    installed. `max_per_host` caps the requests open to a single host in each pool.
+    """
+
+    def __init__(self, max_connections: int = 100, max_per_host: int = 20, keepalive_expiry: float = 60.0,
+                 timeout: float = 120.0, connect_timeout: float = 10.0, http2: Optional[bool] = None):
+        """
+        max_connections: connections kept by the httpx pool across all hosts.
+        max_per_host: requests open to one host at a time (and connections kept per host by `session`).
+        keepalive_expiry: seconds an idle connection is kept open.
+        timeout, connect_timeout: default read and connect timeouts in seconds.
+        http2: use HTTP/2 for httpx; None uses it when `h2` is installed.
+        """
+        self.http2 = importlib.util.find_spec("h2") is not None if http2 is None else http2
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.httpx_client = httpx.Client(
+            transport=_PerHostLimitTransport(max_per_host, http2=self.http2, limits=self.limits),
+            timeout=self.timeout)
+        self.session = _TimeoutSession((connect_timeout, timeout))
+        # pool_block makes a request wait for a free connection instead of opening an extra one
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max_per_host, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def from_env(cls) -> "HttpTransport":
+        http2 = os.environ.get("HTTP2")
+        return cls(max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", 100)),
+                   max_per_host=int(os.environ.get("HTTP_MAX_PER_HOST", 20)),
+                   keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60)),
+                   timeout=float(os.environ.get("HTTP_TIMEOUT", 120)),
+                   connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10)),
+                   http2=None if http2 is None else http2 == "1")
+
+    def openai_client(self, **kwargs):
+        """
+        openai.OpenAI client on the shared pool.
+        """
+        import openai
+        return openai.OpenAI(http_client=self.httpx_client, **kwargs)
+
+    def async_openai_client(self, max_connections: Optional[int] = None, **kwargs):
+        """
+        openai.AsyncOpenAI client on its own asyncio pool with the same timeouts, for up to
+        `max_connections` requests in flight (default: the pool's). Create it on the event
+        loop that uses it.
+        """
+        import openai
+        limits = self.limits if max_connections is None else httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections,
+            keepalive_expiry=self.limits.keepalive_expiry)
+        return openai.AsyncOpenAI(http_client=httpx.AsyncClient(http2=self.http2, limits=limits,
+                                                                timeout=self.timeout), **kwargs)
+
+    def twilio_http_client(self):
+        """
+        Twilio HTTP client on the shared requests session.
+        """
+        from twilio.http.http_client import TwilioHttpClient
+        http_client = TwilioHttpClient(pool_connections=True, timeout=self.timeout.read)
+        http_client.session = self.session
+        return http_client
+
+    def install(self):
+        """
+        Make the shared pool the default of the clients that are not built by hand: litellm
+        (used by every dspy LM and embedder) and calls through the `openai` module itself.
+        """
+        import litellm
+        import openai
+        litellm.client_session = self.httpx_client
+        openai.http_client = self.httpx_client
+
+    def stats(self) -> dict:
+        pool = self.httpx_client._transport._pool
+        return {"http2": self.http2,
+                "httpx_connections": len(pool.connections),
+                "httpx_idle_connections": sum(1 for c in pool.connections if c.is_idle())}
+
+
+# Shared transport; configured with HTTP_MAX_CONNECTIONS, HTTP_MAX_PER_HOST, HTTP_KEEPALIVE_EXPIRY,
+# HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT and HTTP2
+http_transport = HttpTransport.from_env()
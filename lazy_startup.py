@@ -0,0 +1,107 @@
+import importlib
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+# LAZY_STARTUP=1 defers the heavy subsystems of the app (LMs, empathy responder, long-term
+# memory, audio stack, Twilio) until they are first used, so the server binds right away
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "0") == "1"
+
+# Subsystem name -> seconds its initialization took, in the order they were initialized
+init_times = {}
+_registry = []
+_times_lock = threading.Lock()
+
+
+def _timed(name: str, factory: Callable):
+    start = time.perf_counter()
+    value = factory()
+    with _times_lock:
+        init_times[name] = time.perf_counter() - start
+    return value
+
+
+class Lazy:
+    """
+    Stand-in for an object that is built by `factory` the first time one of its attributes
+    is used. Initialization happens once, under a lock, on whichever thread gets there first.
+    """
+
+    def __init__(self, name: str, factory: Callable):
+        self._name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._initialized = False
+
+    def get(self):
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    self._value = _timed(self._name, self._factory)
+                    self._initialized = True
+        return self._value
+
+    @property
+    def initialized(self) -> bool:
+        return self._initialized
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __repr__(self):
+        return f"<lazy {self._name}{'' if self._initialized else ' (not initialized)'}>"
+
+
+def lazy(name: str, factory: Callable):
+    """
+    `factory()` right away, or a Lazy that calls it on first use when LAZY_STARTUP is set.
+    """
+    if not LAZY_STARTUP:
+        return _timed(name, factory)
+    value = Lazy(name, factory)
+    _registry.append(value)
+    return value
+
+
+def lazy_module(name: str, before: Optional[Callable[[], None]] = None):
+    """
+    Import module `name` (after calling `before`), lazily when LAZY_STARTUP is set.
+    """
+    def load():
+        if before is not None:
+            before()
+        return importlib.import_module(name)
+    return lazy(name, load)
+
+
+def ensure(value):
+    """
+    The object behind `value`, initializing it if it is still deferred.
+    """
+    return value.get() if isinstance(value, Lazy) else value
+
+
+def is_initialized(value) -> bool:
+    return not isinstance(value, Lazy) or value.initialized
+
+
+def warm_up(background: bool = True):
+    """
+    Initialize every subsystem that is still deferred, by default on a background thread,
+    so the first requests after a lazy start do not pay for it.
+    """
+    def run():
+        for value in list(_registry):
+            try:
+                value.get()
+            except Exception as e:
+                print(f"warm up of {value._name} failed: {e}")
+    if background:
+        threading.Thread(target=run, name="warm-up", daemon=True).start()
+    else:
+        run()
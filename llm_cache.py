@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+DEFAULT_CACHE_PATH = "llm_cache.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_by_access ON responses (accessed_at);
+"""
+
+# Request arguments that never change the response and must not end up in the key
+_IGNORED_PARAMS = ["api_key", "api_base", "timeout", "cache", "cache_in_memory", "num_retries"]
+
+
+# A sampled request must get a fresh sample every time, or the same prompt would always get the
+# same stored answer back (a repeated ping, a regenerated reply). OpenAI samples at temperature 1
+# when none is given
+def is_sampled(params: dict) -> bool:
+    temperature = params.get("temperature")
+    return temperature is None or temperature > 0
+
+
+class LLMCache:
+    """
+    Disk-backed cache of LLM responses shared by every process of the bot.
+
+    Responses are keyed by a hash of the model, the messages and the sampling parameters,
+    so the same request made by an evaluation rerun, a retry or another process is only
+    paid for once. Only deterministic (temperature 0) requests are cached; sampled ones
+    always go to the API (see `is_sampled`). Entries expire after `ttl` seconds, and once the cache holds more than
+    `max_entries` responses the least recently used ones are evicted.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH, ttl: Optional[float] = 7 * 24 * 3600,
+                 max_entries: int = 50000, bypass: bool = False):
+        """
+        db_path: location of the SQLite database.
+        ttl: seconds a response stays valid; None keeps responses until they are evicted.
+        max_entries: number of responses kept before least recently used ones are evicted.
+        bypass: skip the cache entirely (every call goes to the API and nothing is stored).
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "bypassed": 0}
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads.
+        # A connection inherited through fork belongs to the parent: it is kept, unused and open
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            self._local.inherited = conn
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    @staticmethod
+    def make_key(model: str, messages, **params) -> str:
+        params = {k: v for k, v in params.items() if k not in _IGNORED_PARAMS and v is not None}
+        request = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._conn()
+        row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None:
+            self._count("misses")
+            return None
+        if self.ttl is not None and now - row[1] > self.ttl:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._count("expired")
+            self._count("misses")
+            return None
+        conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return row[0]
+
+    def put(self, key: str, response: str):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                     (key, response, now, now))
+        overflow = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            conn.execute("DELETE FROM responses WHERE key IN "
+                         "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (overflow,))
+            with self._lock:
+                self._stats["evicted"] += overflow
+
+    def cached(self, key: str, call: Callable[[], str], bypass: bool = False) -> str:
+        """
+        Return the cached response for `key`, or run `call` and store its (serialized) response.
+        """
+        if bypass or self.bypass:
+            self._count("bypassed")
+            return call()
+        response = self.get(key)
+        if response is None:
+            response = call()
+            self.put(key, response)
+        return response
+
+    def clear(self):
+        self._conn().execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["entries"] = self._conn().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+# Shared cache used by all call sites; LLM_CACHE_BYPASS=1 turns it off
+llm_cache = LLMCache(db_path=os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                     ttl=float(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600)),
+                     max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 50000)),
+                     bypass=os.environ.get("LLM_CACHE_BYPASS", "0") == "1")
+
+
+# Drop-in replacement for client.chat.completions.create(...) that goes through the shared cache
+# `client` can be an openai.OpenAI instance or the openai module itself
+def cached_chat_completion(client, bypass=False, **kwargs) -> "ChatCompletion":
+    # Imported here so that importing this module stays cheap (see lazy_startup.py)
+    from openai.types.chat import ChatCompletion
+    key = LLMCache.make_key(kwargs.get("model"), kwargs.get("messages"),
+                            **{k: v for k, v in kwargs.items() if k not in ["model", "messages"]})
+    response = llm_cache.cached(key, lambda: client.chat.completions.create(**kwargs).model_dump_json(),
+                                bypass=bypass or is_sampled(kwargs))
+    return ChatCompletion.model_validate_json(response)
+
+
+# The same for an openai.AsyncOpenAI client (app_async.py). The cache lookup and store are
+# SQLite queries that can wait for a writer, so they run on the loop's default executor
+async def cached_chat_completion_async(client, bypass=False, **kwargs) -> "ChatCompletion":
+    from openai.types.chat import ChatCompletion
+    if bypass or llm_cache.bypass or is_sampled(kwargs):
+        llm_cache._count("bypassed")
+        return await client.chat.completions.create(**kwargs)
+    loop = asyncio.get_running_loop()
+    key = LLMCache.make_key(kwargs.get("model"), kwargs.get("messages"),
+                            **{k: v for k, v in kwargs.items() if k not in ["model", "messages"]})
+    response = await loop.run_in_executor(None, llm_cache.get, key)
+    if response is None:
+        response = (await client.chat.completions.create(**kwargs)).model_dump_json()
+        await loop.run_in_executor(None, llm_cache.put, key, response)
+    return ChatCompletion.model_validate_json(response)
+
+
+# CachedLM subclasses dspy.LM, so it is only defined once something asks for it; importing
+# dspy and litellm takes a couple of seconds
+_cached_lm = None
+_cached_lm_lock = threading.Lock()
+
+
+def _define_cached_lm():
+    import dspy
+    import litellm
+
+    class CachedLM(dspy.LM):
+        """
+        dspy.LM whose requests go through the shared LLM cache instead of dspy's own cache.
+        Setting `lm.cache = False` (or passing cache=False) bypasses it, and so does a
+        temperature above 0.
+        """
+
+        def forward(self, prompt=None, messages=None, **kwargs):
+            bypass = not kwargs.pop("cache", self.cache)
+            kwargs.pop("cache_in_memory", None)
+            messages = messages or [{"role": "user", "content": prompt}]
+            params = {**self.kwargs, **kwargs}
+            key = LLMCache.make_key(self.model, messages, **params)
+            response = llm_cache.cached(
+                key,
+                lambda: super(CachedLM, self).forward(messages=messages, cache=False, **kwargs).model_dump_json(warnings=False),
+                bypass=bypass or is_sampled(params))
+            return litellm.ModelResponse(**json.loads(response))
+
+    CachedLM.__module__ = __name__
+    CachedLM.__qualname__ = "CachedLM"
+    return CachedLM
+
+
+def __getattr__(name):
+    global _cached_lm
+    if name == "CachedLM":
+        with _cached_lm_lock:
+            if _cached_lm is None:
+                _cached_lm = _define_cached_lm()
+        return _cached_lm
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,221 @@
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import aiohttp
+from aiohttp import web
+
+# Load test of the threaded Flask webhook (app_official.py) against the asyncio one (app_async.py).
+# Both run against a local stub of the OpenAI and Twilio APIs that answers after a fixed latency,
+# so the test measures how many conversations a server keeps in flight, not the APIs themselves.
+# Every simulated user enrolls with an EXP_ID and then sends --turns messages, each after the
+# reply to the previous one has arrived. A turn's latency runs from the webhook POST until the
+# reply reaches the stub's Twilio messages endpoint.
+# Run from the repository root:
+#   python load_test_async.py                                   # 100 users, both servers
+#   python load_test_async.py --users 1000 --servers async --openai_latency 2
+#   python load_test_async.py --flask_reply_workers 32 --output load_test.json
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+
+SERVERS = {
+    "flask": lambda port: [sys.executable, "-c",
+                           f"import app_official; app_official.app.run(port={port}, threaded=True)"],
+    "async": lambda port: [sys.executable, "app_async.py", "--port", str(port)],
+}
+
+
+class UpstreamStub:
+    """
+    Answers OpenAI chat completions and Twilio message creations after a fixed latency, and
+    hands the arrival time of every reply to the simulated user it is addressed to.
+    """
+    def __init__(self, openai_latency: float, twilio_latency: float):
+        self.openai_latency = openai_latency
+        self.twilio_latency = twilio_latency
+        self.inboxes = {}
+        self.requests = {"openai": 0, "twilio": 0}
+        self._ids = itertools.count()
+
+    def inbox(self, phone_number: str) -> asyncio.Queue:
+        return self.inboxes.setdefault(phone_number, asyncio.Queue())
+
+    async def chat_completion(self, request):
+        await request.json()
+        self.requests["openai"] += 1
+        await asyncio.sleep(self.openai_latency)
+        return web.json_response({
+            "id": f"chatcmpl-{next(self._ids)}", "object": "chat.completion", "created": int(time.time()),
+            "model": "gpt-4o", "choices": [{"index": 0, "finish_reason": "stop",
+                                            "message": {"role": "assistant", "content": "How are you feeling today?"}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}})
+
+    async def create_message(self, request):
+        form = await request.post()
+        self.requests["twilio"] += 1
+        await asyncio.sleep(self.twilio_latency)
+        # Scheduled check-in templates have no body; only replies count
+        if form.get("Body") is not None:
+            self.inbox(form["To"]).put_nowait(time.monotonic())
+        return web.json_response({"sid": f"SM{next(self._ids):032d}", "status": "queued", "to": form.get("To"),
+                                  "body": form.get("Body")}, status=201)
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.add_routes([web.post("/v1/chat/completions", self.chat_completion),
+                        web.post("/2010-04-01/Accounts/{sid}/Messages.json", self.create_message)])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def start_server(name: str, port: int, stub_port: int, workdir: str, flask_reply_workers: int):
+    env = dict(os.environ,
+               OPENAI_API_KEY="sk-load-test", OPENAI_BASE_URL=f"http://127.0.0.1:{stub_port}/v1",
+               TWILIO_ACCOUNT_SID="ACloadtest", TWILIO_AUTH_TOKEN="load-test",
+               TWILIO_API_BASE_URL=f"http://127.0.0.1:{stub_port}",
+               # Fresh state in a scratch directory; every request goes to the stub
+               STATE_STORE_PATH=os.path.join(workdir, "state.db"), LLM_CACHE_PATH=os.path.join(workdir, "llm_cache.db"),
+               VECTOR_STORE_DIR=os.path.join(workdir, "storage"), USER_LOCK_DIR=os.path.join(workdir, "locks"),
+               LLM_CACHE_BYPASS="1", LAZY_STARTUP="1", COALESCE_WINDOW="0", SUMMARY_EVERY_N_TURNS="0",
+               PING_PRECOMPUTE_IDLE="-1", REPLY_WORKERS=str(flask_reply_workers), PYTHONUNBUFFERED="1",
+               # Large enough that neither server turns users away; latency shows the backlog instead
+               REPLY_QUEUE_DEPTH="100000", ASYNC_QUEUE_DEPTH="100000")
+    log = open(os.path.join(workdir, f"{name}.log"), "w+")
+    return subprocess.Popen(SERVERS[name](port), cwd=__location__, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_up(session, url: str, process, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            async with session.get(url + "/") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not come up")
+
+
+async def simulate_user(session, url: str, stub: UpstreamStub, phone_number: str, exp_id: str, turns: int,
+                        think_time: float, timeout: float, result: dict):
+    inbox = stub.inbox(phone_number)
+    for turn in range(turns + 1):
+        body = f"EXP_ID {exp_id}" if turn == 0 else f"Message {turn} from {phone_number}"
+        sent = time.monotonic()
+        try:
+            async with session.post(url + "/webhook", data={"SmsStatus": "received", "From": phone_number,
+                                                            "MessageType": "text", "Body": body}) as response:
+                if response.status != 200:
+                    result["errors"] += 1
+                    return
+        except aiohttp.ClientError:
+            result["errors"] += 1
+            return
+        try:
+            arrived = await asyncio.wait_for(inbox.get(), timeout)
+        except asyncio.TimeoutError:
+            result["timeouts"] += 1
+            return
+        result["latencies"].append(arrived - sent)
+        await asyncio.sleep(think_time)
+
+
+async def sample_metrics(session, url: str, peak: dict, stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            async with session.get(url + "/metrics") as response:
+                stats = await response.json()
+            peak["threads"] = max(peak["threads"], stats["threads"])
+        except (aiohttp.ClientError, ValueError, KeyError):
+            pass
+        await asyncio.sleep(0.5)
+
+
+async def run_server(name: str, args, stub: UpstreamStub, stub_port: int, port: int, exp_ids: list) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"load_test_{name}_")
+    process = start_server(name, port, stub_port, workdir, args.flask_reply_workers)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            await wait_until_up(session, url, process)
+            result = {"latencies": [], "errors": 0, "timeouts": 0}
+            peak = {"threads": 0}
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(sample_metrics(session, url, peak, stop))
+            start = time.monotonic()
+            await asyncio.gather(*[simulate_user(session, url, stub, f"whatsapp:+1555{port % 100:02d}{i:06d}",
+                                                 exp_ids[i % len(exp_ids)], args.turns, args.think_time,
+                                                 args.timeout, result) for i in range(args.users)])
+            wall = time.monotonic() - start
+            stop.set()
+            await sampler
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = sorted(result["latencies"])
+    report = {"server": name, "users": args.users, "turns": len(latencies), "errors": result["errors"],
+              "timeouts": result["timeouts"], "wall_seconds": wall,
+              "turns_per_second": len(latencies) / wall if wall else 0.0, "peak_threads": peak["threads"]}
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        report.update({"p50_seconds": percentiles[49], "p95_seconds": percentiles[94], "max_seconds": latencies[-1]})
+    if args.keep_workdir:
+        report["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+async def main(args):
+    stub = UpstreamStub(args.openai_latency, args.twilio_latency)
+    runner = await stub.start(args.stub_port)
+    # Participants whose first week is a plain OpenAI condition, so every turn takes the same path
+    exp_ids = [exp_id for exp_id, condition in json.load(open(os.path.join(__location__, "assignment_exps.json"))).items()
+               if condition in [0, 1]]
+    reports = []
+    try:
+        for i, name in enumerate(args.servers.split(",")):
+            print(f"running {name} with {args.users} users x {args.turns + 1} turns ...")
+            reports.append(await run_server(name, args, stub, args.stub_port, args.port + i, exp_ids))
+    finally:
+        await runner.cleanup()
+    return reports
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--servers", type=str, default="flask,async", help="Comma separated: flask, async")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=2, help="Messages per user after enrolling")
+    parser.add_argument("--think_time", type=float, default=0.0, help="Seconds a user waits before answering")
+    parser.add_argument("--openai_latency", type=float, default=3.0)
+    parser.add_argument("--twilio_latency", type=float, default=0.2)
+    parser.add_argument("--flask_reply_workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds a user waits for a reply")
+    parser.add_argument("--port", type=int, default=55110, help="Port of the first server under test")
+    parser.add_argument("--stub_port", type=int, default=55100)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--keep_workdir", action="store_true", help="Keep the state and server logs of each run")
+    args = parser.parse_args()
+
+    reports = asyncio.run(main(args))
+    print(f"\n{'server':<8}{'turns':>7}{'errors':>8}{'turns/s':>10}{'p50 s':>8}{'p95 s':>8}{'max s':>8}{'threads':>9}")
+    for r in reports:
+        print(f"{r['server']:<8}{r['turns']:>7}{r['errors'] + r['timeouts']:>8}{r['turns_per_second']:>10.1f}"
+              f"{r.get('p50_seconds', 0):>8.2f}{r.get('p95_seconds', 0):>8.2f}{r.get('max_seconds', 0):>8.2f}"
+              f"{r['peak_threads']:>9}")
+    if args.output:
+        json.dump(reports, open(args.output, "w+"), indent=2)
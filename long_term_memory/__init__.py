@@ -1,2 +1,2 @@
-from .embed_bullets import build_faiss_index, retrieve_bullets
-from .identify_topics import identify_and_retrieve
\ No newline at end of file
+from .embed_bullets import build_faiss_index, retrieve_bullets, get_embeddings, index_manager, embedding_batcher
+from .identify_topics import identify_and_retrieve, identify_topic
\ No newline at end of file
@@ -0,0 +1,92 @@
+import time
+import json
+from argparse import ArgumentParser
+
+import faiss
+import numpy as np
+
+from .vector_store import FaissShard, normalize
+
+# Recall@k and query latency of the approximate shard layouts against the flat index.
+# Vectors are synthetic clustered embeddings and every query searches the whole shard, which is
+# the case of one participant with that many bullets (smaller users are scored exactly anyway).
+# Latency is reported for the plain search and for the search filtered to the participant's ids,
+# which also pays for building the id selector.
+# Run from the repository root:
+#   python -m long_term_memory.benchmark_ann --sizes 1000 10000 100000
+
+
+def clustered_vectors(rng, n, dim, n_clusters=100, noise=0.8):
+    centroids = rng.standard_normal((n_clusters, dim)).astype("float32")
+    labels = rng.integers(0, n_clusters, n)
+    return normalize(centroids[labels] + noise * rng.standard_normal((n, dim)).astype("float32"))
+
+
+def build_shard(vectors, layout):
+    shard = FaissShard("unused.faiss", dimension=vectors.shape[1])
+    shard.add(vectors, np.arange(len(vectors), dtype="int64"))
+    start = time.perf_counter()
+    if layout != "flat":
+        shard.promote(layout)
+    return shard, time.perf_counter() - start
+
+
+def run_queries(shard, queries, ids, top_k, **params):
+    # ids=None searches the index without an id filter
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        hits = shard.search(q[None, :], ids, top_k, exact_limit=0, **params)
+        latencies.append(time.perf_counter() - start)
+        results.append([i for i, _ in hits])
+    return results, latencies
+
+
+def recall_at_k(results, truth):
+    return float(np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth)]))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=256, help="Use 1536 for text-embedding-3-small sized vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--ef_search", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(1)
+    rng = np.random.default_rng(args.seed)
+    report = []
+    print(f"{'size':>7} {'layout':<20}{'build_s':>9}{'recall@k':>10}{'p50_ms':>9}{'p95_ms':>9}{'filtered_p50_ms':>17}")
+    for size in args.sizes:
+        vectors = clustered_vectors(rng, size + args.queries, args.dim)
+        corpus, queries = vectors[:size], vectors[size:]
+        ids = np.arange(size, dtype="int64")
+        configs = [("flat", {})]
+        configs += [("ivf", {"nprobe": p}) for p in args.nprobe]
+        configs += [("hnsw", {"ef_search": e}) for e in args.ef_search]
+        truth = None
+        shards = {}
+        for layout, params in configs:
+            if layout not in shards:
+                shards[layout] = build_shard(corpus, layout)
+            shard, build_time = shards[layout]
+            results, latencies = run_queries(shard, queries, None, args.top_k, **params)
+            _, filtered_latencies = run_queries(shard, queries, ids, args.top_k, **params)
+            if truth is None:
+                truth = results
+            row = {"size": size, "layout": layout, **params, "build_seconds": build_time,
+                   "recall_at_k": recall_at_k(results, truth),
+                   "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+                   "p95_ms": 1000 * float(np.percentile(latencies, 95)),
+                   "filtered_p50_ms": 1000 * float(np.percentile(filtered_latencies, 50))}
+            report.append(row)
+            name = layout + "".join(f" {k}={v}" for k, v in params.items())
+            print(f"{size:>7} {name:<20}{build_time:>9.2f}{row['recall_at_k']:>10.3f}{row['p50_ms']:>9.3f}"
+                  f"{row['p95_ms']:>9.3f}{row['filtered_p50_ms']:>17.3f}")
+    if args.output:
+        json.dump(report, open(args.output, "w+"), indent=2)
@@ -0,0 +1,141 @@
+import json
+import tempfile
+from argparse import ArgumentParser
+
+import faiss
+import numpy as np
+
+from .vector_store import VectorStore, index_manager
+
+# Recall/precision of long-term memory retrieval on a synthetic bullet corpus.
+# Every bullet belongs to a topic; a retrieved bullet is relevant if it has the topic of the query.
+# Compares the old scoring (raw inner product, keeping hits with 1 - score > 0.4) against
+# cosine similarity on normalized vectors for a sweep of thresholds and top_k values.
+# Run from the repository root:
+#   python -m long_term_memory.benchmark_retrieval                 # synthetic vectors, no API calls
+#   python -m long_term_memory.benchmark_retrieval --embedder openai
+
+TOPICS = {
+    "walking": ["Walked to work three days this week instead of driving",
+                "Wants to reach 8000 steps per day",
+                "Enjoys evening walks with the dog",
+                "Skipped walks when it rained"],
+    "work_stress": ["Deadlines at work leave little time to exercise",
+                    "Feels exhausted after long meetings",
+                    "Stress at the office makes it hard to sleep",
+                    "Manager expects overtime most weeks"],
+    "gym": ["Signed up for a gym membership near home",
+            "Finds the gym intimidating when it is crowded",
+            "Plans to lift weights twice a week",
+            "Went to a spin class on Saturday"],
+    "family": ["Takes care of two young children after school",
+               "Family dinners leave no time for evening workouts",
+               "Goes hiking with their partner on weekends",
+               "Parents are visiting for the next two weeks"],
+    "sleep": ["Sleeps about five hours on weeknights",
+              "Wakes up tired and skips morning exercise",
+              "Wants to go to bed before eleven",
+              "Naps in the afternoon on weekends"],
+    "diet": ["Eats fast food for lunch most days",
+             "Trying to drink more water",
+             "Snacks late at night while watching TV",
+             "Started cooking meals on Sunday for the week"],
+    "injury": ["Knee pain after running more than two miles",
+               "Physical therapist recommended swimming",
+               "Sprained an ankle last month",
+               "Avoids stairs because of back pain"],
+    "motivation": ["Feels guilty after missing planned workouts",
+                   "Tracking progress in an app keeps them going",
+                   "Rewarded themselves after a full week of activity",
+                   "Loses motivation when they do not see results"]
+}
+
+QUERIES = {
+    "walking": ["How has their walking routine been going?", "Daily step goal"],
+    "work_stress": ["Job stress getting in the way of activity", "Busy schedule at work"],
+    "gym": ["Going to the gym", "Strength training plans"],
+    "family": ["Family responsibilities", "Time spent with their kids and partner"],
+    "sleep": ["Getting enough rest", "Sleep schedule"],
+    "diet": ["Eating habits", "Healthy meals and snacks"],
+    "injury": ["Pain or injuries that limit exercise", "Recovering from an injury"],
+    "motivation": ["Staying motivated", "Feelings about missed workouts"]
+}
+
+
+def synthetic_embeddings(rng, dim=256, noise=1.2):
+    # Topic centroids plus noise, with random vector lengths so that raw inner products
+    # are dominated by length rather than direction
+    centroids = {t: rng.standard_normal(dim) / np.sqrt(dim) for t in TOPICS}
+    def embed(topic):
+        v = centroids[topic] + noise * rng.standard_normal(dim) / np.sqrt(dim)
+        return (v / np.linalg.norm(v) * rng.uniform(0.5, 2.0)).astype("float32")
+    bullets = np.stack([embed(t) for t in TOPICS for _ in TOPICS[t]])
+    queries = np.stack([embed(t) for t in QUERIES for _ in QUERIES[t]])
+    return bullets, queries
+
+
+def openai_embeddings():
+    from .embed_bullets import get_embeddings
+    bullets = get_embeddings([b for t in TOPICS for b in TOPICS[t]])
+    queries = get_embeddings([q for t in QUERIES for q in QUERIES[t]])
+    return np.asarray(bullets, dtype="float32"), np.asarray(queries, dtype="float32")
+
+
+def evaluate(hits_per_query, query_topics, bullet_topics):
+    # hits_per_query: list of retrieved bullet positions per query; -1 is a bullet of another user
+    precisions, recalls = [], []
+    n_relevant = {t: bullet_topics.count(t) for t in set(bullet_topics)}
+    for hits, topic in zip(hits_per_query, query_topics):
+        relevant = sum(1 for h in hits if h >= 0 and bullet_topics[h] == topic)
+        precisions.append(relevant / len(hits) if hits else 1.0)
+        recalls.append(relevant / n_relevant[topic])
+    return {"precision": float(np.mean(precisions)), "recall": float(np.mean(recalls)),
+            "avg_retrieved": float(np.mean([len(h) for h in hits_per_query]))}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--embedder", type=str, default="synthetic", choices=["synthetic", "openai"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.embedder == "openai":
+        bullet_embs, query_embs = openai_embeddings()
+    else:
+        bullet_embs, query_embs = synthetic_embeddings(np.random.default_rng(args.seed))
+    bullet_texts = [b for t in TOPICS for b in TOPICS[t]]
+    bullet_topics = [t for t in TOPICS for _ in TOPICS[t]]
+    query_topics = [t for t in QUERIES for _ in QUERIES[t]]
+
+    report = {"embedder": args.embedder, "n_bullets": len(bullet_texts), "n_queries": len(query_topics), "results": []}
+
+    # Old scoring: raw vectors in an IndexFlatIP, keep hits with 1 - score > 0.4
+    legacy = faiss.IndexFlatIP(bullet_embs.shape[1])
+    legacy.add(bullet_embs)
+    for top_k in [3, 5]:
+        scores, indices = legacy.search(query_embs, top_k)
+        hits = [[int(i) for s, i in zip(sr, ir) if i >= 0 and 1 - s > 0.4] for sr, ir in zip(scores, indices)]
+        report["results"].append({"scoring": "legacy 1 - ip > 0.4", "top_k": top_k, **evaluate(hits, query_topics, bullet_topics)})
+
+    # New scoring through the vector store. A second user holds a copy of the corpus in the same
+    # shard; retrieving one of their bullets would count as irrelevant.
+    with tempfile.TemporaryDirectory() as storage_dir:
+        store = VectorStore(storage_dir, num_shards=1)
+        bullets = [{"text": b, "session_date": "2025-01-01"} for b in bullet_texts]
+        store.add("benchmark_user", bullet_embs, bullets)
+        store.add("other_user", bullet_embs, [{"text": "[other] " + b, "session_date": "2025-01-01"} for b in bullet_texts])
+        position = {b: i for i, b in enumerate(bullet_texts)}
+        for top_k in [3, 5]:
+            per_query = [store.search("benchmark_user", q[None, :], top_k) for q in query_embs]
+            for threshold in [0.0, 0.2, 0.3, 0.4, 0.5]:
+                hits = [[position.get(m["text"], -1) for m, sim in res if sim >= threshold] for res in per_query]
+                report["results"].append({"scoring": f"cosine >= {threshold}", "top_k": top_k,
+                                          **evaluate(hits, query_topics, bullet_topics)})
+        index_manager.flush()
+
+    print(f"{'scoring':<22}{'top_k':>6}{'precision':>11}{'recall':>8}{'retrieved':>11}")
+    for r in report["results"]:
+        print(f"{r['scoring']:<22}{r['top_k']:>6}{r['precision']:>11.3f}{r['recall']:>8.3f}{r['avg_retrieved']:>11.2f}")
+    if args.output:
+        json.dump(report, open(args.output, "w+"), indent=2)
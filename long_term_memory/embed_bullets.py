@@ -1,16 +1,24 @@
-import faiss
 import openai
 import numpy as np
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional
 import dspy
 import os
-import json
+from .vector_store import vector_store, index_manager
+from .embedding_batcher import EmbeddingBatcher, EmbeddingCache
 
 # ----------------------
 # Configuration
 # ----------------------
 
-embedder = dspy.Embedder(model="openai/text-embedding-3-small", caching=True)
+EMBEDDING_MODEL = "openai/text-embedding-3-small"
+
+embedder = dspy.Embedder(model=EMBEDDING_MODEL, caching=True)
+
+# Shared by all threads, so concurrent summaries and retrievals are embedded in common batches
+embedding_batcher = EmbeddingBatcher(lambda texts: embedder(inputs=texts), model=EMBEDDING_MODEL,
+                                     cache=EmbeddingCache(os.path.join(vector_store.storage_dir, "embeddings.db")),
+                                     max_batch=int(os.environ.get("EMBEDDING_BATCH_SIZE", 256)),
+                                     max_wait=float(os.environ.get("EMBEDDING_BATCH_WAIT", 0.05)))
 
 
 # ----------------------
@@ -21,77 +29,29 @@ def get_embeddings(texts: List[str]) -> np.ndarray:
     Generate embeddings for a list of texts using OpenAI.
     Returns an array of shape (len(texts), embedding_dim).
     """
-    return embedder(inputs=texts)
-
-# ----------------------
-# FAISS Index with Metadata
-# ----------------------
-class FaissIndexWithMetadata:
-    def __init__(self, user_prefix: str, dimension: int = 0):
-        """
-        Initialize a FAISS index and storage for metadata.
-        """
-        self.dimension = dimension
-        index_file = user_prefix + ".faiss"
-        metadata_file = user_prefix + ".json"
-        self.index_file = index_file
-        self.metadata_file = metadata_file
-        if not os.path.exists(index_file):
-            self.index = faiss.IndexFlatIP(dimension)
-            faiss.write_index(self.index, index_file)
-        else:
-            self.index = faiss.read_index(self.index_file)
-            self.dimension = self.index.d
-        if not os.path.exists(metadata_file):
-            self.metadata = []
-            json.dump(self.metadata, open(metadata_file, "w+"))
-        else:
-            self.metadata = json.load(open(self.metadata_file))
-
+    return embedding_batcher.embed(texts)
 
-    def add(self, embeddings: np.ndarray, metadatas: List[Dict[str, Any]]):
-        """
-        Add embeddings and their corresponding metadata to the index.
-        """
-        self.index.add(embeddings)
-        self.metadata.extend(metadatas)
-
-    def search(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[Dict[str, Any], float]]:
-        """
-        Retrieve top_k closest embeddings and return their metadata and distances.
-        """
-        distances, indices = self.index.search(query_embedding, top_k)
-        results: List[Tuple[Dict[str, Any], float]] = []
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx < 0:
-                continue
-            # 1 - cosine distance is cosine similarity
-            results.append((self.metadata[idx], 1 - float(dist)))
-        return results
-    
-    def save(self):
-        faiss.write_index(self.index, self.index_file)
-        json.dump(self.metadata, open(self.metadata_file, "w+"))
+# Users are identified in the vector store by the last component of their
+# faiss_meta_prefix, which is also the name of their old per-user files
+def memory_id(user_prefix: str) -> str:
+    return os.path.basename(user_prefix)
 
 # ----------------------
 # Build Index Function
 # ----------------------
 def build_faiss_index(
     bullets: List[Dict[str, Any]],  # Each dict should have 'text' and 'session_date'
-    user_prefix: str
+    user_prefix: str,
+    embeddings: Optional[np.ndarray] = None
 ):
     """
     Given a list of bullet-point records with text and metadata,
-    build and return a FAISS index with stored metadata.
+    add them to the user's long-term memory in the shared vector store.
+    Pass `embeddings` when the bullets have already been embedded.
     """
-    texts = [b['text'] for b in bullets]
-    embeddings = get_embeddings(texts)
-    dim = embeddings.shape[1]
-    
-    faiss_idx = FaissIndexWithMetadata(user_prefix=user_prefix,
-                                       dimension=dim)
-    faiss_idx.add(embeddings, bullets)
-    faiss_idx.save()
+    if embeddings is None:
+        embeddings = get_embeddings([b['text'] for b in bullets])
+    vector_store.add(memory_id(user_prefix), embeddings, bullets)
 
 # ----------------------
 # Retrieval Function
@@ -99,20 +59,20 @@ def build_faiss_index(
 def retrieve_bullets(
     user_prefix: str,
     query: str,
-    top_k: int = 5,
-    threshold: float = 0.4
+    top_k: int = 3,
+    threshold: float = 0.3
 ):
     """
     Retrieve the top_k most relevant bullets for a given query.
-    Returns a list of metadata dicts with 'text', 'session_date', and 'distance'.
+    Only bullets whose cosine similarity to the query is at least `threshold` are kept.
+    Returns the bullets formatted one per line with their session date.
     """
-    faiss_idx = FaissIndexWithMetadata(user_prefix=user_prefix)
     q_emb = get_embeddings([query])
-    hits = faiss_idx.search(q_emb, top_k)
+    hits = vector_store.search(memory_id(user_prefix), q_emb, top_k)
     results = []
     print(hits)
-    for meta, dist in hits:
+    for meta, similarity in hits:
         entry = meta.copy()
-        if dist > threshold:
-            results.append(f"Date: {entry["session_date"]}, Content: {entry["text"]}")
+        if similarity >= threshold:
+            results.append(f"Date: {entry['session_date']}, Content: {entry['text']}")
     return "\n".join(results)
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    vector BLOB NOT NULL
+);
+"""
+
+
+# ----------------------
+# Persistent Embedding Cache
+# ----------------------
+class EmbeddingCache:
+    """
+    Embeddings stored by a hash of the model name and the text, so a text is only
+    embedded once no matter which user or session it comes from.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads.
+        # A connection inherited through fork belongs to the parent: it is kept, unused and open
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            self._local.inherited = conn
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256((model + "\0" + text).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> dict:
+        found = {}
+        conn = self._conn()
+        # Stay below SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype="float32")
+        return found
+
+    def put_many(self, items: dict):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                             [(k, np.asarray(v, dtype="float32").tobytes()) for k, v in items.items()])
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+# ----------------------
+# Embedding Batcher
+# ----------------------
+class EmbeddingBatcher:
+    """
+    Gathers the texts of concurrent embedding calls into API-sized batches.
+
+    Texts already in the cache are answered directly. The remaining ones are queued,
+    deduplicated against texts other callers are already waiting for, and embedded by a
+    background thread once `max_batch` texts are queued or the oldest has waited `max_wait`
+    seconds. Each caller then gets the vectors of its own texts back in order.
+    """
+    def __init__(self, embed: Callable[[List[str]], np.ndarray], model: str, cache: Optional[EmbeddingCache] = None,
+                 max_batch: int = 256, max_wait: float = 0.05):
+        """
+        embed: embeds a list of texts, returning an array of shape (len(texts), dim).
+        model: model name, part of the cache key.
+        cache: persistent cache of embeddings; None disables caching.
+        max_batch: maximum number of texts per embedding request.
+        max_wait: seconds a queued text waits for other texts before its batch is sent.
+        """
+        self.embed_fn = embed
+        self.model = model
+        self.cache = cache
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        # key -> (text, future) for texts waiting to be embedded, in arrival order
+        self._pending = {}
+        self._oldest = None
+        self._thread = None
+        self._stats = {"calls": 0, "texts": 0, "cache_hits": 0, "deduplicated": 0, "batches": 0, "embedded": 0}
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        keys = [EmbeddingCache.make_key(self.model, t) for t in texts]
+        vectors = self.cache.get_many(list(set(keys))) if self.cache is not None else {}
+        futures = {}
+        with self._cond:
+            self._stats["calls"] += 1
+            self._stats["texts"] += len(texts)
+            for key, text in zip(keys, texts):
+                if key in vectors:
+                    self._stats["cache_hits"] += 1
+                    continue
+                if key in futures:
+                    self._stats["deduplicated"] += 1
+                    continue
+                if key in self._pending:
+                    # Another caller is already waiting for this text
+                    self._stats["deduplicated"] += 1
+                    futures[key] = self._pending[key][1]
+                    continue
+                future = Future()
+                self._pending[key] = (text, future)
+                futures[key] = future
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            if futures:
+                self._start()
+                self._cond.notify()
+        for key, future in futures.items():
+            vectors[key] = future.result()
+        return np.stack([vectors[k] for k in keys]) if keys else np.zeros((0, 0), dtype="float32")
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queued"] = len(self._pending)
+        return stats
+
+    def _start(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._pending:
+                        waited = time.monotonic() - self._oldest
+                        if len(self._pending) >= self.max_batch or waited >= self.max_wait:
+                            break
+                        self._cond.wait(self.max_wait - waited)
+                    else:
+                        self._cond.wait()
+                batch = []
+                for key in list(self._pending)[:self.max_batch]:
+                    batch.append((key,) + self._pending.pop(key))
+                if not self._pending:
+                    self._oldest = None
+                self._stats["batches"] += 1
+                self._stats["embedded"] += len(batch)
+            try:
+                embeddings = np.asarray(self.embed_fn([text for _, text, _ in batch]), dtype="float32")
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            if self.cache is not None:
+                try:
+                    self.cache.put_many({key: embeddings[i] for i, (key, _, _) in enumerate(batch)})
+                except Exception as e:
+                    print(f"embedding cache error: {e}")
+            for i, (_, _, future) in enumerate(batch):
+                future.set_result(embeddings[i])
@@ -1,8 +1,8 @@
-import dspy
+from llm_cache import CachedLM
 from typing import List
 from .embed_bullets import retrieve_bullets
 
-summary_lm = dspy.LM(model="openai/gpt-4o-mini")
+summary_lm = CachedLM(model="openai/gpt-4o-mini")
 # ----------------------
 # Topic Identification Function
 # ----------------------
@@ -0,0 +1,63 @@
+import glob
+import json
+import os
+from argparse import ArgumentParser
+
+import faiss
+import numpy as np
+
+from .embed_bullets import memory_id
+from .vector_store import VectorStore, DEFAULT_STORAGE_DIR, index_manager
+
+# Imports the old per-user <uuid>.faiss + <uuid>.json pairs into the shared vector store.
+# Users that are already in the store are skipped, so the migration can be re-run safely.
+# Run from the repository root:
+#   python -m long_term_memory.migrate_vector_store --legacy_dir long_term_memory/storage
+
+
+# Vectors and bullet metadata of one old <uuid>.faiss + <uuid>.json pair
+def load_legacy(user_prefix: str):
+    index = faiss.read_index(user_prefix + ".faiss")
+    metadata = json.load(open(user_prefix + ".json"))
+    embeddings = np.asarray(index.reconstruct_n(0, index.ntotal), dtype="float32") if index.ntotal > 0 else None
+    return embeddings, metadata
+
+
+def migrate(legacy_dir: str, store: VectorStore, delete: bool = False) -> dict:
+    counts = {"users": 0, "bullets": 0, "skipped": 0}
+    for index_file in sorted(glob.glob(os.path.join(legacy_dir, "*.faiss"))):
+        user_prefix = index_file[:-len(".faiss")]
+        user_id = memory_id(user_prefix)
+        # The shard files of the store itself live in the same directory
+        if user_id.startswith("shard_") or not os.path.exists(user_prefix + ".json"):
+            continue
+        if store.has_user(user_id):
+            counts["skipped"] += 1
+            continue
+        embeddings, metadata = load_legacy(user_prefix)
+        vectors = 0 if embeddings is None else len(embeddings)
+        if vectors != len(metadata):
+            print(f"{user_prefix}: {vectors} vectors but {len(metadata)} metadata entries, skipping")
+            counts["skipped"] += 1
+            continue
+        if vectors > 0:
+            store.add(user_id, embeddings, metadata)
+        counts["users"] += 1
+        counts["bullets"] += vectors
+        if delete:
+            os.remove(index_file)
+            os.remove(user_prefix + ".json")
+    index_manager.flush()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--legacy_dir", type=str, default=DEFAULT_STORAGE_DIR)
+    parser.add_argument("--storage_dir", type=str, default=DEFAULT_STORAGE_DIR)
+    parser.add_argument("--num_shards", type=int, default=16)
+    parser.add_argument("--delete", action="store_true", help="Remove the per-user files once imported")
+    args = parser.parse_args()
+
+    counts = migrate(args.legacy_dir, VectorStore(args.storage_dir, num_shards=args.num_shards), delete=args.delete)
+    print(f"Imported {counts['bullets']} bullets of {counts['users']} users, skipped {counts['skipped']} users")
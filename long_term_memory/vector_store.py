@@ -0,0 +1,388 @@
+import faiss
+import numpy as np
+from typing import List, Dict, Any, Tuple, Callable, Optional
+import os
+import time
+import atexit
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+
+DEFAULT_STORAGE_DIR = os.path.join(__location__, "storage")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bullets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    session_date TEXT,
+    text TEXT NOT NULL,
+    embedding BLOB
+);
+CREATE INDEX IF NOT EXISTS bullets_by_user ON bullets (user_id, id);
+CREATE INDEX IF NOT EXISTS bullets_by_shard ON bullets (shard, id);
+"""
+
+
+# Unit-length float32 copy of the vectors, so that inner products are cosine similarities
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.array(embeddings, dtype="float32", copy=True).reshape(len(embeddings), -1)
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+# ----------------------
+# Index Shard
+# ----------------------
+class FaissShard:
+    """
+    One shard of the shared index. Vectors are stored under the id of their row in the
+    bullets table, so a search can be restricted to the rows of one user.
+    Vectors and queries are L2-normalized, so search scores are cosine similarities
+    in [-1, 1] where higher means more similar.
+
+    A shard starts as a flat (exact) index and can be promoted to an IVF or HNSW layout
+    once it grows large. Users with few bullets are always scored exactly against their
+    own vectors; the approximate layouts only serve users with more than `exact_limit`.
+
+    Ids are only ever added in increasing order, so the shard holds exactly the rows of
+    its table up to `max_id`.
+    """
+    def __init__(self, index_file: str, dimension: int = 0):
+        self.index_file = index_file
+        if os.path.exists(index_file):
+            self.index = faiss.read_index(index_file)
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        ids = faiss.vector_to_array(self.index.id_map)
+        self.max_id = int(ids.max()) if len(ids) else 0
+        # Guards the index against a write-back running while it is searched or extended
+        self.lock = threading.RLock()
+        self.promoting = False
+
+    def add(self, embeddings: np.ndarray, ids: np.ndarray):
+        with self.lock:
+            if self.index.ntotal == 0 and self.index.d != embeddings.shape[1]:
+                # A new shard takes the dimension of its first vectors
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(embeddings.shape[1]))
+            self.index.add_with_ids(normalize(embeddings), ids)
+            self.max_id = max(self.max_id, int(ids.max()))
+
+    def layout(self) -> str:
+        inner = faiss.downcast_index(self.index.index)
+        if isinstance(inner, faiss.IndexIVF):
+            return "ivf"
+        if isinstance(inner, faiss.IndexHNSW):
+            return "hnsw"
+        return "flat"
+
+    def promote(self, layout: str, hnsw_m: int = 32):
+        """
+        Rebuild the shard with an approximate layout ("ivf" or "hnsw").
+        IVF centroids are trained on the vectors already in the shard. The new index is
+        built without holding the lock, so the shard stays searchable in the meantime.
+        """
+        with self.lock:
+            if self.promoting or self.layout() != "flat":
+                return
+            self.promoting = True
+            n, d = self.index.ntotal, self.index.d
+            vectors = self.index.index.reconstruct_n(0, n)
+            ids = faiss.vector_to_array(self.index.id_map)
+        try:
+            if layout == "ivf":
+                # ~4 sqrt(n) lists, with enough training points per centroid
+                nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+                inner = faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, nlist, faiss.METRIC_INNER_PRODUCT)
+                inner.train(vectors)
+                # Needed to look vectors up by id for the exact search of small users
+                inner.make_direct_map()
+            elif layout == "hnsw":
+                inner = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            else:
+                raise ValueError(f"Unknown index layout: {layout}")
+            index = faiss.IndexIDMap2(inner)
+            index.add_with_ids(vectors, ids)
+            with self.lock:
+                # Catch up with the vectors added while the new index was built
+                if self.index.ntotal > n:
+                    index.add_with_ids(self.index.index.reconstruct_n(n, self.index.ntotal - n),
+                                       faiss.vector_to_array(self.index.id_map)[n:])
+                self.index = index
+        finally:
+            self.promoting = False
+
+    def search(self, query_embedding: np.ndarray, ids: Optional[np.ndarray], top_k: int,
+               nprobe: int = 16, ef_search: int = 64, exact_limit: int = 1024) -> List[Tuple[int, float]]:
+        """
+        Search only among the vectors with the given ids (all vectors if ids is None).
+        Returns (id, cosine similarity) pairs.
+        nprobe / ef_search: search breadth of the IVF / HNSW layouts.
+        exact_limit: up to this many ids, the ids' vectors are scored exactly instead.
+        """
+        query = normalize(query_embedding)
+        top_k = min(top_k, self.index.ntotal if ids is None else len(ids))
+        with self.lock:
+            if ids is not None and len(ids) <= exact_limit:
+                try:
+                    scores = self.index.reconstruct_batch(ids) @ query[0]
+                    best = np.argsort(-scores)[:top_k]
+                    return [(int(ids[i]), float(scores[i])) for i in best]
+                except RuntimeError:
+                    # Some of the rows have no vector in this shard (rows stored before the
+                    # table kept their embeddings); the filtered search below skips them
+                    pass
+            sel = faiss.IDSelectorBatch(ids) if ids is not None else None
+            layout = self.layout()
+            if layout == "ivf":
+                params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe)
+            elif layout == "hnsw":
+                params = faiss.SearchParametersHNSW(sel=sel, efSearch=ef_search)
+            else:
+                params = faiss.SearchParameters(sel=sel)
+            scores, indices = self.index.search(query, top_k, params=params)
+        return [(int(idx), float(score)) for score, idx in zip(scores[0], indices[0]) if idx >= 0]
+
+    def save(self):
+        with self.lock:
+            # Other worker processes may write the same shard back at the same time
+            tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+            faiss.write_index(self.index, tmp_file)
+            os.replace(tmp_file, self.index_file)
+
+    def nbytes(self) -> int:
+        """
+        Approximate resident size: the raw vectors plus their ids (and the graph links of HNSW).
+        """
+        per_vector = self.index.d * 4 + 8
+        if self.layout() == "hnsw":
+            per_vector += faiss.downcast_index(self.index.index).hnsw.nb_neighbors(0) * 4
+        return self.index.ntotal * per_vector
+
+
+# ----------------------
+# Index Manager
+# ----------------------
+class FaissIndexManager:
+    """
+    Process-wide LRU of loaded index shards, so retrievals and session updates
+    do not re-read the index from disk every time.
+
+    Shards changed in memory are marked dirty and written back by a background thread
+    every `flush_interval` seconds, when they are evicted, and at interpreter shutdown.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, flush_interval: float = 60.0):
+        """
+        max_bytes: memory budget for resident shards; least recently used ones are evicted beyond it.
+        flush_interval: seconds between write-backs of dirty shards; 0 only writes back on eviction and shutdown.
+        """
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._indexes = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._flusher = None
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "writebacks": 0}
+
+    def get(self, key: str, load: Callable[[], FaissShard]) -> FaissShard:
+        with self._lock:
+            faiss_idx = self._indexes.get(key)
+            if faiss_idx is not None:
+                self._indexes.move_to_end(key)
+                self._stats["hits"] += 1
+                return faiss_idx
+            self._stats["misses"] += 1
+            faiss_idx = load()
+            self._indexes[key] = faiss_idx
+            self._evict(keep=key)
+            return faiss_idx
+
+    def mark_dirty(self, key: str):
+        with self._lock:
+            self._dirty.add(key)
+            self._evict(keep=key)
+            self._start_flusher()
+
+    def flush(self):
+        """
+        Write every dirty shard back to disk.
+        """
+        with self._lock:
+            dirty = [(k, self._indexes[k]) for k in self._dirty if k in self._indexes]
+            self._dirty.clear()
+        for _, faiss_idx in dirty:
+            faiss_idx.save()
+        with self._lock:
+            self._stats["writebacks"] += len(dirty)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["resident"] = len(self._indexes)
+            stats["dirty"] = len(self._dirty)
+            stats["resident_bytes"] = sum(f.nbytes() for f in self._indexes.values())
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+    def _evict(self, keep: str):
+        # Called with the lock held; the shard just used is never evicted
+        total = sum(f.nbytes() for f in self._indexes.values())
+        while total > self.max_bytes and len(self._indexes) > 1:
+            key = next(iter(self._indexes))
+            if key == keep:
+                self._indexes.move_to_end(keep)
+                continue
+            faiss_idx = self._indexes.pop(key)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                faiss_idx.save()
+                self._stats["writebacks"] += 1
+            total -= faiss_idx.nbytes()
+            self._stats["evictions"] += 1
+
+    def _start_flusher(self):
+        if self._flusher is not None or self.flush_interval <= 0:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name="faiss-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"faiss write-back error: {e}")
+
+
+index_manager = FaissIndexManager(max_bytes=int(os.environ.get("FAISS_CACHE_BYTES", 256 * 1024 * 1024)),
+                                  flush_interval=float(os.environ.get("FAISS_FLUSH_INTERVAL", 60)))
+atexit.register(index_manager.flush)
+
+
+# ----------------------
+# Shared Vector Store
+# ----------------------
+class VectorStore:
+    """
+    Long-term memory of all users in a fixed number of FAISS shards plus one SQLite table.
+
+    Every user is assigned to a shard by a stable hash of their id. The bullet texts and
+    dates live in the bullets table, indexed by user, and the row id doubles as the vector
+    id in the shard, so retrieving for a user is a search restricted to that user's ids.
+
+    The table also keeps each bullet's normalized embedding and is the durable copy of the
+    shards: before a shard is used it is caught up with the rows added since it was loaded,
+    whichever process added them. Several processes (e.g. gunicorn workers) can therefore
+    share one store, each with its own cached shards, and the shard files written back by
+    any of them are only a faster starting point.
+    """
+    def __init__(self, storage_dir: str = DEFAULT_STORAGE_DIR, num_shards: int = 16,
+                 ann_layout: str = "ivf", promote_size: int = 50000, nprobe: int = 16, ef_search: int = 64,
+                 exact_limit: int = 1024):
+        """
+        storage_dir: directory holding bullets.db and the shard_<n>.faiss files.
+        num_shards: number of shards; must stay the same for an existing store.
+        ann_layout: "ivf" or "hnsw" layout a shard is promoted to, or None to keep every shard flat.
+        promote_size: number of vectors at which a flat shard is promoted.
+        nprobe / ef_search: search breadth of promoted IVF / HNSW shards.
+        exact_limit: users with at most this many bullets are always scored exactly.
+        """
+        os.makedirs(storage_dir, exist_ok=True)
+        self.storage_dir = storage_dir
+        self.num_shards = num_shards
+        self.ann_layout = ann_layout
+        self.promote_size = promote_size
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.exact_limit = exact_limit
+        self.db_path = os.path.join(storage_dir, "bullets.db")
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        if "embedding" not in [row[1] for row in conn.execute("PRAGMA table_info(bullets)")]:
+            conn.execute("ALTER TABLE bullets ADD COLUMN embedding BLOB")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads.
+        # A connection inherited through fork belongs to the parent: it is kept, unused and open
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            self._local.inherited = conn
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def shard_of(self, user_id: str) -> int:
+        return zlib.crc32(user_id.encode("utf-8")) % self.num_shards
+
+    def _shard(self, shard: int) -> FaissShard:
+        """
+        The cached shard, caught up with the rows added to the table since it was loaded.
+        """
+        index_file = os.path.join(self.storage_dir, f"shard_{shard}.faiss")
+        faiss_shard = index_manager.get(index_file, lambda: FaissShard(index_file))
+        with faiss_shard.lock:
+            rows = self._conn().execute("SELECT id, embedding FROM bullets WHERE shard = ? AND id > ? "
+                                        "AND embedding IS NOT NULL ORDER BY id", (shard, faiss_shard.max_id)).fetchall()
+            if rows:
+                faiss_shard.add(np.stack([np.frombuffer(r[1], dtype="float32") for r in rows]),
+                                np.array([r[0] for r in rows], dtype="int64"))
+        if rows:
+            index_manager.mark_dirty(index_file)
+        return faiss_shard
+
+    def add(self, user_id: str, embeddings: np.ndarray, bullets: List[Dict[str, Any]]):
+        """
+        Store the bullets of a user with their embeddings.
+        """
+        shard = self.shard_of(user_id)
+        vectors = normalize(embeddings)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for b, vector in zip(bullets, vectors):
+                conn.execute("INSERT INTO bullets (user_id, shard, session_date, text, embedding) VALUES (?, ?, ?, ?, ?)",
+                             (user_id, shard, b.get("session_date"), b["text"], vector.tobytes()))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        # Catching up adds the new rows along with any other process's
+        faiss_shard = self._shard(shard)
+        if self.ann_layout and faiss_shard.layout() == "flat" and faiss_shard.index.ntotal >= self.promote_size:
+            faiss_shard.promote(self.ann_layout)
+
+    def search(self, user_id: str, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[Dict[str, Any], float]]:
+        """
+        Retrieve the top_k bullets of a user closest to the query, with their cosine similarities.
+        """
+        conn = self._conn()
+        ids = [r[0] for r in conn.execute("SELECT id FROM bullets WHERE user_id = ?", (user_id,))]
+        if not ids:
+            return []
+        hits = self._shard(self.shard_of(user_id)).search(query_embedding, np.array(ids, dtype="int64"), top_k,
+                                                          nprobe=self.nprobe, ef_search=self.ef_search,
+                                                          exact_limit=self.exact_limit)
+        results = []
+        for idx, score in hits:
+            row = conn.execute("SELECT session_date, text FROM bullets WHERE id = ?", (idx,)).fetchone()
+            results.append(({"session_date": row[0], "text": row[1]}, score))
+        return results
+
+    def has_user(self, user_id: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM bullets WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+
+vector_store = VectorStore(storage_dir=os.environ.get("VECTOR_STORE_DIR", DEFAULT_STORAGE_DIR),
+                           num_shards=int(os.environ.get("VECTOR_STORE_SHARDS", 16)),
+                           ann_layout=os.environ.get("VECTOR_STORE_ANN", "ivf") or None,
+                           promote_size=int(os.environ.get("VECTOR_STORE_PROMOTE_SIZE", 50000)),
+                           nprobe=int(os.environ.get("VECTOR_STORE_NPROBE", 16)),
+                           ef_search=int(os.environ.get("VECTOR_STORE_EF_SEARCH", 64)))
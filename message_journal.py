@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+
+
+# Append-only journal for the per-user message logs.
+#
+# Every change to the message logs is written as one JSON line instead of
+# re-serializing the whole dictionary, so a write costs O(message size).
+# Every `snapshot_every` records the in-memory logs are written to a compacted
+# snapshot and the journal is truncated. On startup the snapshot is loaded and
+# the journal records after it are replayed.
+#
+# Record ops:
+#   append        add `message` to `session` of `phone_number`
+#   pop           drop the last message of `session`
+#   replace_last  overwrite the content of the last message of `session`
+#   archive       move "current_session" to `session` and start a new one
+class MessageJournal:
+    def __init__(self,
+                 journal_path: str = "message_journal.jsonl",
+                 snapshot_path: str = "message_snapshot.json",
+                 legacy_path: str = "message_logs.json",
+                 snapshot_every: int = 1000,
+                 fsync: bool = False):
+        """
+        journal_path: file the per-message records are appended to.
+        snapshot_path: compacted snapshot, stored as {"seq": ..., "logs": ...}.
+        legacy_path: old whole-file message log, imported if there is no snapshot yet.
+        snapshot_every: number of journal records after which the logs are compacted.
+        fsync: fsync the journal after every record instead of only flushing it.
+        """
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.legacy_path = legacy_path
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.logs = {}
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self._lock = threading.RLock()
+        self._journal_file = None
+
+    def load(self) -> dict:
+        """
+        Rebuild the message logs from the latest snapshot plus the journal tail.
+        Returns the live dictionary; later journal operations mutate it in place.
+        """
+        with self._lock:
+            snapshot_seq = 0
+            if os.path.exists(self.snapshot_path):
+                snapshot = json.load(open(self.snapshot_path))
+                snapshot_seq = snapshot["seq"]
+                logs = snapshot["logs"]
+            elif self.legacy_path and os.path.exists(self.legacy_path):
+                logs = json.load(open(self.legacy_path))
+            else:
+                logs = {}
+            self.seq = snapshot_seq
+            self.records_since_snapshot = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path) as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # A torn final line from a crash mid-write; everything before it is intact
+                            break
+                        # Records already folded into the snapshot are skipped
+                        if record["seq"] <= snapshot_seq:
+                            continue
+                        _apply(logs, record)
+                        self.seq = record["seq"]
+                        self.records_since_snapshot += 1
+            # Keep the same object so that references handed out earlier stay valid
+            self.logs.clear()
+            self.logs.update(logs)
+            return self.logs
+
+    def append(self, phone_number: str, session: str, message: dict):
+        self._write({"op": "append", "phone_number": phone_number, "session": session, "message": message})
+
+    def pop(self, phone_number: str, session: str = "current_session"):
+        self._write({"op": "pop", "phone_number": phone_number, "session": session})
+
+    def replace_last(self, phone_number: str, content: str, session: str = "current_session"):
+        self._write({"op": "replace_last", "phone_number": phone_number, "session": session, "content": content})
+
+    def archive(self, phone_number: str, session: str):
+        self._write({"op": "archive", "phone_number": phone_number, "session": session})
+
+    def reset(self):
+        with self._lock:
+            self.logs.clear()
+            self.compact()
+
+    def compact(self):
+        """
+        Write the current logs to the snapshot and truncate the journal.
+        The snapshot carries the last sequence number, so a crash between the two
+        steps only leaves records that are skipped on the next load.
+        """
+        with self._lock:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w+") as f:
+                json.dump({"seq": self.seq, "logs": self.logs}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if self._journal_file is not None:
+                self._journal_file.close()
+            self._journal_file = open(self.journal_path, "w+")
+            self.records_since_snapshot = 0
+
+    def close(self):
+        with self._lock:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+    def _write(self, record: dict):
+        with self._lock:
+            self.seq += 1
+            record["seq"] = self.seq
+            _apply(self.logs, record)
+            if self._journal_file is None:
+                self._journal_file = open(self.journal_path, "a+")
+            self._journal_file.write(json.dumps(record) + "\n")
+            self._journal_file.flush()
+            if self.fsync:
+                os.fsync(self._journal_file.fileno())
+            self.records_since_snapshot += 1
+            if self.records_since_snapshot >= self.snapshot_every:
+                self.compact()
+
+
+def _apply(logs: dict, record: dict):
+    op = record["op"]
+    phone_number = record["phone_number"]
+    session = record["session"]
+    if op == "append":
+        if phone_number not in logs:
+            logs[phone_number] = {"current_session": []}
+        logs[phone_number].setdefault(session, []).append(record["message"])
+    elif op == "pop":
+        logs[phone_number][session].pop()
+    elif op == "replace_last":
+        logs[phone_number][session][-1]["content"] = record["content"]
+    elif op == "archive":
+        logs[phone_number][session] = logs[phone_number]["current_session"]
+        logs[phone_number]["current_session"] = []
@@ -1,6 +1,22 @@
-import requests
 from argparse import ArgumentParser
-import json
+from state_store import StateStore
+from http_transport import http_transport
+
+APP_URL = "http://127.0.0.1:5000"
+
+
+# Ask the app to summarize the user's current session
+def summarize(user_number, app_url=APP_URL):
+    http_transport.session.get(f"{app_url}/summarize", params={"phone_number": user_number}, timeout=600).raise_for_status()
+
+
+# Send the user's stored webhook payload back to the app as a "PING USER" message
+def ping(user_number, app_url=APP_URL, state_store=None):
+    template = (state_store or StateStore()).get_template(user_number)
+    template["entry"][0]["changes"][0]["value"]["messages"][0]["text"]["body"] = "PING USER"
+    template["entry"][0]["changes"][0]["value"]["messages"] = [template["entry"][0]["changes"][0]["value"]["messages"][0]]
+    http_transport.session.post(f"{app_url}/webhook", json=template, timeout=600).raise_for_status()
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -11,10 +27,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     if args.summarize:
-        requests.get(f"http://127.0.0.1:5000/summarize?phone_number={args.user_number}")
+        summarize(args.user_number)
     else:
-        user_template_dict = json.load(open("user_templates.json"))
-        template = user_template_dict[args.user_number]
-        template["entry"][0]["changes"][0]["value"]["messages"][0]["text"]["body"] = "PING USER"
-        template["entry"][0]["changes"][0]["value"]["messages"] = [template["entry"][0]["changes"][0]["value"]["messages"][0]]
-        requests.post(f"http://127.0.0.1:5000/webhook", json=template)
\ No newline at end of file
+        ping(args.user_number)
\ No newline at end of file
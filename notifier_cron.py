@@ -1,55 +1,81 @@
-import requests
 from argparse import ArgumentParser
 import json
 import os
 import sys
 from datetime import datetime
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from state_store import StateStore, DEFAULT_DB_PATH
+from notifier_scheduler import DueJobScheduler
+import notifier
 
 __location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
+
+# Summarize the session of a due user, then ping them through the webhook
+def notify(state_store, app_url, phone_number, due_at):
+    print("Notifying:", phone_number, "due", datetime.fromtimestamp(due_at))
+    if state_store.get_template(phone_number) is None:
+        raise ValueError(f"no webhook template stored for {phone_number}")
+    # /summarize only answers once the session is summarized
+    notifier.summarize(phone_number, app_url=app_url)
+    notifier.ping(phone_number, app_url=app_url, state_store=state_store)
+    state_store.mark_job_done(phone_number, due_at)
+
+
+# Serve the scheduler metrics as JSON on http://127.0.0.1:<port>/metrics
+def serve_metrics(scheduler, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = json.dumps(scheduler.metrics()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="notifier-metrics", daemon=True).start()
+    return server
+
+
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--app_url", type=str, default="http://127.0.0.1:5000")
+    parser.add_argument("--workers", type=int, default=8, help="Users notified at once")
+    parser.add_argument("--poll_interval", type=float, default=1.0,
+                        help="Seconds between checks of the state store for new or moved jobs")
+    parser.add_argument("--retry_delay", type=float, default=60.0)
+    parser.add_argument("--metrics_interval", type=float, default=300.0, help="Seconds between metrics log lines")
+    parser.add_argument("--metrics_port", type=int, default=0, help="Serve /metrics on this port; 0 disables it")
+    args = parser.parse_args()
+
+    # Shared with the webhook app; WAL mode lets us read while it writes
+    state_store = StateStore(os.path.join(__location__, DEFAULT_DB_PATH), legacy_dir=__location__)
+    scheduler = DueJobScheduler(lambda u, due_at: notify(state_store, args.app_url, u, due_at),
+                                num_workers=args.workers, retry_delay=args.retry_delay)
+    if args.metrics_port:
+        serve_metrics(scheduler, args.metrics_port)
+
+    # The jobs table is the durable copy of the schedule. Due times are kept in the scheduler's
+    # heap and only re-read when the app has committed something to the store since the last
+    # check (PRAGMA data_version), which costs next to nothing when nothing changed.
+    last_version = None
+    last_metrics = time.monotonic()
     while True:
-        print("Current time", datetime.now().timestamp())
-        if not os.path.exists(os.path.join(__location__, "user_job_dict.json")):
-            json.dump({}, open(os.path.join(__location__, "user_job_dict.json"), "w+"))
-        user_job_dict = json.load(open(os.path.join(__location__, "user_job_dict.json")))
-        if os.path.exists(os.path.join(__location__, "done_ping_dict.json")):
-            done_dict = json.load(open(os.path.join(__location__, "done_ping_dict.json")))
-        else:
-            done_dict = {}
-
-        # If it is within 5 minutes of the job
-
-        for u in user_job_dict:
-            # Summarize then ping
-            curr_time = datetime.now().timestamp()
-            if user_job_dict[u] != -1 and user_job_dict[u] <= curr_time and (u not in done_dict or done_dict[u] != user_job_dict[u]):
-                print("Notifying:", u)
-                resp = requests.get(f"http://127.0.0.1:5000/summarize?phone_number={u}")
-                time.sleep(60)
-                user_template_dict = json.load(open(os.path.join(__location__, "user_templates.json")))
-                template = user_template_dict[u]
-                template["entry"][0]["changes"][0]["value"]["messages"][0]["text"]["body"] = "PING USER"
-                template["entry"][0]["changes"][0]["value"]["messages"] = [template["entry"][0]["changes"][0]["value"]["messages"][0]]
-                resp = requests.post(f"http://127.0.0.1:5000/webhook", json=template)
-                done_dict[u] = user_job_dict[u]
-                json.dump(done_dict, open(os.path.join(__location__, "done_ping_dict.json"), "w+"))
-        time.sleep(300)
-
-        # parser = ArgumentParser()
-        # parser.add_argument("--summarize", action="store_true")
-        # parser.add_argument("--ping", action="store_true")
-        # parser.add_argument("--user_number", type=str)
-
-        # args = parser.parse_args()
-        
-        # if args.summarize:
-        #     requests.get(f"http://127.0.0.1:5000/summarize?phone_number={args.user_number}")
-        # else:
-        #     user_template_dict = json.load(open("user_templates.json"))
-        #     template = user_template_dict[args.user_number]
-        #     template["entry"][0]["changes"][0]["value"]["messages"][0]["text"]["body"] = "PING USER"
-        #     template["entry"][0]["changes"][0]["value"]["messages"] = [template["entry"][0]["changes"][0]["value"]["messages"][0]]
-        #     requests.post(f"http://127.0.0.1:5000/webhook", json=template)
+        version = state_store.data_version()
+        if version != last_version:
+            last_version = version
+            scheduler.sync(state_store.pending_jobs())
+        if time.monotonic() - last_metrics >= args.metrics_interval:
+            last_metrics = time.monotonic()
+            print("Current time", datetime.now().timestamp(), "notifier metrics:", scheduler.metrics())
+        time.sleep(args.poll_interval)
@@ -0,0 +1,180 @@
+import heapq
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Iterable, Optional, Tuple
+
+
+class DueJobScheduler:
+    """
+    Runs one job per key at its due time (a Unix timestamp).
+
+    Due times sit in a min-heap, and a single timer thread sleeps until the earliest one
+    (or until a job is added or moved), so jobs start on time instead of at the next poll.
+    Due jobs run on a bounded pool of `num_workers` threads. A job that raises is retried
+    after `retry_delay` seconds, up to `max_attempts` times. Scheduling is O(log n);
+    cancelling is O(1) (the heap entry is dropped lazily). Jobs of the same key never
+    run at the same time.
+
+    The scheduler itself keeps no state on disk: the caller persists the jobs (e.g. the
+    jobs table of the state store) and re-adds them on start with `sync`.
+    """
+
+    def __init__(self, run: Callable[[Hashable, float], None], num_workers: int = 8,
+                 retry_delay: float = 60.0, max_attempts: int = 3,
+                 on_give_up: Optional[Callable[[Hashable, float], None]] = None):
+        """
+        run: called with (key, due_at) on a worker thread when a job is due.
+        num_workers: maximum number of jobs running at once.
+        retry_delay: seconds before a failed job is retried.
+        max_attempts: number of times a job is tried before it is given up.
+        on_give_up: called with (key, due_at) when a job has failed for the last time.
+        """
+        self.run = run
+        self.on_give_up = on_give_up
+        self.num_workers = num_workers
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="notifier-job")
+        self._cond = threading.Condition()
+        # key -> (run_at, due_at) of its pending job, plus a heap of (run_at, key, due_at) that may
+        # hold stale entries. run_at is due_at, or later for a retry.
+        self._pending = {}
+        self._heap = []
+        # key -> due time of the job that is queued for or running on a worker
+        self._running = {}
+        # key -> due time of the last job that finished, so a sync racing with the
+        # caller's bookkeeping does not run it again
+        self._finished = {}
+        self._attempts = {}
+        self._thread = None
+        self._stats = {"scheduled": 0, "cancelled": 0, "started": 0, "completed": 0, "failed": 0,
+                       "retried": 0, "max_lag_seconds": 0.0, "last_lag_seconds": 0.0, "total_lag_seconds": 0.0}
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._timer, name="notifier-timer", daemon=True)
+                self._thread.start()
+
+    def schedule(self, key: Hashable, due_at: float):
+        """
+        Add a job, or move the pending job of `key` to `due_at`.
+        """
+        self.start()
+        with self._cond:
+            pending = self._pending.get(key)
+            if (pending is not None and pending[1] == due_at) or self._running.get(key) == due_at \
+                    or self._finished.get(key) == due_at:
+                return
+            self._attempts.pop(key, None)
+            self._push(key, due_at, due_at)
+            self._stats["scheduled"] += 1
+
+    def cancel(self, key: Hashable):
+        with self._cond:
+            if self._pending.pop(key, None) is not None:
+                self._attempts.pop(key, None)
+                self._stats["cancelled"] += 1
+
+    def sync(self, jobs: Iterable[Tuple[Hashable, float]]):
+        """
+        Make the pending jobs match `jobs`, the (key, due_at) pairs that should be pending.
+        """
+        jobs = dict(jobs)
+        with self._cond:
+            stale = [key for key in self._pending if key not in jobs]
+        for key in stale:
+            self.cancel(key)
+        for key, due_at in jobs.items():
+            self.schedule(key, due_at)
+
+    def metrics(self) -> dict:
+        now = time.time()
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._pending)
+            stats["running"] = len(self._running)
+            # Jobs past their time that have not started yet
+            stats["overdue"] = sum(1 for run_at, _ in self._pending.values() if run_at <= now)
+            next_run = min(run_at for run_at, _ in self._pending.values()) if self._pending else None
+        total_lag = stats.pop("total_lag_seconds")
+        stats.update({
+            "workers": self.num_workers,
+            "avg_lag_seconds": total_lag / stats["started"] if stats["started"] else 0.0,
+            "next_due_in_seconds": None if next_run is None else max(0.0, next_run - now)
+        })
+        return stats
+
+    def _push(self, key: Hashable, run_at: float, due_at: float):
+        # Called with the lock held
+        self._pending[key] = (run_at, due_at)
+        heapq.heappush(self._heap, (run_at, key, due_at))
+        # Only wake the timer if this job is now the earliest
+        if self._heap[0] == (run_at, key, due_at):
+            self._cond.notify()
+
+    def _next_run(self) -> Optional[float]:
+        # Called with the lock held; drops heap entries that were cancelled or moved, and entries
+        # of keys whose previous job is still running (they are pushed again when it finishes)
+        while self._heap:
+            run_at, key, due_at = self._heap[0]
+            if self._pending.get(key) == (run_at, due_at) and key not in self._running:
+                return run_at
+            heapq.heappop(self._heap)
+        return None
+
+    def _timer(self):
+        while True:
+            with self._cond:
+                while True:
+                    run_at = self._next_run()
+                    if run_at is None:
+                        self._cond.wait()
+                        continue
+                    wait = run_at - time.time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                _, key, due_at = heapq.heappop(self._heap)
+                del self._pending[key]
+                self._running[key] = due_at
+                lag = time.time() - run_at
+                self._stats["started"] += 1
+                self._stats["last_lag_seconds"] = lag
+                self._stats["total_lag_seconds"] += lag
+                self._stats["max_lag_seconds"] = max(self._stats["max_lag_seconds"], lag)
+            self._executor.submit(self._run_job, key, due_at)
+
+    def _run_job(self, key: Hashable, due_at: float):
+        try:
+            self.run(key, due_at)
+            failed = False
+        except Exception:
+            print(f"notifier job for {key} failed:")
+            traceback.print_exc()
+            failed = True
+        gave_up = False
+        with self._cond:
+            del self._running[key]
+            if failed:
+                self._stats["failed"] += 1
+                attempts = self._attempts.get(key, 0) + 1
+                # Retry unless the job has been moved in the meantime
+                if attempts < self.max_attempts and key not in self._pending:
+                    self._attempts[key] = attempts
+                    self._stats["retried"] += 1
+                    self._push(key, time.time() + self.retry_delay, due_at)
+                    return
+                gave_up = key not in self._pending
+            else:
+                self._stats["completed"] += 1
+            self._attempts.pop(key, None)
+            self._finished[key] = due_at
+            if key in self._pending:
+                # Moved while it was running; its heap entry was dropped in the meantime
+                run_at, pending_due = self._pending[key]
+                self._push(key, run_at, pending_due)
+        if gave_up and self.on_give_up is not None:
+            self.on_give_up(key, due_at)
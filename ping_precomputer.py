@@ -0,0 +1,86 @@
+import heapq
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+
+class PingPrecomputer:
+    """
+    Prepares each user's next check-in ping once their session has gone quiet.
+
+    `touch` is called after every turn and (re)starts the user's idle timer. When no new
+    turn has arrived for `idle_seconds`, `precompute` runs for that user on one of
+    `num_workers` background threads. `precompute` stores its result itself (the state
+    store's precomputed_pings table); the button handler then only has to check that the
+    conversation has not changed since and use it.
+    """
+
+    def __init__(self, precompute: Callable[[str], None], idle_seconds: float = 300.0, num_workers: int = 2):
+        """
+        precompute: prepares and stores the ping of a user; called with the phone number.
+        idle_seconds: seconds without a new turn after which the ping is prepared.
+        num_workers: number of pings prepared at once.
+        """
+        self.precompute = precompute
+        self.idle_seconds = idle_seconds
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="ping-precompute")
+        self._cond = threading.Condition()
+        # phone number -> due time, plus a heap of (due time, phone number) that may hold stale entries
+        self._due = {}
+        self._heap = []
+        self._thread = None
+        self._stats = {"scheduled": 0, "precomputed": 0, "failed": 0}
+
+    def touch(self, phone_number: str):
+        if self.idle_seconds < 0:
+            return
+        due = time.monotonic() + self.idle_seconds
+        with self._cond:
+            self._due[phone_number] = due
+            heapq.heappush(self._heap, (due, phone_number))
+            self._stats["scheduled"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ping-idle-timer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def cancel(self, phone_number: str):
+        with self._cond:
+            self._due.pop(phone_number, None)
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["waiting"] = len(self._due)
+        return stats
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # Drop entries superseded by a later touch or a cancel
+                    while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                _, phone_number = heapq.heappop(self._heap)
+                del self._due[phone_number]
+            self._executor.submit(self._precompute, phone_number)
+
+    def _precompute(self, phone_number: str):
+        try:
+            self.precompute(phone_number)
+            with self._cond:
+                self._stats["precomputed"] += 1
+        except Exception:
+            with self._cond:
+                self._stats["failed"] += 1
+            print(f"ping precompute error for {phone_number}:")
+            traceback.print_exc()
@@ -0,0 +1,107 @@
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# Cold-start profile of an app module, in the style of `python -X importtime`.
+# Imports the module in a fresh interpreter (eagerly and with LAZY_STARTUP=1), then reports
+# the wall time of the import and the packages that took longest to import.
+# Run from the repository root:
+#   python profile_startup.py                                   # app_official, both modes
+#   python profile_startup.py --module app_interactive --top 30
+#   python profile_startup.py --output startup.json             # save a baseline
+#   python profile_startup.py --baseline startup.json           # exit 1 if startup got >20% slower
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+
+PROBE = """
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+sys.stderr.write("startup wall time: %f\\n" % (time.perf_counter() - start))
+"""
+
+
+def parse_importtime(stderr: str) -> dict:
+    """
+    Returns {"wall_seconds", "imports": [{"module", "self_ms", "cumulative_ms", "depth"}]}.
+    """
+    imports, wall = [], None
+    for line in stderr.splitlines():
+        if line.startswith("startup wall time:"):
+            wall = float(line.split(":")[1])
+            continue
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append({"module": name.strip(), "self_ms": int(self_us) / 1000,
+                        "cumulative_ms": int(cumulative_us) / 1000,
+                        "depth": (len(name) - len(name.lstrip())) // 2})
+    return {"wall_seconds": wall, "imports": imports}
+
+
+def profile(module: str, lazy: bool) -> dict:
+    env = dict(os.environ, LAZY_STARTUP="1" if lazy else "0")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE.format(root=__location__, module=module)],
+                            cwd=__location__, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    report = parse_importtime(result.stderr)
+    report.update({"module": module, "lazy": lazy})
+    return report
+
+
+def top_level(report: dict, top: int) -> list:
+    # Direct imports of the app module (depth 1), the slowest first
+    direct = [i for i in report["imports"] if i["depth"] == 1]
+    return sorted(direct, key=lambda i: -i["cumulative_ms"])[:top]
+
+
+def slowest_packages(report: dict, top: int) -> list:
+    # Slowest top-level packages wherever they were first imported
+    packages = {}
+    for i in report["imports"]:
+        if "." not in i["module"]:
+            packages[i["module"]] = max(packages.get(i["module"], 0.0), i["cumulative_ms"])
+    return sorted(packages.items(), key=lambda p: -p[1])[:top]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--module", type=str, default="app_official")
+    parser.add_argument("--mode", type=str, default="both", choices=["eager", "lazy", "both"])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None, help="Report saved with --output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown over the baseline")
+    args = parser.parse_args()
+
+    modes = {"eager": [False], "lazy": [True], "both": [False, True]}[args.mode]
+    reports = [profile(args.module, lazy) for lazy in modes]
+
+    for report in reports:
+        print(f"\n{report['module']} ({'LAZY_STARTUP=1' if report['lazy'] else 'eager'}): "
+              f"{report['wall_seconds']:.2f}s")
+        print(f"  {'direct import':<40}{'cumulative ms':>15}")
+        for i in top_level(report, args.top):
+            print(f"  {i['module']:<40}{i['cumulative_ms']:>15.1f}")
+        print(f"  {'slowest packages':<40}{'cumulative ms':>15}")
+        for name, ms in slowest_packages(report, args.top):
+            print(f"  {name:<40}{ms:>15.1f}")
+
+    if args.output:
+        json.dump(reports, open(args.output, "w+"), indent=2)
+
+    if args.baseline:
+        baseline = {r["lazy"]: r for r in json.load(open(args.baseline))}
+        regressed = False
+        for report in reports:
+            if report["lazy"] not in baseline:
+                continue
+            before, after = baseline[report["lazy"]]["wall_seconds"], report["wall_seconds"]
+            change = (after - before) / before
+            print(f"{'lazy' if report['lazy'] else 'eager'}: {before:.2f}s -> {after:.2f}s ({change:+.0%})")
+            regressed |= change > args.tolerance
+        sys.exit(1 if regressed else 0)
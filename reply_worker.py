@@ -0,0 +1,196 @@
+import collections
+import heapq
+import threading
+import time
+import traceback
+from typing import Callable, Hashable, List, Optional
+
+
+class ReplyWorkerPool:
+    """
+    Bounded pool of background threads that run the reply pipeline for queued webhook payloads.
+
+    The webhook only validates and enqueues the payload, so Twilio gets its 200 right away;
+    the LLM calls and the outgoing message happen on one of the workers. When the queue is
+    full `submit` refuses the payload so the webhook can ask Twilio to retry later.
+
+    Payloads are submitted under a key (the user's phone number). Each key has its own
+    mailbox: payloads of the same key run one at a time in arrival order, while payloads of
+    different keys run in parallel. A key with a backlog gives up its worker after every
+    payload so that one chatty user cannot hold a worker.
+
+    With a coalesce window, a key only becomes ready once no new payload has arrived for
+    `coalesce_window` seconds (or `coalesce_max_wait` seconds after its oldest pending
+    payload). The worker then takes the whole mailbox and passes it through `merge`, so a
+    burst of short messages is handled as one turn.
+    """
+
+    def __init__(self, handler: Callable[[dict], None], num_workers: int = 4, max_queue: int = 100,
+                 coalesce_window: float = 0.0, coalesce_max_wait: float = 10.0,
+                 merge: Optional[Callable[[List[dict]], List[dict]]] = None):
+        """
+        handler: called with each payload on a worker thread.
+        num_workers: maximum number of payloads processed concurrently.
+        max_queue: maximum number of payloads waiting for a worker, across all keys.
+        coalesce_window: seconds of quiet to wait for before handling a key; 0 disables coalescing.
+        coalesce_max_wait: upper bound on how long the oldest pending payload is held back.
+        merge: turns the pending payloads of a key into the payloads to handle, in order.
+        """
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_wait = coalesce_max_wait
+        self.merge = merge if merge is not None else (lambda payloads: payloads)
+        self._cond = threading.Condition()
+        # key -> deque of (enqueued_at, payload); a key is present while it is queued or running
+        self._mailboxes = {}
+        # keys whose next payload may run
+        self._ready = collections.deque()
+        # keys held back by the coalesce window: key -> due time, plus a heap of (due time, key)
+        self._due = {}
+        self._due_heap = []
+        self._pending = 0
+        self._threads = []
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "coalesced": 0,
+            "busy_workers": 0,
+            "total_wait_seconds": 0.0,
+            "total_run_seconds": 0.0
+        }
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._run, name=f"reply-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, key: Hashable, payload: dict) -> bool:
+        """
+        Queue a payload behind the earlier payloads of the same key. Returns False if the queue is full.
+        """
+        self.start()
+        with self._cond:
+            if self._pending >= self.max_queue:
+                self._stats["rejected"] += 1
+                return False
+            now = time.monotonic()
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                # Nothing queued or running for this key, so it can be scheduled right away
+                mailbox = self._mailboxes[key] = collections.deque()
+                mailbox.append((now, payload))
+                self._schedule(key)
+            else:
+                mailbox.append((now, payload))
+                if key in self._due:
+                    # Still inside the window: push the deadline back
+                    self._schedule(key)
+            self._pending += 1
+            self._stats["submitted"] += 1
+        return True
+
+    def metrics(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._pending
+            stats["active_keys"] = len(self._mailboxes)
+        finished = stats["completed"] + stats["failed"]
+        wait_total = stats.pop("total_wait_seconds")
+        run_total = stats.pop("total_run_seconds")
+        stats.update({
+            "workers": self.num_workers,
+            "max_queue_depth": self.max_queue,
+            "avg_wait_seconds": wait_total / finished if finished else 0.0,
+            "avg_run_seconds": run_total / finished if finished else 0.0
+        })
+        return stats
+
+    def _schedule(self, key: Hashable):
+        # Called with the lock held for a key that is neither ready nor running
+        if self.coalesce_window <= 0:
+            self._ready.append(key)
+            self._cond.notify()
+            return
+        mailbox = self._mailboxes[key]
+        due = min(mailbox[-1][0] + self.coalesce_window, mailbox[0][0] + self.coalesce_max_wait)
+        self._due[key] = due
+        heapq.heappush(self._due_heap, (due, key))
+        self._cond.notify()
+
+    def _promote_due(self) -> Optional[float]:
+        # Move keys whose window has passed to the ready queue; returns seconds until the next one
+        now = time.monotonic()
+        while self._due_heap:
+            due, key = self._due_heap[0]
+            if self._due.get(key) != due:
+                # Superseded by a later deadline
+                heapq.heappop(self._due_heap)
+                continue
+            if due > now:
+                return due - now
+            heapq.heappop(self._due_heap)
+            del self._due[key]
+            self._ready.append(key)
+        return None
+
+    def join(self):
+        """
+        Block until every queued payload has been processed.
+        """
+        with self._cond:
+            while self._mailboxes:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    timeout = self._promote_due()
+                    if self._ready:
+                        break
+                    self._cond.wait(timeout)
+                key = self._ready.popleft()
+                mailbox = self._mailboxes[key]
+                if self.coalesce_window > 0:
+                    taken = list(mailbox)
+                    mailbox.clear()
+                else:
+                    taken = [mailbox.popleft()]
+                self._pending -= len(taken)
+                self._stats["busy_workers"] += 1
+            enqueued_at = taken[0][0]
+            started_at = time.monotonic()
+            failed = False
+            try:
+                payloads = self.merge([payload for _, payload in taken])
+            except Exception as e:
+                print(f"reply worker merge error: {e}")
+                payloads = [payload for _, payload in taken]
+            for payload in payloads:
+                try:
+                    self.handler(payload)
+                except Exception as e:
+                    failed = True
+                    print(f"reply worker error: {e}")
+                    traceback.print_exc()
+            finished_at = time.monotonic()
+            with self._cond:
+                self._stats["busy_workers"] -= 1
+                self._stats["failed" if failed else "completed"] += 1
+                self._stats["coalesced"] += len(taken) - len(payloads)
+                self._stats["total_wait_seconds"] += started_at - enqueued_at
+                self._stats["total_run_seconds"] += finished_at - started_at
+                if mailbox:
+                    # Go to the back of the line so other keys get a turn
+                    self._schedule(key)
+                else:
+                    del self._mailboxes[key]
+                self._cond.notify_all()
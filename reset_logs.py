@@ -8,4 +8,10 @@ json.dump({}, open("message_logs.json", "w+"))
 json.dump({}, open("done_ping_dict.json", "w+"))
 json.dump({}, open("exp_id_map.json", "w+"))
 
+from message_journal import MessageJournal
+MessageJournal().reset()
+
+from state_store import StateStore
+StateStore(legacy_dir=None).clear()
+
 
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, ContextManager, List, Optional
+
+from llm_cache import cached_chat_completion
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+
+SUMMARY_PROMPT = open(os.path.join(__location__, "summarization_prompt.txt")).read()
+ROLLING_SUMMARY_PROMPT = open(os.path.join(__location__, "rolling_summary_prompt.txt")).read()
+ACTION_PLAN_PROMPT = open(os.path.join(__location__, "action_plan_prompt.txt")).read()
+STRESS_JUDGE_PROMPT = "Does the user think stress is a significant barrier for them in terms of increasing physical activity? Answer with yes or no."
+
+
+def count_turns(messages: List[dict]) -> int:
+    return sum(1 for m in messages if m.get("role") in ["user", "assistant"])
+
+
+class RollingSummarizer:
+    """
+    Keeps a running summary, action plan and stress judgement of each user's current session.
+
+    Every `every_n_turns` new user/assistant messages, the new part of the conversation is
+    folded into the running state on a background thread, so each LLM call only reads the
+    previous summary plus the new turns. At the end of the session `finalize` only has to
+    fold in the turns since the last update. The running state is kept in the state store
+    (rolling_summaries table) together with the number of messages it covers.
+
+    The summary, action plan and stress judgement of a fold do not depend on each other and
+    are requested concurrently.
+    """
+
+    def __init__(self, state_store, format_conversation: Callable[[List[dict]], str],
+                 every_n_turns: int = 6, num_workers: int = 2, model: str = "gpt-4o-mini", client=None,
+                 user_lock: Optional[Callable[[str], ContextManager]] = None):
+        """
+        state_store: the StateStore holding the messages and the running summaries.
+        format_conversation: turns a list of messages into the transcript given to the LLM.
+        every_n_turns: new user/assistant messages after which the summary is updated; 0 only summarizes in finalize.
+        num_workers: number of background updates running at once.
+        client: openai.OpenAI client for the LLM calls; defaults to the `openai` module.
+        user_lock: returns the lock serializing the updates of a user (e.g. user_lock.summary_locks.lock,
+            which also holds across worker processes); defaults to a lock per user in this process.
+            It is held through the LLM calls, so it should not be the lock of the user's turns.
+        """
+        self.state_store = state_store
+        self.format_conversation = format_conversation
+        self.every_n_turns = every_n_turns
+        self.model = model
+        if client is None:
+            import openai
+            client = openai
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="rolling-summary")
+        # Separate pool for the LLM calls of a fold, so folds waiting on their calls never starve them
+        self._llm_executor = ThreadPoolExecutor(max_workers=3 * (num_workers + 1), thread_name_prefix="rolling-summary-llm")
+        self._lock = threading.Lock()
+        # phone number -> lock serializing the updates of that user
+        self._user_locks = {}
+        self._scheduled = set()
+        if user_lock is not None:
+            self._user_lock = user_lock
+
+    def observe(self, phone_number: str):
+        """
+        Called after a turn; schedules a background update once enough new turns have accumulated.
+        """
+        if self.every_n_turns <= 0:
+            return
+        with self._lock:
+            if phone_number in self._scheduled:
+                return
+        messages = self.state_store.get_messages(phone_number)
+        rolling = self._current(phone_number)
+        covered = rolling["messages_covered"] if rolling is not None else 0
+        if count_turns(messages[covered:]) < self.every_n_turns:
+            return
+        with self._lock:
+            if phone_number in self._scheduled:
+                return
+            self._scheduled.add(phone_number)
+        self._executor.submit(self._background_update, phone_number)
+
+    def finalize(self, phone_number: str, on_summary: Optional[Callable[[Optional[str]], None]] = None,
+                 timings: Optional[dict] = None) -> dict:
+        """
+        Fold the remaining turns of the session into the running state and return it as
+        {"messages_covered", "summary", "action_plan", "stress_barrier"}.
+        on_summary: called with the final summary as soon as it is known, while the action plan
+            and stress judgement may still be in flight. Those calls can still fail and the
+            finalize be retried, so it should prepare work rather than store anything.
+        timings: filled with the seconds spent on each LLM call.
+        """
+        return self._fold(phone_number, on_summary=on_summary, timings=timings)
+
+    def _background_update(self, phone_number: str):
+        try:
+            self._fold(phone_number)
+        except Exception as e:
+            print(f"rolling summary error: {e}")
+        finally:
+            with self._lock:
+                self._scheduled.discard(phone_number)
+
+    def _user_lock(self, phone_number: str) -> threading.Lock:
+        with self._lock:
+            return self._user_locks.setdefault(phone_number, threading.Lock())
+
+    def _current(self, phone_number: str):
+        # The running state, unless it belongs to an earlier session
+        session_log = self.state_store.get_session(phone_number)
+        rolling = self.state_store.get_rolling_summary(phone_number)
+        if rolling is None or session_log is None or rolling["session"] != session_log["current_session"]:
+            return None
+        return rolling
+
+    def _complete(self, prompt: str, temperature=None) -> str:
+        kwargs = {} if temperature is None else {"temperature": temperature}
+        response = cached_chat_completion(self.client, model=self.model,
+                                          messages=[{"role": "user", "content": prompt}], **kwargs)
+        return response.choices[0].message.content
+
+    def _timed(self, timings: dict, stage: str, fn: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage] = time.perf_counter() - start
+
+    def _fold(self, phone_number: str, on_summary=None, timings=None) -> dict:
+        timings = timings if timings is not None else {}
+        with self._user_lock(phone_number):
+            session_log = self.state_store.get_session(phone_number)
+            messages = self.state_store.get_messages(phone_number)
+            rolling = self._current(phone_number)
+            if rolling is None:
+                previous_plan = session_log.get("action_plan") if session_log is not None else None
+                rolling = {"messages_covered": 0, "summary": None, "action_plan": previous_plan, "stress_barrier": None}
+            # Messages removed after an API error can leave the count past the end
+            covered = min(rolling["messages_covered"], len(messages))
+            tail = messages[covered:]
+            if count_turns(tail) == 0:
+                if on_summary is not None:
+                    on_summary(rolling["summary"])
+                return rolling
+            new_turns = self.format_conversation(tail)
+            if rolling["summary"] is None:
+                summary_prompt = SUMMARY_PROMPT + "\n\n" + new_turns
+            else:
+                summary_prompt = ROLLING_SUMMARY_PROMPT.replace("PREV_SUMMARY", rolling["summary"]) \
+                    .replace("NEW_TURNS", new_turns)
+            summary_future = self._llm_executor.submit(self._timed, timings, "summary", self._complete,
+                                                       summary_prompt, temperature=1.0)
+            action_plan_future = self._llm_executor.submit(
+                self._timed, timings, "action_plan", self._complete,
+                ACTION_PLAN_PROMPT.replace("USER_CONVO", new_turns).replace("PREV_ACTION_PLAN", str(rolling["action_plan"])))
+            stress_future = None
+            stress_barrier = rolling["stress_barrier"]
+            # Only the first session decides whether stress relief is offered; once the user
+            # has named stress as a barrier the later parts of the session do not undo it
+            if session_log is not None and session_log["current_session"] == 1 and not stress_barrier:
+                context = new_turns if rolling["summary"] is None else \
+                    "Summary of the earlier conversation:\n" + rolling["summary"] + "\n\nLatest conversation:\n" + new_turns
+                stress_future = self._llm_executor.submit(self._timed, timings, "stress_judge", self._complete,
+                                                          STRESS_JUDGE_PROMPT + "\n\n" + context, temperature=0)
+            summary = summary_future.result()
+            if on_summary is not None:
+                # The caller can start on the summary (e.g. embedding it) while the other calls finish
+                on_summary(summary)
+            action_plan = action_plan_future.result()
+            if stress_future is not None:
+                stress_barrier = stress_future.result().lower().startswith("yes")
+            rolling = {"messages_covered": len(messages), "summary": summary, "action_plan": action_plan,
+                       "stress_barrier": stress_barrier}
+            self.state_store.set_rolling_summary(phone_number, session_log["current_session"], len(messages),
+                                                 summary, action_plan, stress_barrier)
+            return rolling
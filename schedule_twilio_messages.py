@@ -3,6 +3,7 @@ import dotenv
 import datetime
 import json
 import time
+from argparse import ArgumentParser
 
 dotenv.load_dotenv(".env")
 
@@ -12,22 +13,38 @@ TWILIO_SID = os.environ.get("TWILIO_ACCOUNT_SID")
 TWILIO_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 TWILIO_MESSAGING_SERVICE_SID = "MGdadfd2c85ec7e22833d012852d8fa58a"
 
-from twilio.rest import Client
+from twilio_bulk import BulkMessageScheduler, TwilioTransport, DryRunTransport, TWILIO_RATE_LIMIT, TWILIO_CONCURRENCY
+from state_store import StateStore
+from http_transport import HttpTransport
 
-twilio_client = Client(TWILIO_SID, TWILIO_TOKEN)
-curr_time = datetime.datetime.now(datetime.timezone.utc)
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--dry_run", action="store_true", help="Do not contact Twilio; only time the run")
+    parser.add_argument("--dry_run_users", type=int, default=0, help="Schedule for this many fake numbers in a dry run")
+    parser.add_argument("--rate", type=float, default=TWILIO_RATE_LIMIT, help="Twilio requests per second")
+    parser.add_argument("--concurrency", type=int, default=TWILIO_CONCURRENCY)
+    args = parser.parse_args()
 
-schedule_time = datetime.datetime(year=2025, month=7, day=21, hour=11) + datetime.timedelta(hours=48)
-import json
-
-all_msgs = json.load(open("message_logs.json"))
-for k in all_msgs:
-    message = twilio_client.messages.create(
+    schedule_time = datetime.datetime(year=2025, month=7, day=21, hour=11) + datetime.timedelta(hours=48)
+    if args.dry_run and args.dry_run_users:
+        numbers = [f"whatsapp:+1555{i:07d}" for i in range(args.dry_run_users)]
+    else:
+        numbers = StateStore().all_phone_numbers()
+    messages = [dict(
             content_sid="HX2e855ed5ae297f2dbdd35a294b275079",
             to=k.replace("whatsapp:", ""),
             from_=TWILIO_SMS_NUMBER,
             messaging_service_sid=TWILIO_MESSAGING_SERVICE_SID,
             send_at=schedule_time,
             schedule_type="fixed",
-        )
-    time.sleep(1)
\ No newline at end of file
+        ) for k in numbers]
+
+    transport = DryRunTransport() if args.dry_run else TwilioTransport(transport=HttpTransport(max_per_host=args.concurrency))
+    scheduler = BulkMessageScheduler(transport, rate=args.rate, concurrency=args.concurrency)
+    start = time.perf_counter()
+    results = scheduler.schedule_many(messages)
+    for k, r in zip(numbers, results):
+        if r["error"] is not None:
+            print(f"{k}: {r['error']}")
+    print(f"Scheduled {sum(r['error'] is None for r in results)}/{len(messages)} messages "
+          f"in {time.perf_counter() - start:.1f}s: {json.dumps(scheduler.stats())}")
@@ -1,35 +1,180 @@
-import subprocess
+import json
+import os
 import re
+import sqlite3
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Optional
 
-def schedule_job(command, interval):
-    # Schedule a command at specific intervals
-    result = subprocess.run(f"echo \"{command}\" | at now + {interval}", shell=True, capture_output=True, text=True)
-    std_err = result.stderr
-    std_err = std_err.split("\n")[-2]
-    job_num = re.search(r"[0-9]+", std_err).group(0)
-    return job_num
+from notifier_scheduler import DueJobScheduler
 
-def cancel_job(job_num):
-    subprocess.run(f"atrm {job_num}", shell=True, check=True)
+DEFAULT_JOBS_PATH = "scheduled_jobs.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    run_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS scheduled_jobs_by_status ON scheduled_jobs (status, run_at);
+"""
+
+_UNITS = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+
+
+# Seconds in an `at`-style interval such as "15 minutes" or "48 hours"
+def parse_interval(interval: str) -> float:
+    match = re.fullmatch(r"\s*(\d+)\s*(minute|hour|day|week)s?\s*", interval)
+    if match is None:
+        raise ValueError(f"unsupported interval: {interval!r}")
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+class JobQueue:
+    """
+    Durable in-process replacement for the `at` daemon.
+
+    A job is the name of a registered handler plus JSON arguments and the time it should
+    run. Jobs are written to SQLite before they are scheduled and marked done only after
+    their handler returns, so pending jobs (including ones that were running when the
+    process stopped) are picked up again by `start` after a restart. Timing is done by a
+    DueJobScheduler: schedule and reschedule are O(log n), cancel is O(1) plus an indexed
+    update.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_JOBS_PATH, num_workers: int = 4,
+                 retry_delay: float = 60.0, max_attempts: int = 3):
+        """
+        db_path: location of the SQLite database holding the jobs.
+        num_workers: maximum number of jobs running at once.
+        retry_delay, max_attempts: retry policy for jobs whose handler raises.
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self._handlers: Dict[str, Callable[..., None]] = {}
+        self._lock = threading.Lock()
+        self._started = False
+        self.scheduler = DueJobScheduler(self._run, num_workers=num_workers, retry_delay=retry_delay,
+                                         max_attempts=max_attempts,
+                                         on_give_up=lambda job_id, run_at: self._finish(job_id, run_at, "failed"))
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads.
+        # A connection inherited through fork belongs to the parent: it is kept, unused and open
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            self._local.inherited = conn
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
 
-# Define the command
-# command = "echo 'Hello from Python hiya' > ~/output.txt"
+    def register(self, name: str, handler: Callable[..., None]):
+        """
+        Register the function run for jobs called `name`; it receives the job's arguments as keywords.
+        """
+        self._handlers[name] = handler
 
-# # Schedule the job and capture the output
-# result = subprocess.run(f"echo \"{command}\" | at now + 1 minutes", shell=True, capture_output=True, text=True)
+    def start(self):
+        """
+        Schedule the jobs left pending by earlier runs. Register the handlers first.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        rows = self._conn().execute("SELECT id, run_at FROM scheduled_jobs WHERE status = 'pending'").fetchall()
+        for job_id, run_at in rows:
+            self.scheduler.schedule(job_id, run_at)
 
-# # Print the output (which includes the job ID)
-# print(result.stdout)
-# print(result.stderr)
+    def schedule(self, name: str, args: Optional[dict] = None, run_at: Optional[float] = None,
+                 delay: float = 0.0) -> int:
+        """
+        Run handler `name` with `args` at `run_at` (a Unix timestamp), or `delay` seconds from now.
+        Returns the job id.
+        """
+        self.start()
+        run_at = run_at if run_at is not None else time.time() + delay
+        cursor = self._conn().execute("INSERT INTO scheduled_jobs (name, args, run_at) VALUES (?, ?, ?)",
+                                      (name, json.dumps(args or {}), run_at))
+        self.scheduler.schedule(cursor.lastrowid, run_at)
+        return cursor.lastrowid
 
-# # Need to parse stderr to get the job number
-# std_err = result.stderr
-# std_err = std_err.split("\n")[-2]
-# import re
+    def reschedule(self, job_id: int, run_at: Optional[float] = None, delay: float = 0.0) -> bool:
+        """
+        Move a pending job. Returns False if the job is no longer pending.
+        """
+        self.start()
+        run_at = run_at if run_at is not None else time.time() + delay
+        cursor = self._conn().execute("UPDATE scheduled_jobs SET run_at = ? WHERE id = ? AND status = 'pending'",
+                                      (run_at, job_id))
+        if cursor.rowcount == 0:
+            return False
+        self.scheduler.schedule(job_id, run_at)
+        return True
 
-# print(std_err)
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancel a pending job. Returns False if the job is no longer pending.
+        """
+        cursor = self._conn().execute(
+            "UPDATE scheduled_jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'pending'",
+            (time.time(), job_id))
+        self.scheduler.cancel(job_id)
+        return cursor.rowcount > 0
 
-# print(re.search(r"[0-9]+", std_err).group(0))
+    def get(self, job_id: int) -> Optional[dict]:
+        row = self._conn().execute("SELECT id, name, args, run_at, status FROM scheduled_jobs WHERE id = ?",
+                                   (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "name": row[1], "args": json.loads(row[2]), "run_at": row[3], "status": row[4]}
 
-# # import time
-# # time.sleep(65)
\ No newline at end of file
+    def pending(self) -> List[dict]:
+        rows = self._conn().execute("SELECT id FROM scheduled_jobs WHERE status = 'pending' ORDER BY run_at").fetchall()
+        return [self.get(r[0]) for r in rows]
+
+    def metrics(self) -> dict:
+        return self.scheduler.metrics()
+
+    def _run(self, job_id: int, run_at: float):
+        job = self.get(job_id)
+        # Cancelled or moved after the scheduler picked it up
+        if job is None or job["status"] != "pending" or job["run_at"] != run_at:
+            return
+        handler = self._handlers.get(job["name"])
+        if handler is None:
+            raise KeyError(f"no handler registered for job {job['name']!r}")
+        handler(**job["args"])
+        self._finish(job_id, run_at, "done")
+
+    def _finish(self, job_id: int, run_at: float, status: str):
+        self._conn().execute(
+            "UPDATE scheduled_jobs SET status = ?, finished_at = ? WHERE id = ? AND status = 'pending' AND run_at = ?",
+            (status, time.time(), job_id, run_at))
+
+
+# Run a shell command; the handler behind schedule_job
+def run_command(command: str):
+    subprocess.run(command, shell=True, check=True)
+
+
+job_queue = JobQueue(db_path=os.environ.get("SCHEDULED_JOBS_PATH", DEFAULT_JOBS_PATH))
+job_queue.register("command", run_command)
+
+
+def schedule_job(command, interval):
+    # Schedule a shell command to run once after an `at`-style interval ("15 minutes")
+    return job_queue.schedule("command", {"command": command}, delay=parse_interval(interval))
+
+
+def cancel_job(job_num):
+    job_queue.cancel(int(job_num))
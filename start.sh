@@ -1,5 +1,5 @@
 # For development use (simple logging, etc):
 pip3 install -r requirements.txt
 python3 app.py
-# For production use: 
-# gunicorn app:app -w 1 --log-file -
\ No newline at end of file
+# For production use (preforked workers sharing the state store, see gunicorn_conf.py):
+# gunicorn -c gunicorn_conf.py
@@ -0,0 +1,510 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+from message_journal import MessageJournal
+
+DEFAULT_DB_PATH = os.environ.get("STATE_STORE_PATH", "whatsbot_state.db")
+
+# jobs.due_at of a user whose session was just summarized and who waits for their check-in;
+# the (-1, -1) of user_job_dict.json. Unlike -1 (no ping scheduled), it does not let the
+# next message schedule a ping
+SUMMARIZED_JOB = -2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone_number TEXT NOT NULL,
+    session TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_by_session ON messages (phone_number, session, id);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    phone_number TEXT PRIMARY KEY,
+    current_session INTEGER NOT NULL,
+    action_plan TEXT,
+    faiss_meta_prefix TEXT
+);
+
+CREATE TABLE IF NOT EXISTS session_summaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone_number TEXT NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_summaries_by_user ON session_summaries (phone_number, id);
+
+CREATE TABLE IF NOT EXISTS stress_relief (
+    phone_number TEXT PRIMARY KEY,
+    state INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stress_profiles (
+    phone_number TEXT PRIMARY KEY,
+    profile TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    phone_number TEXT PRIMARY KEY,
+    due_at REAL NOT NULL,
+    done_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_due_at ON jobs (due_at);
+
+CREATE TABLE IF NOT EXISTS experiments (
+    phone_number TEXT PRIMARY KEY,
+    exp_id TEXT NOT NULL,
+    exp_condition INTEGER NOT NULL,
+    enroll_time REAL
+);
+
+CREATE TABLE IF NOT EXISTS templates (
+    phone_number TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rolling_summaries (
+    phone_number TEXT PRIMARY KEY,
+    session INTEGER NOT NULL,
+    messages_covered INTEGER NOT NULL,
+    summary TEXT,
+    action_plan TEXT,
+    stress_barrier INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS precomputed_pings (
+    phone_number TEXT PRIMARY KEY,
+    session INTEGER NOT NULL,
+    messages_covered INTEGER NOT NULL,
+    emp_condition INTEGER NOT NULL,
+    ping TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    maintenance_prompt TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class StateStore:
+    """
+    SQLite-backed store for all per-user state shared by the apps and the notifier.
+
+    Each call touches only the rows of one user and every lookup goes through an index
+    on the phone number. The database runs in WAL mode, so readers in other processes
+    (e.g. notifier_cron.py) never block the webhook. Use `transaction()` to group
+    several updates atomically.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, legacy_dir: Optional[str] = "."):
+        """
+        db_path: location of the SQLite database.
+        legacy_dir: directory holding the old JSON state files; they are imported once
+            when the database is first created. Pass None to skip the import.
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        created = not os.path.exists(db_path)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        if created and legacy_dir is not None:
+            self.import_legacy(legacy_dir)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads.
+        # A connection inherited through fork belongs to the parent: it is kept, unused and open
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            self._local.inherited = conn
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the enclosed updates in one transaction. Nested calls join the outer transaction.
+        """
+        conn = self._conn()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ----------------------
+    # Messages
+    # ----------------------
+    def append_message(self, phone_number: str, message: dict, session: str = "current_session"):
+        self._conn().execute(
+            "INSERT INTO messages (phone_number, session, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (phone_number, session, message["role"], message["content"], message.get("timestamp"))
+        )
+
+    def get_messages(self, phone_number: str, session: str = "current_session") -> List[dict]:
+        rows = self._conn().execute(
+            "SELECT role, content, timestamp FROM messages WHERE phone_number = ? AND session = ? ORDER BY id",
+            (phone_number, session)
+        ).fetchall()
+        messages = []
+        for role, content, timestamp in rows:
+            m = {"role": role, "content": content}
+            if timestamp is not None:
+                m["timestamp"] = timestamp
+            messages.append(m)
+        return messages
+
+    def has_messages(self, phone_number: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM messages WHERE phone_number = ? LIMIT 1", (phone_number,)
+        ).fetchone()
+        return row is not None
+
+    def count_archived_sessions(self, phone_number: str) -> int:
+        row = self._conn().execute(
+            "SELECT COUNT(DISTINCT session) FROM messages WHERE phone_number = ? AND session != 'current_session'",
+            (phone_number,)
+        ).fetchone()
+        return row[0]
+
+    def pop_last_message(self, phone_number: str, session: str = "current_session"):
+        self._conn().execute(
+            "DELETE FROM messages WHERE id = "
+            "(SELECT MAX(id) FROM messages WHERE phone_number = ? AND session = ?)",
+            (phone_number, session)
+        )
+
+    def replace_last_message(self, phone_number: str, content: str, session: str = "current_session"):
+        self._conn().execute(
+            "UPDATE messages SET content = ? WHERE id = "
+            "(SELECT MAX(id) FROM messages WHERE phone_number = ? AND session = ?)",
+            (content, phone_number, session)
+        )
+
+    def archive_session(self, phone_number: str, session: str):
+        """
+        Move the messages of "current_session" to `session`, leaving the current session empty.
+        """
+        self._conn().execute(
+            "UPDATE messages SET session = ? WHERE phone_number = ? AND session = 'current_session'",
+            (session, phone_number)
+        )
+
+    def all_phone_numbers(self) -> List[str]:
+        rows = self._conn().execute("SELECT DISTINCT phone_number FROM messages").fetchall()
+        return [r[0] for r in rows]
+
+    def clear_messages(self):
+        self._conn().execute("DELETE FROM messages")
+
+    # ----------------------
+    # Sessions
+    # ----------------------
+    def get_session(self, phone_number: str) -> Optional[dict]:
+        """
+        Returns the session record in the shape of the old session_logs.json entries,
+        or None if the user has no session yet.
+        """
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT current_session, action_plan, faiss_meta_prefix FROM sessions WHERE phone_number = ?",
+            (phone_number,)
+        ).fetchone()
+        if row is None:
+            return None
+        summaries = conn.execute(
+            "SELECT summary FROM session_summaries WHERE phone_number = ? ORDER BY id", (phone_number,)
+        ).fetchall()
+        session = {
+            "current_session": row[0],
+            "session_summaries": [s[0] for s in summaries]
+        }
+        if row[1] is not None:
+            session["action_plan"] = row[1]
+        if row[2] is not None:
+            session["faiss_meta_prefix"] = row[2]
+        return session
+
+    def create_session(self, phone_number: str, current_session: int = 1):
+        self._conn().execute(
+            "INSERT OR IGNORE INTO sessions (phone_number, current_session) VALUES (?, ?)",
+            (phone_number, current_session)
+        )
+
+    def update_session(self, phone_number: str, action_plan: Optional[str] = None,
+                       faiss_meta_prefix: Optional[str] = None):
+        conn = self._conn()
+        if action_plan is not None:
+            conn.execute("UPDATE sessions SET action_plan = ? WHERE phone_number = ?", (action_plan, phone_number))
+        if faiss_meta_prefix is not None:
+            conn.execute("UPDATE sessions SET faiss_meta_prefix = ? WHERE phone_number = ?",
+                         (faiss_meta_prefix, phone_number))
+
+    def increment_session(self, phone_number: str):
+        self._conn().execute(
+            "UPDATE sessions SET current_session = current_session + 1 WHERE phone_number = ?", (phone_number,)
+        )
+
+    def add_session_summary(self, phone_number: str, summary: str):
+        self._conn().execute(
+            "INSERT INTO session_summaries (phone_number, summary) VALUES (?, ?)", (phone_number, summary)
+        )
+
+    # ----------------------
+    # Stress relief state
+    # ----------------------
+    def has_stress_relief(self, phone_number: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM stress_relief WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        return row is not None
+
+    def get_stress_relief(self, phone_number: str, default=False):
+        """
+        Returns the stress relief state: False when inactive, otherwise the round number.
+        """
+        row = self._conn().execute(
+            "SELECT state FROM stress_relief WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        if row is None:
+            return default
+        return row[0] if row[0] else False
+
+    def set_stress_relief(self, phone_number: str, state):
+        self._conn().execute(
+            "INSERT INTO stress_relief (phone_number, state) VALUES (?, ?) "
+            "ON CONFLICT (phone_number) DO UPDATE SET state = excluded.state",
+            (phone_number, int(state))
+        )
+
+    def get_stress_profile(self, phone_number: str) -> Optional[dict]:
+        """
+        Returns the user's stress relief profile (bandit state and intervention history).
+        """
+        row = self._conn().execute(
+            "SELECT profile FROM stress_profiles WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_stress_profile(self, phone_number: str, profile: dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO stress_profiles (phone_number, profile) VALUES (?, ?)",
+            (phone_number, json.dumps(profile))
+        )
+
+    # ----------------------
+    # Ping jobs
+    # ----------------------
+    def get_job(self, phone_number: str) -> Optional[float]:
+        """
+        Returns the timestamp of the next scheduled ping, -1 if none is scheduled,
+        SUMMARIZED_JOB right after the session was summarized, or None if the user has no
+        job entry yet.
+        """
+        row = self._conn().execute(
+            "SELECT due_at FROM jobs WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_job(self, phone_number: str, due_at: float):
+        self._conn().execute(
+            "INSERT INTO jobs (phone_number, due_at) VALUES (?, ?) "
+            "ON CONFLICT (phone_number) DO UPDATE SET due_at = excluded.due_at",
+            (phone_number, due_at)
+        )
+
+    def due_jobs(self, now: float) -> List[tuple]:
+        """
+        Returns (phone_number, due_at) for every job that is due and has not been notified yet.
+        """
+        return self._conn().execute(
+            "SELECT phone_number, due_at FROM jobs WHERE due_at >= 0 AND due_at <= ? "
+            "AND (done_at IS NULL OR done_at != due_at)",
+            (now,)
+        ).fetchall()
+
+    def pending_jobs(self) -> List[tuple]:
+        """
+        Returns (phone_number, due_at) for every scheduled job that has not been notified yet, due or not.
+        """
+        return self._conn().execute(
+            "SELECT phone_number, due_at FROM jobs WHERE due_at >= 0 AND (done_at IS NULL OR done_at != due_at)"
+        ).fetchall()
+
+    def mark_job_done(self, phone_number: str, due_at: float):
+        self._conn().execute("UPDATE jobs SET done_at = ? WHERE phone_number = ?", (due_at, phone_number))
+
+    # ----------------------
+    # Experiment assignment
+    # ----------------------
+    def get_experiment(self, phone_number: str) -> Optional[tuple]:
+        """
+        Returns (exp_id, exp_condition, enroll_time) or None if the user has not enrolled.
+        """
+        row = self._conn().execute(
+            "SELECT exp_id, exp_condition, enroll_time FROM experiments WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set_experiment(self, phone_number: str, exp_id: str, exp_condition: int, enroll_time: Optional[float] = None):
+        self._conn().execute(
+            "INSERT INTO experiments (phone_number, exp_id, exp_condition, enroll_time) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (phone_number) DO UPDATE SET exp_id = excluded.exp_id, "
+            "exp_condition = excluded.exp_condition, enroll_time = excluded.enroll_time",
+            (phone_number, exp_id, exp_condition, enroll_time)
+        )
+
+    # ----------------------
+    # WhatsApp Cloud API request templates (app.py / notifier_cron.py)
+    # ----------------------
+    def get_template(self, phone_number: str) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT body FROM templates WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_template(self, phone_number: str, body: dict):
+        self._conn().execute(
+            "INSERT INTO templates (phone_number, body) VALUES (?, ?) "
+            "ON CONFLICT (phone_number) DO UPDATE SET body = excluded.body",
+            (phone_number, json.dumps(body))
+        )
+
+    # ----------------------
+    # Running summary of the current session (rolling_summarizer.py)
+    # ----------------------
+    def get_rolling_summary(self, phone_number: str) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT session, messages_covered, summary, action_plan, stress_barrier "
+            "FROM rolling_summaries WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "session": row[0],
+            "messages_covered": row[1],
+            "summary": row[2],
+            "action_plan": row[3],
+            "stress_barrier": None if row[4] is None else bool(row[4])
+        }
+
+    def set_rolling_summary(self, phone_number: str, session: int, messages_covered: int, summary: Optional[str],
+                            action_plan: Optional[str], stress_barrier: Optional[bool] = None):
+        self._conn().execute(
+            "INSERT INTO rolling_summaries (phone_number, session, messages_covered, summary, action_plan, stress_barrier) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (phone_number) DO UPDATE SET session = excluded.session, "
+            "messages_covered = excluded.messages_covered, summary = excluded.summary, "
+            "action_plan = excluded.action_plan, stress_barrier = excluded.stress_barrier",
+            (phone_number, session, messages_covered, summary, action_plan,
+             None if stress_barrier is None else int(stress_barrier))
+        )
+
+    def clear_rolling_summary(self, phone_number: str):
+        self._conn().execute("DELETE FROM rolling_summaries WHERE phone_number = ?", (phone_number,))
+
+    # ----------------------
+    # Check-in ping prepared while the session is idle (ping_precomputer.py)
+    # ----------------------
+    def get_precomputed_ping(self, phone_number: str) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT session, messages_covered, emp_condition, ping, topic, maintenance_prompt, created_at "
+            "FROM precomputed_pings WHERE phone_number = ?", (phone_number,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["session", "messages_covered", "emp_condition", "ping", "topic",
+                         "maintenance_prompt", "created_at"], row))
+
+    def set_precomputed_ping(self, phone_number: str, session: int, messages_covered: int, emp_condition: int,
+                             ping: str, topic: str, maintenance_prompt: str, created_at: float):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO precomputed_pings (phone_number, session, messages_covered, emp_condition, "
+            "ping, topic, maintenance_prompt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (phone_number, session, messages_covered, emp_condition, ping, topic, maintenance_prompt, created_at)
+        )
+
+    def clear_precomputed_ping(self, phone_number: str):
+        self._conn().execute("DELETE FROM precomputed_pings WHERE phone_number = ?", (phone_number,))
+
+    # ----------------------
+    # Maintenance
+    # ----------------------
+    def data_version(self) -> int:
+        """
+        Changes whenever another connection (thread or process) commits to the database;
+        a cheap way to find out whether anything needs to be re-read.
+        """
+        return self._conn().execute("PRAGMA data_version").fetchone()[0]
+
+    def clear(self):
+        with self.transaction():
+            conn = self._conn()
+            for table in ["messages", "sessions", "session_summaries", "stress_relief",
+                          "jobs", "experiments", "templates", "rolling_summaries", "precomputed_pings",
+                          "stress_profiles"]:
+                conn.execute(f"DELETE FROM {table}")
+
+    def import_legacy(self, legacy_dir: str = "."):
+        """
+        Import the JSON files (and message journal) that held the state before the store existed.
+        """
+        def load(name):
+            path = os.path.join(legacy_dir, name)
+            if not os.path.exists(path):
+                return {}
+            try:
+                return json.load(open(path))
+            except json.JSONDecodeError:
+                return {}
+
+        message_logs = MessageJournal(
+            journal_path=os.path.join(legacy_dir, "message_journal.jsonl"),
+            snapshot_path=os.path.join(legacy_dir, "message_snapshot.json"),
+            legacy_path=os.path.join(legacy_dir, "message_logs.json")
+        ).load()
+        done_pings = load("done_ping_dict.json")
+        with self.transaction():
+            for phone_number, sessions in message_logs.items():
+                # Archived sessions first, in session order, so message ids follow the conversation
+                ordered = sorted([s for s in sessions if s != "current_session"],
+                                 key=lambda s: int(s.split("_")[-1]) if s.split("_")[-1].isdigit() else 0)
+                for session in ordered + ["current_session"]:
+                    for m in sessions.get(session, []):
+                        self.append_message(phone_number, m, session)
+            for phone_number, s in load("session_logs.json").items():
+                self.create_session(phone_number, s["current_session"])
+                self.update_session(phone_number, action_plan=s.get("action_plan"),
+                                    faiss_meta_prefix=s.get("faiss_meta_prefix"))
+                for summary in s.get("session_summaries", []):
+                    self.add_session_summary(phone_number, summary)
+            for phone_number, state in load("stress_relief_logs.json").items():
+                self.set_stress_relief(phone_number, state)
+            for phone_number, due_at in load("user_job_dict.json").items():
+                # (-1, -1) right after summarizing
+                if isinstance(due_at, list):
+                    due_at = SUMMARIZED_JOB
+                self.set_job(phone_number, due_at)
+                if phone_number in done_pings:
+                    self.mark_job_done(phone_number, done_pings[phone_number])
+            for phone_number, exp in load("exp_id_map.json").items():
+                self.set_experiment(phone_number, exp[0], exp[1], exp[2] if len(exp) > 2 else None)
+            for phone_number, body in load("user_templates.json").items():
+                self.set_template(phone_number, body)
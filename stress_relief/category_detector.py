@@ -1,17 +1,19 @@
 import re
 from typing import Tuple
 from openai import OpenAI
+from llm_cache import cached_chat_completion
 
 
 class CategoryDetector:
     """Detects stress categories from user messages using LLM."""
     
-    def __init__(self, llm_client=None, openai_api_key=None):
+    def __init__(self, llm_client=None, openai_api_key=None, http_client=None):
         """Initialize the CategoryDetector.
         
         Args:
             llm_client: Optional custom LLM client for category detection.
             openai_api_key: Optional OpenAI API key. If provided, OpenAI's API will be used.
+            http_client: Optional httpx.Client shared with other API clients (connection pooling).
             
         Raises:
             ValueError: If neither llm_client nor openai_api_key is provided.
@@ -22,7 +24,7 @@ class CategoryDetector:
         # Set up OpenAI client if API key is provided
         self.openai_client = None
         if openai_api_key:
-            self.openai_client = OpenAI(api_key=openai_api_key)
+            self.openai_client = OpenAI(api_key=openai_api_key, http_client=http_client)
             
         # Ensure we have LLM capabilities
         if not (self.llm_client or self.openai_client):
@@ -88,7 +90,7 @@ class CategoryDetector:
         
         # Otherwise, use OpenAI
         else:
-            response = self.openai_client.chat.completions.create(
+            response = cached_chat_completion(self.openai_client,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a stress detection AI that analyzes text and categorizes the type of stress."},
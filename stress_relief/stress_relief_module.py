@@ -2,6 +2,7 @@ import time
 import random
 from typing import Dict, List, Any, Optional, Tuple
 from openai import OpenAI
+from llm_cache import cached_chat_completion
 
 from .user_profile_manager import UserProfileManager
 from .category_detector import CategoryDetector
@@ -15,7 +16,8 @@ class StressReliefModule:
                  profile_path: str = "user_profiles.json", 
                  llm_client=None,
                  openai_api_key=None,
-                 favorite_threshold: float = 7.5):
+                 favorite_threshold: float = 7.5,
+                 http_client=None):
         """Initialize the StressReliefModule.
         
         Args:
@@ -23,6 +25,7 @@ class StressReliefModule:
             llm_client: Optional custom LLM client for more personalized responses.
             openai_api_key: Optional OpenAI API key for LLM-based responses.
             favorite_threshold: Threshold for considering an intervention a favorite.
+            http_client: Optional httpx.Client shared with other API clients (connection pooling).
             
         Raises:
             ValueError: If neither llm_client nor openai_api_key is provided.
@@ -36,14 +39,14 @@ class StressReliefModule:
         # Set up OpenAI client if API key is provided
         self.openai_client = None
         if openai_api_key:
-            self.openai_client = OpenAI(api_key=openai_api_key)
+            self.openai_client = OpenAI(api_key=openai_api_key, http_client=http_client)
         
         # Ensure we have LLM capabilities
         if not (self.llm_client or self.openai_client):
             raise ValueError("Either llm_client or openai_api_key must be provided")
             
         # Initialize the category detector with LLM capabilities
-        self.category_detector = CategoryDetector(llm_client, openai_api_key)
+        self.category_detector = CategoryDetector(llm_client, openai_api_key, http_client=http_client)
         
         # Track conversation state
         self.current_state = {}
@@ -117,7 +120,7 @@ class StressReliefModule:
         
         # Otherwise, use OpenAI
         else:
-            response = self.openai_client.chat.completions.create(
+            response = cached_chat_completion(self.openai_client,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are an AI that detects feedback scores in user messages."},
@@ -271,7 +274,7 @@ class StressReliefModule:
         
         # Use the LLM to generate the summary
         try:
-            response = self.openai_client.chat.completions.create(
+            response = cached_chat_completion(self.openai_client,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant that generates concise summaries of stress relief interactions, focusing on the user's condition, the intervention applied, and their reaction."},
@@ -409,7 +412,7 @@ class StressReliefModule:
         
         # Otherwise, use OpenAI
         else:
-            response = self.openai_client.chat.completions.create(
+            response = cached_chat_completion(self.openai_client,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are an AI that selects the best stress relief intervention based on user history and feedback."},
@@ -505,7 +508,7 @@ class StressReliefModule:
             
             # Otherwise, use OpenAI
             else:
-                completion = self.openai_client.chat.completions.create(
+                completion = cached_chat_completion(self.openai_client,
                     model="gpt-4o",
                     messages=[
                         {"role": "system", "content": system_prompt},
@@ -730,7 +733,7 @@ class StressReliefModule:
         
         try:
             # Use the LLM to analyze the feedback
-            response = self.openai_client.chat.completions.create(
+            response = cached_chat_completion(self.openai_client,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant that analyzes patterns in user feedback to improve stress relief recommendations."},
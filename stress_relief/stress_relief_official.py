@@ -1,6 +1,6 @@
 import json
 import os
-import dspy
+from llm_cache import CachedLM
 from typing import List
 import re
 from .mab import UCBBandit
@@ -9,18 +9,35 @@ import random
 
 class StressReliefModule:
     def __init__(self,
-                 user_profile_path: str):
+                 user_profile_path: str,
+                 profile_store=None):
         self.profile_path = user_profile_path
         if not os.path.exists(user_profile_path):
             json.dump({}, open(user_profile_path, "w+"))
         self.user_profile = json.load(open(user_profile_path))
-        self.lm = dspy.LM(model="openai/gpt-4o")
+        # With a profile store (the StateStore) each profile is read before and written after
+        # every use, so all worker processes see the latest one; the JSON file is then only
+        # read, for users the store has no profile for yet
+        self.profile_store = profile_store
+        self.lm = CachedLM(model="openai/gpt-4o")
         self.int_db = InterventionDatabase()
         self.epsilon = 0.8
     
 
     def update_user_profile(self):
         json.dump(self.user_profile, open(self.profile_path, "w+"))
+
+    def load_user_profile(self, user_id: str):
+        if self.profile_store is not None:
+            profile = self.profile_store.get_stress_profile(user_id)
+            if profile is not None:
+                self.user_profile[user_id] = profile
+
+    def save_user_profile(self, user_id: str):
+        if self.profile_store is not None:
+            self.profile_store.set_stress_profile(user_id, self.user_profile[user_id])
+        else:
+            self.update_user_profile()
     
     def generate_from_intervention(self, intervention, msg_history, non_empathetic=False):
         # Safely get intervention details
@@ -88,6 +105,7 @@ class StressReliefModule:
             ])[0]
             response = response + "\n\nFINAL_MESSAGE"
             return False, response
+        self.load_user_profile(user_id)
         if user_id not in self.user_profile:
             self.user_profile.update({
                 user_id: {
@@ -123,7 +141,7 @@ class StressReliefModule:
         self.user_profile[user_id]["interaction_history"]["interventions"].append(chosen)
         self.user_profile[user_id]["interaction_history"]["arms"].append(curr_arm)
 
-        json.dump(self.user_profile, open(self.profile_path, "w+"))
+        self.save_user_profile(user_id)
         
         return 2, stress_rec
 
@@ -133,6 +151,7 @@ class StressReliefModule:
         score = int(match.group(1)) if match else None
 
         if score is not None:
+            self.load_user_profile(user_id)
             curr_mab = UCBBandit(self.user_profile[user_id]["mab_states"])
             self.user_profile[user_id]["interaction_history"]["scores"].append(score)
             curr_mab.update(
@@ -140,7 +159,7 @@ class StressReliefModule:
                 self.user_profile[user_id]["interaction_history"]["scores"][-1]
             )
             self.user_profile[user_id]["mab_states"] = curr_mab.dump_states()
-            json.dump(self.user_profile, open(self.profile_path, "w+"))
+            self.save_user_profile(user_id)
 
             resp = self.lm(messages=msg_history + [
                 {
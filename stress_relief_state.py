@@ -0,0 +1,169 @@
+import atexit
+import os
+import threading
+import time
+
+from state_store import StateStore
+
+# Stress relief states, as stored in the state store's stress_relief table
+NONE = 0
+AWAITING_RATING = 1
+AWAITING_FEEDBACK = 2
+
+# state -> states it may move to
+TRANSITIONS = {
+    NONE: {NONE, AWAITING_RATING},
+    # the rating may be asked again when the answer was not a number
+    AWAITING_RATING: {NONE, AWAITING_RATING, AWAITING_FEEDBACK},
+    AWAITING_FEEDBACK: {NONE, AWAITING_FEEDBACK},
+}
+
+
+class StressReliefStates:
+    """
+    Per-user stress relief state machine: none -> awaiting rating -> awaiting feedback -> none.
+
+    States are kept in memory and changed only through `start`, `advance` and `end`, which
+    reject transitions the workflow does not have. A user's state is read from the state
+    store the first time it is needed; changed states are written back in one transaction
+    by a background thread `flush_interval` seconds after the first change, and at exit.
+
+    With `shared=True` (several processes answering the same users, e.g. gunicorn workers)
+    nothing is cached: every read goes to the store and every transition is written at once,
+    so each process sees the transitions made by the others.
+    """
+
+    def __init__(self, store: StateStore, flush_interval: float = 1.0, shared: bool = False):
+        """
+        store: state store holding the stress relief table.
+        flush_interval: seconds a changed state may wait before it is written back.
+        shared: write through and do not cache, for stores shared by several processes.
+        """
+        self.store = store
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._reset()
+        # A forked worker starts without the parent's cache and flusher thread
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        # Serializes flushes, so a later state of a user is never overwritten by an earlier one
+        self._flush_lock = threading.Lock()
+        # phone number -> state; changed states are also in _dirty until written back
+        self._states = {}
+        self._dirty = {}
+        self._oldest = None
+        self._thread = None
+        self._stats = {"loads": 0, "transitions": 0, "flushes": 0, "written": 0}
+
+    def state(self, phone_number: str) -> int:
+        with self._cond:
+            state = self._states.get(phone_number)
+        if state is not None:
+            return state
+        state = int(self.store.get_stress_relief(phone_number) or NONE)
+        with self._cond:
+            self._stats["loads"] += 1
+            if self.shared:
+                return state
+            # A transition made while the store was read wins
+            return self._states.setdefault(phone_number, state)
+
+    def active(self, phone_number: str) -> bool:
+        return self.state(phone_number) != NONE
+
+    def start(self, phone_number: str):
+        """
+        Enter the workflow: the user is asked to rate their stress.
+        """
+        self._move(phone_number, AWAITING_RATING)
+
+    def advance(self, phone_number: str, cont):
+        """
+        Apply the outcome of StressReliefModule.process_user_msg / process_user_feedback:
+        False ends the workflow, 1 or 2 is the next state.
+        """
+        self._move(phone_number, int(cont or NONE))
+
+    def end(self, phone_number: str):
+        if self.active(phone_number):
+            self._move(phone_number, NONE)
+
+    def _move(self, phone_number: str, new_state: int):
+        state = self.state(phone_number)
+        if new_state not in TRANSITIONS[state]:
+            raise ValueError(f"stress relief of {phone_number} cannot go from state {state} to {new_state}")
+        if self.shared:
+            self.store.set_stress_relief(phone_number, new_state)
+            with self._cond:
+                self._stats["transitions"] += 1
+                self._stats["written"] += 1
+            return
+        with self._cond:
+            self._stats["transitions"] += 1
+            self._states[phone_number] = new_state
+            self._dirty[phone_number] = new_state
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stress-relief-flusher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """
+        Write every changed state back to the store in one transaction.
+        """
+        with self._flush_lock:
+            with self._cond:
+                batch, self._dirty, self._oldest = self._dirty, {}, None
+            if not batch:
+                return
+            try:
+                with self.store.transaction():
+                    for phone_number, state in batch.items():
+                        self.store.set_stress_relief(phone_number, state)
+            except Exception as e:
+                print(f"stress relief flush error: {e}")
+                with self._cond:
+                    # Retry with the next flush, unless the user has moved on since
+                    for phone_number, state in batch.items():
+                        self._dirty.setdefault(phone_number, state)
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+                return
+            with self._cond:
+                self._stats["flushes"] += 1
+                self._stats["written"] += len(batch)
+
+    def clear(self):
+        """
+        Forget the cached states without writing them, e.g. after the store has been cleared.
+        """
+        with self._cond:
+            self._states.clear()
+            self._dirty.clear()
+            self._oldest = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._states)
+            stats["dirty"] = len(self._dirty)
+            stats["shared"] = self.shared
+        return stats
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._dirty:
+                        waited = time.monotonic() - self._oldest
+                        if waited >= self.flush_interval:
+                            break
+                        self._cond.wait(self.flush_interval - waited)
+                    else:
+                        self._cond.wait()
+            self.flush()
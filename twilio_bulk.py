@@ -0,0 +1,200 @@
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+# Requests per second and requests in flight towards the Twilio API. Twilio allows 100
+# concurrent requests per account; the rate stays well below what our messaging service
+# accepts so that the webhook's own replies are never throttled by a bulk run.
+TWILIO_RATE_LIMIT = float(os.environ.get("TWILIO_RATE_LIMIT", 30))
+TWILIO_CONCURRENCY = int(os.environ.get("TWILIO_CONCURRENCY", 16))
+
+
+class RateLimited(Exception):
+    """
+    Raised by a transport when Twilio answered 429 (or a 5xx that is safe to retry).
+    """
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average, with bursts of up to `burst`.
+    """
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        # Called after a 429: the server says we are over the limit, so stop bursting
+        with self._lock:
+            self._tokens = 0
+            self._last = time.monotonic()
+
+
+# ----------------------
+# Transports
+# ----------------------
+class TwilioTransport:
+    """
+    Sends requests through a Twilio client on a pooled HTTP session (by default the shared
+    http_transport), so concurrent requests reuse TLS connections instead of opening one each.
+    """
+    def __init__(self, client=None, transport=None):
+        if client is None:
+            from twilio.rest import Client
+            from http_transport import http_transport
+            client = Client(os.environ.get("TWILIO_ACCOUNT_SID"), os.environ.get("TWILIO_AUTH_TOKEN"),
+                            http_client=(transport or http_transport).twilio_http_client())
+        self.client = client
+
+    def _call(self, fn: Callable, idempotent: bool):
+        from twilio.base.exceptions import TwilioRestException
+        try:
+            return fn()
+        except TwilioRestException as e:
+            # A 500, 502 or 504 may come back after Twilio has accepted the request, so only
+            # requests that can safely run twice are retried on them; 429 and 503 mean the
+            # request was turned away
+            if e.status in (429, 503) or (idempotent and e.status >= 500):
+                raise RateLimited(f"twilio {e.status}: {e.msg}")
+            raise
+
+    def create(self, **params) -> str:
+        # Creating twice would send the message twice
+        return self._call(lambda: self.client.messages.create(**params), idempotent=False).sid
+
+    def cancel(self, sid: str) -> str:
+        return self._call(lambda: self.client.messages(sid).update(status="canceled"), idempotent=True).sid
+
+
+class DryRunTransport:
+    """
+    Stand-in for Twilio when testing: records every request and answers after `latency`
+    seconds. With `max_rate` set it answers 429 to requests above that rate, like the real API.
+    """
+    def __init__(self, latency: float = 0.05, max_rate: Optional[float] = None):
+        self.latency = latency
+        self.max_rate = max_rate
+        self.created = []
+        self.cancelled = []
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._window = []
+
+    def _admit(self):
+        if self.max_rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.max_rate:
+                self.rejected += 1
+                raise RateLimited("dry run 429", retry_after=1.0 - (now - self._window[0]))
+            self._window.append(now)
+
+    def create(self, **params) -> str:
+        self._admit()
+        time.sleep(self.latency)
+        with self._lock:
+            sid = f"SMdryrun{next(self._ids):024d}"
+            self.created.append((sid, params))
+        return sid
+
+    def cancel(self, sid: str) -> str:
+        self._admit()
+        time.sleep(self.latency)
+        with self._lock:
+            self.cancelled.append(sid)
+        return sid
+
+
+# ----------------------
+# Bulk scheduler
+# ----------------------
+class BulkMessageScheduler:
+    """
+    Creates or cancels many Twilio scheduled messages at once.
+
+    Requests run on `concurrency` threads sharing one transport, and every attempt first
+    takes a token from a bucket refilled at `rate` per second, so the run stays under the
+    account's limits however many threads are free. A 429 drains the bucket and the request
+    is retried with exponential backoff and jitter (or after the Retry-After the transport
+    reports), up to `max_retries` times.
+    """
+    def __init__(self, transport, rate: float = TWILIO_RATE_LIMIT, concurrency: int = TWILIO_CONCURRENCY,
+                 max_retries: int = 5, backoff: float = 1.0, max_backoff: float = 30.0):
+        self.transport = transport
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "succeeded": 0, "failed": 0, "rate_limited": 0}
+
+    def _with_retries(self, fn: Callable[[], str]) -> str:
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            with self._lock:
+                self._stats["requests"] += 1
+            try:
+                return fn()
+            except RateLimited as e:
+                with self._lock:
+                    self._stats["rate_limited"] += 1
+                self.bucket.drain()
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after if e.retry_after is not None else \
+                    min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(delay * random.uniform(1.0, 1.5))
+
+    def _run_all(self, calls: List[Callable[[], str]]) -> List[dict]:
+        def run(call):
+            try:
+                sid = self._with_retries(call)
+                with self._lock:
+                    self._stats["succeeded"] += 1
+                return {"sid": sid, "error": None}
+            except Exception as e:
+                with self._lock:
+                    self._stats["failed"] += 1
+                return {"sid": None, "error": str(e)}
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="twilio-bulk") as executor:
+            return list(executor.map(run, calls))
+
+    def schedule_many(self, messages: List[dict]) -> List[dict]:
+        """
+        messages: keyword arguments of twilio_client.messages.create, one dict per message.
+        Returns one {"sid", "error"} per message, in order.
+        """
+        return self._run_all([lambda m=m: self.transport.create(**m) for m in messages])
+
+    def cancel_many(self, sids: List[str]) -> List[dict]:
+        return self._run_all([lambda s=s: self.transport.cancel(s) for s in sids])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
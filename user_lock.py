@@ -0,0 +1,64 @@
+import contextlib
+import fcntl
+import os
+import threading
+import zlib
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+
+
+class UserLocks:
+    """
+    Per-user locks that hold across threads and across the worker processes of a
+    multi-worker deployment (see gunicorn_conf.py).
+
+    Users are hashed onto `stripes` lock files under `lock_dir`; locking a user takes an
+    in-process RLock for its stripe and then an exclusive flock on the stripe's file. Two
+    users on the same stripe wait for each other, which with enough stripes is rare. The
+    locks are re-entrant within a thread, and the kernel releases them if a worker dies.
+    """
+
+    def __init__(self, lock_dir: str, stripes: int = 256):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        os.makedirs(lock_dir, exist_ok=True)
+        self._reset()
+        # A forked worker must not share the parent's open lock files or thread locks
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._locks = [threading.RLock() for _ in range(self.stripes)]
+        # stripe -> [file descriptor, depth]; only touched while holding the stripe's RLock
+        self._held = {}
+
+    def stripe_of(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % self.stripes
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        stripe = self.stripe_of(key)
+        with self._locks[stripe]:
+            held = self._held.get(stripe)
+            if held is None:
+                fd = os.open(os.path.join(self.lock_dir, f"user_{stripe}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                held = self._held[stripe] = [fd, 0]
+            held[1] += 1
+            try:
+                yield
+            finally:
+                held[1] -= 1
+                if held[1] == 0:
+                    del self._held[stripe]
+                    fcntl.flock(held[0], fcntl.LOCK_UN)
+                    os.close(held[0])
+
+
+# Held for a user's whole turn by the reply pipeline of every worker
+user_locks = UserLocks(os.environ.get("USER_LOCK_DIR", os.path.join(__location__, "locks")),
+                       stripes=int(os.environ.get("USER_LOCK_STRIPES", 256)))
+
+# Held by the rolling summarizer through the LLM calls of a summary update. Separate lock
+# files, so a background summary never holds up the replies to its user or to the users
+# sharing its stripe
+summary_locks = UserLocks(os.path.join(user_locks.lock_dir, "summaries"), stripes=user_locks.stripes)